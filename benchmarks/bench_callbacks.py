@@ -0,0 +1,352 @@
+"""
+    Measures what supports_callbacks costs.  Run it from the repository root:
+
+    python benchmarks/bench_callbacks.py [--quick] [--output results.json]
+                                         [--compare baseline.json]
+
+Every benchmark reports the best of several repeats, in nanoseconds per
+operation (or bytes for the memory benchmarks).  --output writes the
+results as JSON and --compare prints the ratio against an earlier run, so
+changes to SupportsCallbacks can be compared between versions.  Benchmarks
+of features the measured version does not have are skipped, and listed
+under 'skipped' in the results.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import gc
+import inspect
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from callbacks import supports_callbacks, __version__
+
+CALLBACK_COUNTS = (0, 1, 10, 100)
+FLAG_COMBINATIONS = ((False, False), (True, False), (False, True), (True, True))
+
+def callback(*args, **kwargs):
+    pass
+
+def handler(exception, *args, **kwargs):
+    return None
+
+def plain(a, b=2):
+    return a
+
+def raises(a, b=2):
+    raise ValueError(a)
+
+def missing(method, *parameters):
+    '''
+        Returns None if the registries of the version being measured have
+    <method> and it takes all of <parameters>, otherwise the reason why a
+    benchmark that needs them is skipped.
+    '''
+    function = getattr(type(supports_callbacks(plain)), method, None)
+    if function is None:
+        return 'needs %s' % method
+    names = inspect.signature(function).parameters
+    absent = [name for name in parameters if name not in names]
+    if absent:
+        return 'needs %s(%s)' % (method, ', '.join(absent))
+    return None
+
+def time_per_call(statement, number, repeat):
+    '''
+        Returns the fastest of <repeat> runs of <statement>, in nanoseconds
+    per call.
+    '''
+    timer = timeit.Timer(statement)
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e9
+
+def bench_call_overhead(number, repeat):
+    results = {'undecorated': time_per_call(lambda: plain(1, b=2),
+            number, repeat)}
+    for count in CALLBACK_COUNTS:
+        target = supports_callbacks(plain)
+        for _ in range(count):
+            target.add_pre_callback(callback)
+            target.add_post_callback(callback)
+            target.add_exception_callback(callback)
+        # fewer iterations for the slow cases, the result is per call anyway
+        iterations = max(number // max(count, 1), 100)
+        results['decorated_%d_per_phase' % count] = time_per_call(
+                lambda: target(1, b=2), iterations, repeat)
+    return results
+
+def bench_flags(number, repeat):
+    results = {}
+    for takes_target_args, takes_target_result in FLAG_COMBINATIONS:
+        target = supports_callbacks(plain)
+        target.add_post_callback(callback,
+                takes_target_args=takes_target_args,
+                takes_target_result=takes_target_result)
+        name = 'args_%s_result_%s' % (takes_target_args, takes_target_result)
+        results[name] = time_per_call(lambda: target(1, b=2), number, repeat)
+    return results
+
+def bench_exception_path(number, repeat, skipped):
+    results = {}
+
+    def call_undecorated():
+        try:
+            raises(1)
+        except ValueError:
+            pass
+    results['undecorated_raise'] = time_per_call(call_undecorated,
+            number, repeat)
+
+    for count in CALLBACK_COUNTS:
+        target = supports_callbacks(raises)
+        for _ in range(count):
+            target.add_exception_callback(callback, takes_target_args=True)
+
+        def call_reraised():
+            try:
+                target(1)
+            except ValueError:
+                pass
+        iterations = max(number // max(count, 1), 100)
+        results['reraised_%d_callbacks' % count] = time_per_call(
+                call_reraised, iterations, repeat)
+
+    target = supports_callbacks(raises)
+    target.add_exception_callback(handler, takes_target_args=True,
+            handles_exception=True)
+    results['handled'] = time_per_call(lambda: target(1), number, repeat)
+
+    # many specialized handlers, only one of which applies to ValueError
+    reason = missing('add_exception_callback', 'exception_types')
+    if reason is not None:
+        skipped['exception_path.handled_typed_1_of_101'] = reason
+        return results
+    target = supports_callbacks(raises)
+    for count in range(100):
+        exception_type = type('Error%d' % count, (Exception,), {})
+        target.add_exception_callback(handler, handles_exception=True,
+                exception_types=exception_type)
+    target.add_exception_callback(handler, handles_exception=True,
+            exception_types=ValueError)
+    results['handled_typed_1_of_101'] = time_per_call(lambda: target(1),
+            number, repeat)
+    return results
+
+def bench_filters(number, repeat):
+    '''
+        One callback per distinct value of the key argument, so every call
+    matches exactly one of them.
+    '''
+    results = {}
+    for count in CALLBACK_COUNTS:
+        target = supports_callbacks(plain)
+        for value in range(count):
+            target.add_post_callback(callback, when={'a': value})
+        results['when_%d_values' % count] = time_per_call(
+                lambda: target(0, b=2), number, repeat)
+    return results
+
+def bench_batch(number, repeat):
+    '''
+        Per call cost of call_many over 1000 calls, with 10 pre and 10 post
+    callbacks, called per call and once per batch.
+    '''
+    results = {}
+    target = supports_callbacks(plain)
+    for _ in range(10):
+        target.add_pre_callback(callback)
+        target.add_post_callback(callback)
+    calls = [(value,) for value in range(1000)]
+    iterations = max(number // 1000, 10)
+    for name, batch_callbacks in [('call_many_per_call', False),
+                                  ('call_many_batched', True)]:
+        results[name] = time_per_call(
+                lambda: target.call_many(calls,
+                    batch_callbacks=batch_callbacks),
+                iterations, repeat) / len(calls)
+    return results
+
+def bench_sampling(number, repeat):
+    '''
+        One post callback that takes the target's arguments and result,
+    with each of the sampling options set so that almost every call skips
+    it.
+    '''
+    results = {}
+    for name, options in [('unsampled', {}),
+                          ('sample_every_100', {'sample_every': 100}),
+                          ('sample_rate_0.01', {'sample_rate': 0.01}),
+                          ('max_per_second_1', {'max_per_second': 1})]:
+        target = supports_callbacks(plain)
+        target.add_post_callback(callback, takes_target_args=True,
+                takes_target_result=True, **options)
+        results[name] = time_per_call(lambda: target(1, b=2), number, repeat)
+    return results
+
+def bench_churn(scale, repeat, skipped):
+    results = {}
+    target = supports_callbacks(plain)
+
+    def add_all():
+        return [target.add_post_callback(callback) for _ in range(scale)]
+
+    def add_then_remove_each():
+        for label in add_all():
+            target.remove_callback(label)
+
+    def add_then_remove_all():
+        target.remove_callbacks(add_all())
+
+    def add_then_remove_by_label():
+        labels = add_all()
+        target.remove_callbacks()
+        return labels
+
+    for name, function in [('add_remove_each', add_then_remove_each),
+                           ('add_remove_bulk', add_then_remove_all),
+                           ('add_clear', add_then_remove_by_label)]:
+        results['%s_%d' % (name, scale)] = time_per_call(function, 1,
+                repeat) / scale
+
+    # disabling and enabling a group of <scale> callbacks, once both plans
+    # were built; per toggle, not per callback
+    reason = missing('disable_group') or missing('add_post_callback', 'group')
+    if reason is not None:
+        skipped['churn.toggle_group_%d' % scale] = reason
+        return results
+    for _ in range(scale):
+        target.add_post_callback(callback, group='tracing')
+    def toggle_group():
+        target.disable_group('tracing')
+        target.enable_group('tracing')
+    toggle_group()
+    results['toggle_group_%d' % scale] = time_per_call(toggle_group, 1000,
+            repeat) / 2
+    target.remove_callbacks()
+    return results
+
+class Example(object):
+    @supports_callbacks
+    def method(self, value):
+        return value
+
+def bench_instance_access(number, repeat):
+    results = {}
+    results['first_access_call'] = time_per_call(
+            lambda: Example().method(1), number, repeat)
+    e = Example()
+    results['repeat_access_call'] = time_per_call(lambda: e.method(1),
+            number, repeat)
+
+    Example.method.add_callback(callback)
+    results['repeat_access_call_class_callback'] = time_per_call(
+            lambda: e.method(1), number, repeat)
+    e.method.add_callback(callback)
+    results['repeat_access_call_both_callbacks'] = time_per_call(
+            lambda: e.method(1), number, repeat)
+    Example.method.remove_callbacks()
+    return results
+
+def bench_memory(count):
+    '''
+        Bytes allocated per instance for an instance that only calls its
+    method, and for one that registers an instance-level callback.
+    '''
+    results = {}
+    for name, register in [('per_instance_plain_call', False),
+                           ('per_instance_registry', True)]:
+        gc.collect()
+        tracemalloc.start()
+        instances = [Example() for _ in range(count)]
+        before = tracemalloc.get_traced_memory()[0]
+        for e in instances:
+            e.method(1)
+            if register:
+                e.method.add_callback(callback)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results[name] = (after - before) / float(count)
+        del instances
+    return results
+
+def run(quick=False):
+    if quick:
+        number, repeat, scale, count = 2000, 3, 100, 1000
+    else:
+        number, repeat, scale, count = 100000, 5, 1000, 10000
+
+    skipped = {}
+    results = {
+        'meta': {'callbacks_version': __version__,
+                 'python': platform.python_version(),
+                 'implementation': platform.python_implementation(),
+                 'units': 'ns per call, bytes for memory'},
+        'call_overhead': bench_call_overhead(number, repeat),
+        'flags': bench_flags(number, repeat),
+        'exception_path': bench_exception_path(number // 10, repeat,
+            skipped),
+        'churn': bench_churn(scale, repeat, skipped),
+        'instance_access': bench_instance_access(number, repeat),
+        'memory': bench_memory(count),
+        'skipped': skipped,
+    }
+    for group, bench, reason in [
+            ('filters', lambda: bench_filters(number, repeat),
+                missing('add_post_callback', 'when')),
+            ('batch', lambda: bench_batch(number, repeat),
+                missing('call_many')),
+            ('sampling', lambda: bench_sampling(number, repeat),
+                missing('add_post_callback', 'sample_every', 'sample_rate',
+                    'max_per_second'))]:
+        if reason is None:
+            results[group] = bench()
+        else:
+            skipped[group] = reason
+    return results
+
+def compare(results, baseline):
+    lines = []
+    for group, values in sorted(results.items()):
+        if group in ('meta', 'skipped'):
+            continue
+        for name, value in sorted(values.items()):
+            old = baseline.get(group, {}).get(name)
+            if old:
+                lines.append('%-20s %-40s %12.1f %12.1f %7.2fx' %
+                        (group, name, old, value, value / old))
+            else:
+                lines.append('%-20s %-40s %12s %12.1f' %
+                        (group, name, '-', value))
+    for name, reason in sorted(results.get('skipped', {}).items()):
+        lines.append('%-61s skipped, %s' % (name, reason))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true',
+            help='fewer iterations, for a smoke test')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare',
+            help='print the results relative to this earlier output')
+    options = parser.parse_args(argv)
+
+    results = run(quick=options.quick)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            print(compare(results, json.load(f)))
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
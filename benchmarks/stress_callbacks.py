@@ -0,0 +1,218 @@
+"""
+    Hammers a decorated function and a decorated method from many threads
+while other threads register and unregister callbacks and create and
+discard instances.  Run it from the repository root:
+
+    python benchmarks/stress_callbacks.py [--threads 1,2,4,8]
+                                          [--duration 2] [--output out.json]
+
+For every thread count it checks that
+    - the callbacks that are registered for the whole run fire exactly once
+      per call,
+    - no call runs a callback more than once,
+    - instance-level callbacks only fire for their own instance, once per
+      call,
+    - registering, unregistering and calling never raise,
+and it reports the calls per second.  The exit status is 1 if an
+invariant was broken.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from callbacks import supports_callbacks
+
+STABLE_CALLBACKS = 3
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def add(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+class StressRun(object):
+    def __init__(self, callers, churners, duration):
+        self.callers = callers
+        self.churners = churners
+        self.duration = duration
+
+        self.stop = threading.Event()
+        self.errors = []
+        self.calls = Counter()
+        self.stable_invocations = Counter()
+        self.duplicates = Counter()
+        self.instance_mismatches = Counter()
+        self.local = threading.local()
+
+        @supports_callbacks
+        def target(value):
+            return value
+        self.target = target
+
+        class Example(object):
+            @supports_callbacks
+            def method(self, value):
+                return value
+        self.Example = Example
+
+        # these stay registered for the whole run
+        target.add_pre_callback(self.start_call, priority=100)
+        for _ in range(STABLE_CALLBACKS):
+            target.add_post_callback(self.stable_callback)
+        Example.method.add_pre_callback(self.start_call, priority=100)
+
+    def start_call(self, *args, **kwargs):
+        # the churn callbacks that have run during this thread's current call
+        self.local.seen = set()
+
+    def stable_callback(self):
+        self.stable_invocations.add()
+
+    def make_churn_callback(self):
+        # a distinct function per registration, so duplicates can be spotted
+        def churn_callback(*args, **kwargs):
+            seen = self.local.seen
+            if churn_callback in seen:
+                self.duplicates.add()
+            seen.add(churn_callback)
+        return churn_callback
+
+    def guarded(self, function):
+        def run():
+            try:
+                function()
+            except Exception as e:
+                self.errors.append(repr(e))
+                self.stop.set()
+        return run
+
+    def call_function(self):
+        calls = 0
+        while not self.stop.is_set():
+            if self.target(calls) != calls:
+                raise AssertionError('wrong result')
+            calls += 1
+        self.calls.add(calls)
+        self.stable_invocations.add(-STABLE_CALLBACKS * calls)
+
+    def call_methods(self):
+        calls = 0
+        while not self.stop.is_set():
+            e = self.Example()
+            fired = []
+            e.method.add_post_callback(fired.append, takes_target_args=True)
+            for value in range(10):
+                if e.method(value) != value:
+                    raise AssertionError('wrong result')
+            if fired != list(range(10)):
+                self.instance_mismatches.add()
+            calls += 10
+            del e
+        self.calls.add(calls)
+
+    def churn(self):
+        labels = []
+        while not self.stop.is_set():
+            for _ in range(5):
+                labels.append(self.target.add_pre_callback(
+                        self.make_churn_callback()))
+                labels.append(self.target.add_post_callback(
+                        self.make_churn_callback(), takes_target_args=True))
+                labels.append(self.Example.method.add_post_callback(
+                        self.make_churn_callback()))
+            # the last two labels belong to the method and the function
+            self.Example.method.remove_callback(labels.pop())
+            self.target.remove_callback(labels.pop())
+            self.Example.method.remove_callbacks(
+                    [label for label in labels
+                        if label in self.Example.method.callbacks])
+            self.target.remove_callbacks(
+                    [label for label in labels
+                        if label in self.target.callbacks])
+            del labels[:]
+
+    def run(self):
+        threads = []
+        for index in range(self.callers):
+            if index % 2:
+                function = self.call_methods
+            else:
+                function = self.call_function
+            threads.append(threading.Thread(target=self.guarded(function)))
+        for _ in range(self.churners):
+            threads.append(threading.Thread(target=self.guarded(self.churn)))
+
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        self.stop.wait(self.duration)
+        self.stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        gc.collect()
+        leaked_registries = len(
+                self.Example.__dict__['method']._callback_registries)
+        return {
+            'caller_threads': self.callers,
+            'churn_threads': self.churners,
+            'calls': self.calls.value,
+            'calls_per_second': self.calls.value / elapsed,
+            'errors': self.errors,
+            'lost_or_extra_stable_invocations': self.stable_invocations.value,
+            'duplicated_invocations': self.duplicates.value,
+            'instance_mismatches': self.instance_mismatches.value,
+            'leaked_instance_registries': leaked_registries,
+        }
+
+def broken_invariants(result):
+    return bool(result['errors'] or
+            result['lost_or_extra_stable_invocations'] or
+            result['duplicated_invocations'] or
+            result['instance_mismatches'] or
+            result['leaked_instance_registries'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', default='1,2,4,8',
+            help='comma separated numbers of calling threads')
+    parser.add_argument('--churn-threads', type=int, default=2,
+            help='threads that add and remove callbacks')
+    parser.add_argument('--duration', type=float, default=2.0,
+            help='seconds per thread count')
+    parser.add_argument('--output', help='write the results to this file')
+    options = parser.parse_args(argv)
+
+    results = []
+    for callers in [int(count) for count in options.threads.split(',')]:
+        result = StressRun(callers, options.churn_threads,
+                options.duration).run()
+        results.append(result)
+        print('%2d callers: %10.0f calls/s  %s' % (callers,
+                result['calls_per_second'],
+                'BROKEN' if broken_invariants(result) else 'ok'))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    failed = [result for result in results if broken_invariants(result)]
+    for result in failed:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,6 @@
-from .callbacks import supports_callbacks
+from .callbacks import (supports_callbacks, CallbackRecord, CallbackLabel,
+        ShortCircuit)
+from .background import BackgroundDispatcher, ProcessDispatcher
 __version__ = '0.2.0'
 
 __doc__ = """
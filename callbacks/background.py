@@ -0,0 +1,522 @@
+from __future__ import absolute_import
+
+from collections import deque
+from concurrent.futures import (Executor, ThreadPoolExecutor,
+        ProcessPoolExecutor)
+import asyncio
+import atexit
+import inspect
+import logging
+import os
+import pickle
+import threading
+import weakref
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+DROP = 'drop'
+RAISE = 'raise'
+INLINE = 'inline'
+UNPICKLABLE_POLICIES = (DROP, RAISE, INLINE)
+
+# dispatchers that still have to be drained when the interpreter exits
+_live_dispatchers = weakref.WeakSet()
+# and buffers (CallBuffers and Debouncers) that still have to be flushed
+_live_buffers = weakref.WeakSet()
+
+def _call(function, args, kwargs):
+    '''
+        Calls function(*args, **kwargs) and, if that returns an awaitable
+    (the callback is a coroutine function), runs it to completion on an
+    event loop of its own, since the worker has none.
+    '''
+    result = function(*args, **kwargs)
+    if inspect.isawaitable(result):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(result)
+        finally:
+            loop.close()
+
+class BackgroundDispatcher(object):
+    '''
+        Runs callbacks off the calling thread.  Calls are put on a bounded
+    queue and run by <max_workers> tasks of <executor>, which is any
+    concurrent.futures.Executor.  If no executor is given a
+    ThreadPoolExecutor is created when the first call is queued.
+    Inputs:
+        executor: The concurrent.futures.Executor to run callbacks on, or
+            None to use a private thread pool.
+        max_queue: How many calls may wait to be run.
+        overflow: What to do with a call when the queue is full:
+            'block'        wait until there is room (the default).
+            'drop_oldest'  discard the call that has waited the longest.
+            'drop_newest'  discard the new call.
+            The number of discarded calls is counted in <dropped>.
+        max_workers: How many calls may run at the same time.  With the
+            default of 1 calls run in the order they were queued.
+        drain_on_exit: If True, queued calls are run before the interpreter
+            exits.
+    Callbacks that are coroutine functions are run to completion on an event
+    loop of the worker's own.  Exceptions raised by callbacks are logged and
+    counted in <errors>.
+    '''
+    def __init__(self, executor=None, max_queue=1024, overflow=BLOCK,
+            max_workers=1, drain_on_exit=True):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of %s, not %r' %
+                    (', '.join(OVERFLOW_POLICIES), overflow))
+        if max_queue < 1 or max_workers < 1:
+            raise ValueError('max_queue and max_workers must be at least 1.')
+
+        self.executor = executor
+        self._owns_executor = executor is None
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.max_workers = max_workers
+        self.dropped = 0
+        self.errors = 0
+
+        self._shut_down = False
+        self._reset()
+
+        if drain_on_exit:
+            _live_dispatchers.add(self)
+
+    def _reset(self):
+        self._queue = deque()
+        self._active_workers = 0
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+
+    def _reset_in_child(self):
+        # in a forked child the queued calls are the parent's to run, and
+        # the worker threads (and a private pool's threads) do not exist
+        self._reset()
+        if self._owns_executor:
+            self.executor = None
+
+    def submit(self, function, args, kwargs):
+        '''
+            Queues function(*args, **kwargs) to be run in the background.
+        Returns:
+            False if the call was dropped, True otherwise.
+        '''
+        with self._lock:
+            if self._shut_down:
+                raise RuntimeError('Cannot submit callbacks after shutdown.')
+            if len(self._queue) >= self.max_queue:
+                if self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.overflow == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._queue) >= self.max_queue:
+                        self._not_full.wait()
+            self._queue.append((function, args, kwargs))
+            if self._active_workers < self.max_workers:
+                self._active_workers += 1
+                start_worker = True
+            else:
+                start_worker = False
+
+        if start_worker:
+            try:
+                self._get_executor().submit(self._work)
+            except Exception:
+                with self._lock:
+                    self._active_workers -= 1
+                    self._idle.notify_all()
+                raise
+        return True
+
+    def _get_executor(self):
+        if self.executor is None:
+            with self._lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(
+                            max_workers=self.max_workers)
+        return self.executor
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._active_workers -= 1
+                    self._idle.notify_all()
+                    return
+                function, args, kwargs = self._queue.popleft()
+                self._not_full.notify()
+            try:
+                _call(function, args, kwargs)
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                logger.exception('Background callback %r raised', function)
+
+    @property
+    def pending(self):
+        '''
+            The number of calls that are queued or running.
+        '''
+        with self._lock:
+            return len(self._queue) + self._active_workers
+
+    def flush(self, timeout=None):
+        '''
+            Waits until every queued call has been run.
+        Inputs:
+            timeout: Seconds to wait, or None to wait for as long as it takes.
+        Returns:
+            True if the queue was drained, False if <timeout> expired first.
+        '''
+        with self._lock:
+            return self._idle.wait_for(
+                    lambda: not self._queue and not self._active_workers,
+                    timeout)
+
+    def shutdown(self, wait=True):
+        '''
+            Stops accepting calls.  If <wait> is True, the queued calls are run
+        first, otherwise they are discarded.  A private thread pool is shut
+        down as well; a user supplied executor is left running.
+        '''
+        with self._lock:
+            self._shut_down = True
+            if not wait:
+                self.dropped += len(self._queue)
+                self._queue.clear()
+                self._not_full.notify_all()
+        if wait:
+            self.flush()
+        if self._owns_executor and self.executor is not None:
+            self.executor.shutdown(wait=wait)
+        _live_dispatchers.discard(self)
+
+def _call_pickled(payload):
+    function, args, kwargs = pickle.loads(payload)
+    _call(function, args, kwargs)
+
+class ProcessDispatcher(BackgroundDispatcher):
+    '''
+        Runs callbacks in other processes, for callbacks that are CPU bound
+    and would only contend for the GIL in threads.  Calls are pickled when
+    they are submitted, so only what the callback is passed (the arguments
+    and result of the target if it takes them) is sent, and the callback
+    itself must be picklable: a module level function, for instance.
+    Calls are queued as they are by BackgroundDispatcher and handed to
+    <max_workers> processes; at most max_queue + max_workers calls are in
+    flight at any time.
+    Inputs:
+        processes: The concurrent.futures.ProcessPoolExecutor to run
+            callbacks in, or None to use a private one with <max_workers>
+            processes.
+        max_queue, overflow, drain_on_exit: see BackgroundDispatcher.
+        max_workers: How many calls may run at the same time, by default
+            the number of CPUs.
+        unpicklable: What to do with a call that cannot be pickled:
+            'drop'    log and discard it (the default).
+            'raise'   raise the pickling error to the caller.
+            'inline'  run it in the calling thread instead.
+            The number of unpicklable calls is counted in <unpicklable>.
+        mp_context: The multiprocessing context of the private process pool
+            (Python 3.7 and later).
+    Exceptions raised by callbacks are logged and counted in <errors>.
+    '''
+    def __init__(self, processes=None, max_queue=1024, overflow=BLOCK,
+            max_workers=None, unpicklable=DROP, drain_on_exit=True,
+            mp_context=None):
+        if unpicklable not in UNPICKLABLE_POLICIES:
+            raise ValueError('unpicklable must be one of %s, not %r' %
+                    (', '.join(UNPICKLABLE_POLICIES), unpicklable))
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        super(ProcessDispatcher, self).__init__(max_queue=max_queue,
+                overflow=overflow, max_workers=max_workers,
+                drain_on_exit=drain_on_exit)
+        self.processes = processes
+        self._owns_processes = processes is None
+        self._mp_context = mp_context
+        self.unpicklable_policy = unpicklable
+        self.unpicklable = 0
+
+    def submit(self, function, args, kwargs):
+        '''
+            Pickles function(*args, **kwargs) and queues it to be run in
+        another process.
+        Returns:
+            False if the call was dropped, True otherwise.
+        '''
+        try:
+            payload = pickle.dumps((function, args, kwargs),
+                    pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            with self._lock:
+                self.unpicklable += 1
+            if self.unpicklable_policy == RAISE:
+                raise
+            elif self.unpicklable_policy == INLINE:
+                function(*args, **kwargs)
+                return True
+            logger.warning('Dropped background callback %r, its call could '
+                    'not be pickled', function, exc_info=True)
+            return False
+        return super(ProcessDispatcher, self).submit(self._run_in_process,
+                (payload,), {})
+
+    def _get_processes(self):
+        if self.processes is None:
+            with self._lock:
+                if self.processes is None:
+                    if self._mp_context is None:
+                        # mp_context is only accepted from Python 3.7 on
+                        self.processes = ProcessPoolExecutor(
+                                max_workers=self.max_workers)
+                    else:
+                        self.processes = ProcessPoolExecutor(
+                                max_workers=self.max_workers,
+                                mp_context=self._mp_context)
+        return self.processes
+
+    def _run_in_process(self, payload):
+        # runs on a worker thread, which waits for the process so that
+        # the queue bounds the calls in flight
+        self._get_processes().submit(_call_pickled, payload).result()
+
+    def _reset_in_child(self):
+        super(ProcessDispatcher, self)._reset_in_child()
+        if self._owns_processes:
+            self.processes = None
+
+    def shutdown(self, wait=True):
+        '''
+            See BackgroundDispatcher.shutdown, a private process pool is
+        shut down as well.
+        '''
+        super(ProcessDispatcher, self).shutdown(wait=wait)
+        if self._owns_processes and self.processes is not None:
+            self.processes.shutdown(wait=wait)
+
+def as_dispatcher(executor):
+    '''
+        Returns <executor> if it is a BackgroundDispatcher, otherwise wraps
+    the concurrent.futures.Executor in a BackgroundDispatcher (or, for a
+    ProcessPoolExecutor, a ProcessDispatcher) with the default queue
+    settings.
+    '''
+    if isinstance(executor, BackgroundDispatcher):
+        return executor
+    if isinstance(executor, ProcessPoolExecutor):
+        return ProcessDispatcher(executor)
+    if isinstance(executor, Executor):
+        return BackgroundDispatcher(executor)
+    raise TypeError('Expected a BackgroundDispatcher or a '
+            'concurrent.futures.Executor, not %r' % (executor,))
+
+def dispatched(dispatcher, function):
+    '''
+        Returns a function that queues calls to <function> on <dispatcher>.
+    '''
+    def dispatch(*args, **kwargs):
+        dispatcher.submit(function, args, kwargs)
+    return dispatch
+
+class CallBuffer(object):
+    '''
+        Collects calls to <function> and passes them to it in batches: the
+    calls are stored in a preallocated list of <size> slots, and
+    function(records) is called with the list of (args, kwargs) records
+    once it is full, once <interval> seconds have passed since the first
+    call of the batch was stored, when flush() is called, and when the
+    interpreter exits.  Batches are delivered one at a time and in order;
+    exceptions raised by <function> are logged and counted in <errors>.
+    '''
+    def __init__(self, function, size, interval=None):
+        if size < 1:
+            raise ValueError('batch_size must be at least 1.')
+        if interval is not None and interval <= 0:
+            raise ValueError('batch_interval must be positive.')
+        self.function = function
+        self.size = size
+        self.interval = interval
+        self.errors = 0
+        self._reset()
+        _live_buffers.add(self)
+
+    def _reset(self):
+        self._records = [None] * self.size
+        self._count = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        # full batches, in the order they were taken, waiting to be delivered
+        self._ready = deque()
+        # held while batches are delivered, to deliver them one at a time
+        self._delivery_lock = threading.Lock()
+
+    # in a forked child the stored calls are the parent's to deliver
+    _reset_in_child = _reset
+
+    def __len__(self):
+        return self._count
+
+    def append(self, *args, **kwargs):
+        '''
+            Stores a call, and delivers the batch if that filled it.
+        '''
+        with self._lock:
+            self._records[self._count] = (args, kwargs)
+            self._count += 1
+            if self._count < self.size:
+                if self._count == 1 and self.interval is not None:
+                    self._timer = threading.Timer(self.interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._take()
+        self._deliver()
+
+    def flush(self):
+        '''
+            Delivers the stored calls, if there are any.
+        '''
+        with self._lock:
+            self._take()
+        self._deliver()
+
+    def _take(self):
+        # with self._lock held: moves the stored calls to the ready batches
+        count = self._count
+        if not count:
+            return
+        records = self._records
+        self._records = [None] * self.size
+        self._count = 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        del records[count:]
+        self._ready.append(records)
+
+    def _deliver(self):
+        with self._delivery_lock:
+            while self._ready:
+                records = self._ready.popleft()
+                try:
+                    self.function(records)
+                except Exception:
+                    with self._lock:
+                        self.errors += 1
+                    logger.exception('Buffered callback %r raised',
+                            self.function)
+
+class Debouncer(object):
+    '''
+        Holds back calls until there have been none for <wait> seconds, and
+    then makes only the last one, on a timer thread.  Exceptions raised by
+    the call are logged and counted in <errors>.
+    '''
+    def __init__(self, wait):
+        if wait <= 0:
+            raise ValueError('debounce must be positive.')
+        self.wait = wait
+        self.errors = 0
+        self._reset()
+        _live_buffers.add(self)
+
+    def _reset(self):
+        # (function, args, kwargs) of the last call, or None
+        self._pending = None
+        self._deadline = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    # in a forked child the held back call is the parent's to make
+    _reset_in_child = _reset
+
+    def call(self, function, args, kwargs):
+        with self._lock:
+            self._pending = (function, args, kwargs)
+            self._deadline = monotonic() + self.wait
+            if self._timer is None:
+                self._start_timer(self.wait)
+
+    def _start_timer(self, delay):
+        self._timer = threading.Timer(delay, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire(self):
+        with self._lock:
+            if self._timer is None:
+                # flushed in the meantime
+                return
+            remaining = self._deadline - monotonic()
+            if remaining > 0:
+                self._start_timer(remaining)
+                return
+            pending, self._pending = self._pending, None
+            self._timer = None
+        self._run(pending)
+
+    def flush(self):
+        '''
+            Makes the call that is being held back now, if there is one.
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self._run(pending)
+
+    def _run(self, pending):
+        if pending is None:
+            return
+        function, args, kwargs = pending
+        try:
+            function(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            logger.exception('Debounced callback %r raised', function)
+
+def debounced(debouncer, function):
+    '''
+        Returns a function that hands calls to <function> to <debouncer>.
+    '''
+    def debounce(*args, **kwargs):
+        debouncer.call(function, args, kwargs)
+    return debounce
+
+def _drain_dispatchers():
+    # buffers first, their batches may be queued on dispatchers
+    for buffer in list(_live_buffers):
+        buffer.flush()
+    for dispatcher in list(_live_dispatchers):
+        dispatcher.shutdown(wait=True)
+
+# concurrent.futures refuses new work once the interpreter starts shutting
+# down its threads, which happens before atexit functions run, so the queues
+# are drained at that point where the interpreter allows it
+_register_atexit = getattr(threading, '_register_atexit', atexit.register)
+_register_atexit(_drain_dispatchers)
+
+if hasattr(os, 'register_at_fork'):
+    # a forked child (a worker of a pre-fork server, say) keeps using the
+    # dispatchers and buffers of the parent, so they are drained when it
+    # exits too, but only of what the child itself queued
+    def _reset_in_child():
+        for dispatcher in list(_live_dispatchers):
+            dispatcher._reset_in_child()
+        for buffer in list(_live_buffers):
+            buffer._reset_in_child()
+    os.register_at_fork(after_in_child=_reset_in_child)
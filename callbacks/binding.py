@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+
+import inspect
+
+_missing = object()
+
+def parameter_getters(signature, names, skip_first=False):
+    '''
+        Works out, once, where each of the target's parameters <names> can be
+    found in the (args, kwargs) the target is called with.
+    Inputs:
+        signature: The inspect.Signature of the target.
+        names: The names of the parameters to fetch.
+        skip_first: If True the first parameter (e.g. 'self') is not part of
+            the args callbacks are given.
+    Returns:
+        A tuple with a function(args, kwargs) -> value for each name.
+    '''
+    parameters = list(signature.parameters.values())
+    if skip_first:
+        parameters = parameters[1:]
+    by_name = dict((parameter.name, (position, parameter))
+            for position, parameter in enumerate(parameters))
+    named = frozenset(parameter.name for parameter in parameters
+            if parameter.kind not in (inspect.Parameter.VAR_POSITIONAL,
+                inspect.Parameter.VAR_KEYWORD))
+
+    getters = []
+    for name in names:
+        if name not in by_name:
+            raise ValueError('Target has no parameter named %r, its '
+                    'parameters are %s' % (name,
+                        ', '.join(parameter.name for parameter in parameters)))
+        position, parameter = by_name[name]
+        getters.append(_getter(parameter, position, named))
+    return tuple(getters)
+
+def _getter(parameter, position, named):
+    name = parameter.name
+    default = parameter.default
+    if default is inspect.Parameter.empty:
+        default = _missing
+
+    def check(value):
+        if value is _missing:
+            raise TypeError('Missing value for parameter %r' % name)
+        return value
+
+    if parameter.kind == inspect.Parameter.VAR_POSITIONAL:
+        return lambda args, kwargs: args[position:]
+    elif parameter.kind == inspect.Parameter.VAR_KEYWORD:
+        return lambda args, kwargs: dict((key, value)
+                for key, value in kwargs.items() if key not in named)
+    elif parameter.kind == inspect.Parameter.KEYWORD_ONLY:
+        return lambda args, kwargs: check(kwargs.get(name, default))
+    elif parameter.kind == inspect.Parameter.POSITIONAL_ONLY:
+        return lambda args, kwargs: (args[position] if len(args) > position
+                else check(default))
+    else:
+        return lambda args, kwargs: (args[position] if len(args) > position
+                else check(kwargs.get(name, default)))
+
+def with_parameters(function, getters, keywords=None, leading=0):
+    '''
+        Returns a function that takes the target's (*args, **kwargs), after
+    <leading> other positional arguments (the target's result or the
+    exception), and calls <function> with just the values <getters> fetch:
+    as keyword arguments named by <keywords>, or positionally if <keywords>
+    is None.
+    '''
+    if keywords is None:
+        def call_with_parameters(*args, **kwargs):
+            target_args = args[leading:]
+            return function(*(args[:leading] + tuple(
+                    getter(target_args, kwargs) for getter in getters)))
+    else:
+        pairs = tuple(zip(keywords, getters))
+        def call_with_parameters(*args, **kwargs):
+            target_args = args[leading:]
+            return function(*args[:leading], **dict(
+                    (keyword, getter(target_args, kwargs))
+                    for keyword, getter in pairs))
+    return call_with_parameters
+
+def with_inserted(function, values, position=0):
+    '''
+        Returns a function that calls <function> with the tuple <values>
+    inserted into its positional arguments at <position>.
+    '''
+    def call_with_inserted(*args, **kwargs):
+        return function(*(args[:position] + values + args[position:]),
+                **kwargs)
+    return call_with_inserted
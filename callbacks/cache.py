@@ -0,0 +1,251 @@
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from time import monotonic
+import inspect
+import threading
+import weakref
+
+HIT = 'hit'
+MISS = 'miss'
+EVICT = 'evict'
+CACHE_EVENTS = (HIT, MISS, EVICT)
+
+INSTANCE = 'instance'
+CLASS = 'class'
+CACHE_SCOPES = (INSTANCE, CLASS)
+
+_missing = object()
+
+class ResultCache(object):
+    '''
+        A size-bounded, least recently used cache.  If <ttl> is given,
+    entries are also evicted once they are <ttl> seconds old, when they are
+    next looked up.
+    '''
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+            Returns (value, evicted keys), where value is the cached value
+        for <key> or a sentinel if there is none.
+        '''
+        with self._lock:
+            entry = self._entries.get(key, _missing)
+            if entry is _missing:
+                self.misses += 1
+                return _missing, ()
+            value, expires = entry
+            if expires is not None and expires <= monotonic():
+                del self._entries[key]
+                self.misses += 1
+                self.evictions += 1
+                return _missing, (key,)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value, ()
+
+    def put(self, key, value):
+        '''
+            Caches <value> for <key>.
+        Returns:
+            The keys that were evicted to make room for it.
+        '''
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = monotonic() + self.ttl
+        evicted = []
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                evicted.append(self._entries.popitem(last=False)[0])
+            self.evictions += len(evicted)
+        return evicted
+
+    def clear(self):
+        '''
+            Throws away every entry and resets the counters.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._entries),
+                'maxsize': self.maxsize, 'ttl': self.ttl}
+
+class CachedTarget(object):
+    '''
+        Calls a target through ResultCaches.  Calls are keyed by their
+    arguments bound to <signature>, with defaults applied, so f(1) and
+    f(a=1) share an entry.  For methods the instance is not part of the key:
+    with the 'instance' scope every instance has a cache of its own (which
+    goes away with the instance), with the 'class' scope all instances share
+    one.  Calls whose arguments are unhashable, or whose instance cannot be
+    weakly referenced, are not cached.  Exceptions are never cached.
+        <listeners> is a tuple of (function, events) that is replaced, not
+    modified, by the registry; function(event, key) is called for every
+    event in <events>.
+    '''
+    def __init__(self, signature, maxsize=128, ttl=None, scope=INSTANCE):
+        if scope not in CACHE_SCOPES:
+            raise ValueError('cache_scope must be one of %s, not %r' %
+                    (', '.join(CACHE_SCOPES), scope))
+        if maxsize < 1:
+            raise ValueError('cache_size must be at least 1.')
+        if ttl is not None and ttl <= 0:
+            raise ValueError('cache_ttl must be positive.')
+        self.signature = signature
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.scope = scope
+        self.is_method = False
+        self.listeners = ()
+        self.cache = ResultCache(maxsize, ttl)
+        # keyed by id, not by the instance: instances that compare equal
+        # still get caches of their own
+        self._instance_caches = {}
+        self._lock = threading.Lock()
+
+    def cache_for(self, args):
+        '''
+            Returns the ResultCache for a call with <args>, or None if the
+        call cannot be cached.
+        '''
+        if not self.is_method or self.scope == CLASS:
+            return self.cache
+        if not args:
+            return None
+        instance = args[0]
+        cache = self._instance_caches.get(id(instance))
+        if cache is None:
+            with self._lock:
+                cache = self._instance_caches.get(id(instance))
+                if cache is None:
+                    try:
+                        # the id is only reused once the instance is gone
+                        weakref.finalize(instance, self._forget, id(instance))
+                    except TypeError:
+                        return None
+                    cache = ResultCache(self.maxsize, self.ttl)
+                    self._instance_caches[id(instance)] = cache
+        return cache
+
+    def _forget(self, instance_id):
+        with self._lock:
+            self._instance_caches.pop(instance_id, None)
+
+    def key(self, args, kwargs):
+        '''
+            Returns the cache key for a call, a tuple of (name, value) for
+        every parameter of the target (but 'self'), or None if the call
+        cannot be cached.
+        '''
+        try:
+            bound = self.signature.bind(*args, **kwargs)
+        except TypeError:
+            # let the target raise the error
+            return None
+        bound.apply_defaults()
+        items = list(bound.arguments.items())
+        if self.is_method:
+            items = items[1:]
+        parameters = self.signature.parameters
+        key = tuple((name, tuple(sorted(value.items()))
+                    if parameters[name].kind == inspect.Parameter.VAR_KEYWORD
+                    else value)
+                for name, value in items)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def notify(self, event, key):
+        for function, events in self.listeners:
+            if event in events:
+                function(event, key)
+
+    def lookup(self, args, kwargs):
+        '''
+            Returns (cache, key, value) for a call, value is a sentinel if
+        the call has to go to the target.
+        '''
+        cache = self.cache_for(args)
+        key = None
+        if cache is not None:
+            key = self.key(args, kwargs)
+        if key is None:
+            return None, None, _missing
+        value, evicted = cache.get(key)
+        for evicted_key in evicted:
+            self.notify(EVICT, evicted_key)
+        self.notify(MISS if value is _missing else HIT, key)
+        return cache, key, value
+
+    def store(self, cache, key, value):
+        for evicted_key in cache.put(key, value):
+            self.notify(EVICT, evicted_key)
+
+    def wrap(self, target):
+        '''
+            Returns <target> called through the cache.
+        '''
+        def cached_target(*args, **kwargs):
+            cache, key, value = self.lookup(args, kwargs)
+            if value is _missing:
+                value = target(*args, **kwargs)
+                if cache is not None:
+                    self.store(cache, key, value)
+            return value
+        return cached_target
+
+    def wrap_async(self, target):
+        '''
+            Returns the coroutine function <target> called through the cache,
+        the awaited results are cached.
+        '''
+        async def cached_target(*args, **kwargs):
+            cache, key, value = self.lookup(args, kwargs)
+            if value is _missing:
+                value = await target(*args, **kwargs)
+                if cache is not None:
+                    self.store(cache, key, value)
+            return value
+        return cached_target
+
+    def clear(self):
+        self.cache.clear()
+        with self._lock:
+            caches = list(self._instance_caches.values())
+        for cache in caches:
+            cache.clear()
+
+    def info(self):
+        '''
+            Returns hits, misses, evictions and size summed over every
+        cache, and the cache settings.
+        '''
+        with self._lock:
+            caches = [self.cache] + list(self._instance_caches.values())
+        info = {'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0}
+        for cache in caches:
+            for name, value in cache.info().items():
+                if name in info:
+                    info[name] += value
+        info.update({'maxsize': self.maxsize, 'ttl': self.ttl,
+                'scope': self.scope})
+        return info
@@ -1,11 +1,135 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+from bisect import bisect_right
 from collections import defaultdict
-from weakref import WeakKeyDictionary, proxy
-import uuid
+from functools import partial
+from types import MappingProxyType
+from weakref import WeakKeyDictionary
+import asyncio
+import itertools
 import inspect
-import six
+import threading
+
+from .background import (as_dispatcher, dispatched, debounced, CallBuffer,
+        Debouncer, ProcessDispatcher)
+from .binding import parameter_getters, with_inserted, with_parameters
+from .cache import CACHE_EVENTS, INSTANCE, CachedTarget
+from .filters import (ExceptionIndex, FilteredDispatchPlan, filter_values,
+        gated, limited, sampled, sampling_policy)
+from .stats import CallbackStats, timed, timed_async
+
+# process-wide counters for automatically generated labels and registry ids
+_label_numbers = itertools.count()
+_registry_ids = itertools.count()
+
+# stands for a plan that has to be rebuilt before the next call
+_stale = object()
+
+# what asyncio.iscoroutinefunction looks for on objects that are not
+# functions
+_is_coroutine = asyncio.coroutines._is_coroutine
+
+class CallbackLabel(object):
+    '''
+        The label given to a callback that was registered without one.  Each
+    instance is unique and only equal to itself, so it can never clash with
+    a user supplied label.  Generating one is just a counter increment.
+    '''
+    __slots__ = ('number',)
+
+    def __init__(self):
+        self.number = next(_label_numbers)
+
+    def __lt__(self, other):
+        if not isinstance(other, CallbackLabel):
+            return NotImplemented
+        return self.number < other.number
+
+    def __repr__(self):
+        return 'callback-%d' % self.number
+
+class ShortCircuit(object):
+    '''
+        Returned by a pre callback that was registered with
+    can_short_circuit=True to skip the target: the call returns <result>
+    instead, and the post callbacks are run with it as the target's result.
+    '''
+    __slots__ = ('result',)
+
+    def __init__(self, result=None):
+        self.result = result
+
+    def __repr__(self):
+        return 'ShortCircuit(%r)' % (self.result,)
+
+class CallbackRecord(object):
+    '''
+        How a single registered callback should be called.  Records are
+    created by the add_*_callback methods and are treated as read-only.
+    <takes_target_result> is only meaningful for 'post' callbacks and
+    <handles_exception> only for 'exception' callbacks; both are None for
+    the other types.
+        Most callbacks use none of the other options, so those are kept in
+    a single dict, <options>, which is None for such callbacks, and read
+    through properties that return None for an option that was not given:
+    <executor> for 'post' and 'exception' callbacks.  <target_params>.
+    <when> maps argument names to the frozenset of values the callback runs
+    for.  <predicate>.  <exception_types> is the tuple of exception types
+    an 'exception' callback is limited to.  <can_short_circuit> is only
+    meaningful for 'pre' callbacks, <takes_short_circuited> only for 'post'
+    callbacks, <cache_events> only for 'cache' callbacks and <batch_size>
+    only for 'item' and 'post' callbacks.  <buffer> is the CallBuffer of a
+    buffered 'post' callback, it outlives the plans so that calls are not
+    lost when the plan is rebuilt; so do <sampling>, the function that
+    tells whether a sampled callback runs for a call, and <debouncer>.
+    <group> is the name of the group the callback was put in.
+    <call_counter> counts the calls of a callback registered with
+    <max_calls>.
+    '''
+    __slots__ = ('label', 'function', 'priority', 'type',
+            'takes_target_args', 'takes_target_result', 'handles_exception',
+            'options')
+
+    # the names of the options kept in <options>
+    option_names = ('executor', 'target_params', 'when', 'predicate',
+            'exception_types', 'can_short_circuit', 'takes_short_circuited',
+            'cache_events', 'batch_size', 'buffer', 'sampling', 'debouncer',
+            'group', 'max_calls', 'call_counter')
+
+    def __init__(self, label, function, priority, type, takes_target_args,
+            takes_target_result=None, handles_exception=None, **options):
+        self.label = label
+        self.function = function
+        self.priority = priority
+        self.type = type
+        self.takes_target_args = takes_target_args
+        self.takes_target_result = takes_target_result
+        self.handles_exception = handles_exception
+        unknown = set(options).difference(self.option_names)
+        if unknown:
+            raise TypeError('Unknown CallbackRecord options %s' %
+                    sorted(unknown))
+        # None and False are what the properties read for missing options
+        options = dict((name, value) for name, value in options.items()
+                if value is not None and value is not False)
+        self.options = options or None
+
+    def __repr__(self):
+        return '<%s label=%r type=%r priority=%r>' % (
+                self.__class__.__name__, self.label, self.type, self.priority)
+
+def _option(name):
+    def get_option(record):
+        options = record.options
+        if options is None:
+            return None
+        return options.get(name)
+    return property(get_option)
+
+for _name in CallbackRecord.option_names:
+    setattr(CallbackRecord, _name, _option(_name))
+del _name
 
 class SupportsCallbacks(object):
     '''
@@ -13,20 +137,89 @@ class SupportsCallbacks(object):
     callbacks.  Callbacks can be registered to be run before or after the
     target function (or after the target function raises an exception).
     See the docstring for add_*_callback for more information.
+        If <post_executor> is given (a BackgroundDispatcher or a
+    concurrent.futures.Executor) post callbacks are run on it by default
+    instead of inline; see add_post_callback.
+        If <instrument> is True, call counts and timings of the target and of
+    every callback are recorded; see enable_instrumentation.
+        If <cache_size> is given, the target's results are cached, least
+    recently used results are evicted once there are more than <cache_size>
+    of them, and if <cache_ttl> is given, results older than <cache_ttl>
+    seconds are evicted too.  The callbacks still run on every call, cached
+    or not; add_cache_callback registers callbacks for cache hits, misses
+    and evictions.  For methods, <cache_scope> is 'instance' to give every
+    instance a cache of its own, or 'class' to share one between all
+    instances.  See cache.CachedTarget.
+        Instance-level registries share the settings of the class-level
+    registry.
     '''
-    def __init__(self, target, target_is_method=False):
-        self.id = uuid.uuid4()
+    # the types of CallbackRecord
+    _records_types = ('pre', 'post', 'exception', 'cache', 'item')
+    # wraps the target and callbacks to record their stats, see
+    # enable_instrumentation
+    _timed = staticmethod(timed)
+
+    def __init__(self, target, target_is_method=False, post_executor=None,
+            instrument=None, cache_size=None, cache_ttl=None,
+            cache_scope=INSTANCE):
+        self._id = None
 
         self.target = target
         self.__name__ = target.__name__
         if isinstance(target, SupportsCallbacks):
+            # an instance-level registry of a class-level registry
+            self._parent = target
             self._signature = target._signature
+            if post_executor is None:
+                post_executor = target.post_executor
         else:
+            self._parent = None
             self._signature = inspect.signature(target)
+        if post_executor is not None:
+            post_executor = as_dispatcher(post_executor)
+        self.post_executor = post_executor
+
+        # instance-level registries also follow the class-level registry,
+        # see instrumented
+        self._instrumented = bool(instrument)
+        # only the class-level registry times the target
+        self._target_stats = None
+        if self._parent is None:
+            self._target_stats = CallbackStats()
+        self._stats = {}
+
+        # only the class-level registry calls the target, so only it caches
+        self._cached_target = None
+        if cache_size is not None and self._parent is None:
+            self._cached_target = CachedTarget(self._signature,
+                    maxsize=cache_size, ttl=cache_ttl, scope=cache_scope)
+            self._cached_target.is_method = target_is_method
+        elif cache_ttl is not None:
+            raise ValueError('cache_ttl needs a cache_size.')
+
+        # writers hold this lock; calls read self._published_plan (and
+        # other readers self._records) without it, so both are replaced,
+        # never modified
+        self._lock = threading.RLock()
         self._target_is_method = target_is_method
-        self._update_docstring(target)
+        # the groups whose callbacks are left out of the plan
+        self._disabled_groups = frozenset()
+        if self._parent is None:
+            self._update_docstring(target)
+        else:
+            self.__doc__ = self._parent.__doc__
         self._initialize()
 
+    @property
+    def id(self):
+        '''
+            A process-unique integer identifying this registry, assigned the
+        first time it is asked for.
+        '''
+        if self._id is None:
+            self._id = next(_registry_ids)
+        return self._id
+
     @property
     def num_callbacks(self):
         """
@@ -39,7 +232,8 @@ class SupportsCallbacks(object):
             -or-
             (num_class_level_callbacks, num_instance_level_callbacks)
         """
-        num = len(list(self.callbacks.keys()))
+        self._purge_expired()
+        num = len(self._records)
         if (isinstance(self.target, self.__class__)):
             return (self.target.num_callbacks, num)
         else:
@@ -48,25 +242,42 @@ class SupportsCallbacks(object):
     def __get__(self, obj, obj_type=None):
         """
             To allow each instance of a class to have different callbacks
-        registered we store a callback registry on the instance itself.
-        Keying off of the id of the decorator allows us to have multiple
-        methods support callbacks on the same instance simultaneously.
+        registered, each instance gets its own callback registry.  The
+        registry is only created once a callback is registered on (or looked
+        up through) the instance, until then calls go straight to the
+        class-level callbacks.
         """
+        # when target was decorated, it had not been bound yet, but now it
+        # is, so update _target_is_method.
+        if not self._target_is_method:
+            self._mark_as_method()
+
         # method is being called on the class instead of an instance
         if obj is None:
-            # when target was decorated, it had not been bound yet, but now it
-            # is, so update _target_is_method.
-            self._target_is_method = True
             return self
 
-        if (obj not in self._callback_registries):
-            callback_registry = SupportsCallbacks(self,
-                    target_is_method=True)
-            self._callback_registries[obj] = proxy(callback_registry)
-        else:
-            callback_registry = self._callback_registries[obj]
+        return BoundSupportsCallbacks(self, obj)
 
-        return six.create_bound_method(callback_registry, obj)
+    def _mark_as_method(self):
+        with self._lock:
+            self._target_is_method = True
+            if self._cached_target is not None:
+                self._cached_target.is_method = True
+            self._rebuild_plan()
+
+    def _instance_registry(self, obj):
+        """
+            Returns the callback registry of <obj>, creating it if needed.
+        """
+        callback_registry = self._callback_registries.get(obj)
+        if callback_registry is None:
+            with self._lock:
+                callback_registry = self._callback_registries.get(obj)
+                if callback_registry is None:
+                    callback_registry = self.__class__(self,
+                            target_is_method=True)
+                    self._callback_registries[obj] = callback_registry
+        return callback_registry
 
     def _update_docstring(self, target):
         method_or_function = {True:'method',
@@ -100,30 +311,374 @@ This %s supports callbacks.
         self.__doc__ = docstring
 
     def _initialize(self):
-        # this will hold the registries for instance method callbacks
-        self._callback_registries = WeakKeyDictionary()
+        with self._lock:
+            # this will hold the registries for instance method callbacks,
+            # which have no instances of their own
+            self._callback_registries = None
+            if self._parent is None:
+                self._callback_registries = WeakKeyDictionary()
 
-        # these hold the order in which callbacks were added
-        self._pre_callbacks = defaultdict(list)
-        self._post_callbacks = defaultdict(list)
-        self._exception_callbacks = defaultdict(list)
-        # this holds the callback functions and how they should be called
-        self.callbacks = defaultdict(dict)
+            # this holds the CallbackRecord of every callback, keyed by label,
+            # in the order in which callbacks were added
+            self._records = {}
+            # records that reached their max_calls, see _expire
+            self._expired = []
+            self._rebuild_plan()
 
         # alias
         self.add_callback = self.add_post_callback
 
+    def _rebuild_plan(self):
+        '''
+            Throws the plans away, to be rebuilt by the next call.  Must be
+        called, with self._lock held, whenever the registry changes; a burst
+        of changes (adding or removing many callbacks) then pays for a single
+        rebuild.
+        '''
+        # the plans for every combination of disabled groups seen since the
+        # registry last changed, so that toggling a group back is a lookup
+        self._group_plans = {}
+        self._invalidate_plan()
+
+    def _invalidate_plan(self):
+        self._published_plan = _stale
+        # built when call_many first needs them
+        self._batch_plans = None
+
+    @property
+    def _plan(self):
+        '''
+            The DispatchPlan calls run (see _publish_plan), rebuilt first if
+        the registry changed since it was built.
+        '''
+        plan = self._published_plan
+        if plan is _stale:
+            plan = self._refresh_plan()
+        return plan
+
+    def _refresh_plan(self):
+        self._purge_expired()
+        with self._lock:
+            if self._published_plan is _stale:
+                self._publish_plan()
+            return self._published_plan
+
+    def _publish_plan(self):
+        '''
+            Flattens the registry into per-phase tuples that are already in
+        priority order, so that calling the target does not have to sort or
+        look anything up, and makes it the plan for the groups that are
+        currently disabled, unless that was built before.  Must be called
+        with self._lock held.  The new plan is complete before it is
+        published, so a call in progress keeps running the plan it started
+        with.
+        '''
+        built = self._group_plans.get(self._disabled_groups)
+        if built is None:
+            ordered = self._ordered_callbacks()
+            listeners = tuple(self._plan_entry(record)
+                    for record in ordered['cache'])
+            built = (self._build_plan(ordered), listeners)
+            self._group_plans[self._disabled_groups] = built
+        if self._cached_target is not None:
+            self._cached_target.listeners = built[1]
+        self._published_plan = built[0]
+
+    def _build_plan(self, ordered):
+        '''
+            Returns the DispatchPlan for <ordered> (see _ordered_callbacks),
+        or None if calls can go straight to the target.  If callbacks were
+        registered with a 'when' filter a FilteredDispatchPlan is returned,
+        which picks the DispatchPlan for each call.
+        '''
+        phases = dict((type, tuple(self._plan_items(record)
+                    for record in records))
+                for type, records in ordered.items())
+
+        # the class-level registry times and caches the target of instance
+        # methods
+        wrapped_target = None
+        if self._parent is None:
+            if self.instrumented:
+                wrapped_target = self._timed(self.target,
+                        self._target_stats)
+            if self._cached_target is not None:
+                wrapped_target = self._cached(wrapped_target or self.target)
+        if wrapped_target is not None:
+            plan_class = WrappedTargetDispatchPlan
+        else:
+            plan_class = DispatchPlan
+        build = partial(build_dispatch_plan, plan_class,
+                wrapped_target=wrapped_target,
+                batch_post=self._batches_post_callbacks())
+
+        names = []
+        for records in ordered.values():
+            for record in records:
+                if record.when is not None:
+                    names.extend(name for name in record.when
+                            if name not in names)
+        if names:
+            getters = parameter_getters(self._signature, names,
+                    skip_first=self._target_is_method)
+            return FilteredDispatchPlan(phases, tuple(zip(names, getters)),
+                    build, wrapped_target=wrapped_target)
+
+        plan = build(phases)
+        # while nothing is registered __call__ goes straight to the target
+        if (self.instrumented or wrapped_target is not None or plan.pre or
+                plan.post or plan.exception or plan.item):
+            return plan
+        else:
+            return None
+
+    def _batches_post_callbacks(self):
+        '''
+            Whether plans should group post callbacks by priority (see
+        DispatchPlan.post_batches).
+        '''
+        return False
+
+    def _cached(self, target):
+        '''
+            Returns <target> called through the result cache.
+        '''
+        return self._cached_target.wrap(target)
+
+    def _plan_items(self, record):
+        '''
+            Returns (plan entry, record, short-circuited plan entry) for
+        <record>, see build_dispatch_plan.
+        '''
+        entry = self._plan_entry(record)
+        if record.takes_short_circuited:
+            return (entry, record,
+                    self._plan_entry(record, short_circuited=True))
+        return (entry, record, entry)
+
+    def _plan_entry(self, record, short_circuited=False):
+        '''
+            Returns the tuple that stands for <record> in a DispatchPlan.  For
+        callbacks that take the short-circuited flag, <short_circuited> is
+        the value they are passed.
+        '''
+        function = record.function
+        stats = None
+        if self.instrumented:
+            stats = self._stats.get(record.label)
+            if stats is None:
+                stats = self._stats[record.label] = CallbackStats()
+        # a ProcessDispatcher pickles what it is handed, which has to be the
+        # callback itself, so for those the submission is timed instead
+        in_process = isinstance(record.executor, ProcessDispatcher)
+        if stats is not None and not in_process:
+            function = self._timed(function, stats)
+        if record.executor is not None:
+            function = dispatched(record.executor, function)
+        if stats is not None and in_process:
+            function = timed(function, stats)
+        if record.buffer is not None:
+            record.buffer.function = function
+            function = record.buffer.append
+        if record.debouncer is not None:
+            function = debounced(record.debouncer, function)
+        if record.takes_short_circuited:
+            function = with_inserted(function, (short_circuited,),
+                    position=int(bool(record.takes_target_result)))
+
+        if record.max_calls is not None:
+            function = limited(function, record.call_counter,
+                    record.max_calls, partial(self._expire, record),
+                    handles_exception=bool(record.handles_exception))
+        if record.sampling is not None:
+            # inside the predicate, so only the calls it lets through count
+            function = sampled(function, record.sampling,
+                    handles_exception=bool(record.handles_exception))
+
+        takes_target_args = record.takes_target_args
+        if record.target_params is not None:
+            if isinstance(record.target_params, dict):
+                keywords = tuple(record.target_params.keys())
+                names = list(record.target_params.values())
+            else:
+                keywords = None
+                names = record.target_params
+            # looked up here, like the 'when' filters, since the target may
+            # have turned out to be a method after the callback was added
+            getters = parameter_getters(self._signature, names,
+                    skip_first=self._target_is_method)
+            leading = int(bool(record.takes_target_result or
+                    record.handles_exception))
+            function = with_parameters(function, getters,
+                    keywords=keywords, leading=leading)
+            # the dispatch loop hands over the target's arguments, and
+            # with_parameters picks out the ones the callback wants
+            takes_target_args = True
+        if record.predicate is not None:
+            leading = int(bool(record.takes_target_result or
+                    record.handles_exception))
+            function = gated(function, record.predicate, leading=leading,
+                    takes_target_args=takes_target_args,
+                    handles_exception=bool(record.handles_exception))
+            takes_target_args = True
+
+        if record.type == 'cache':
+            return (function, record.cache_events)
+        elif record.type == 'item':
+            return (function, takes_target_args, record.batch_size)
+        elif record.type == 'pre':
+            return (function, takes_target_args,
+                    bool(record.can_short_circuit))
+        elif record.type == 'post':
+            return (function, takes_target_args, record.takes_target_result)
+        else:
+            return (function, takes_target_args, record.handles_exception)
+
+    def _ordered_callbacks(self, records=None):
+        '''
+            Returns {type: [CallbackRecord, ...]} in the order the callbacks
+        are run, for <records> or, by default, the callbacks that are not in
+        a disabled group.  The sort is stable, so ties in priority are broken
+        by the order in which the callbacks were added.
+        '''
+        if records is None:
+            records = self._enabled_records()
+        ordered = dict((type, []) for type in self._records_types)
+        for record in records.values():
+            ordered[record.type].append(record)
+        for records in ordered.values():
+            records.sort(key=_by_priority, reverse=True)
+        return ordered
+
+    def _enabled_records(self):
+        '''
+            Returns the records of the callbacks that are not in a disabled
+        group.
+        '''
+        disabled = self._disabled_groups
+        if not disabled:
+            return self._records
+        return dict((label, record) for label, record in self._records.items()
+                if record.group not in disabled)
+
+    @property
+    def callbacks(self):
+        '''
+            A read-only mapping of label -> CallbackRecord for every callback
+        registered to this function or method.
+        '''
+        self._purge_expired()
+        return MappingProxyType(self._records)
+
+    @property
+    def instrumented(self):
+        '''
+            Whether stats are recorded, see enable_instrumentation.  The
+        registry of an instance records them while the class-level registry
+        does, too.
+        '''
+        if self._instrumented:
+            return True
+        return self._parent is not None and self._parent._instrumented
+
+    def enable_instrumentation(self):
+        '''
+            Starts recording, for the target and for every callback, the
+        number of calls, the number of calls that raised, the total and
+        maximum wall-clock time and a latency histogram.  See callback_stats.
+        While instrumentation is disabled (the default) none of this costs
+        anything.  On the class-level registry of a method this covers the
+        registries of its instances too.
+        '''
+        with self._lock:
+            self._instrumented = True
+            self._rebuild_plan()
+        self._rebuild_instance_plans()
+
+    def disable_instrumentation(self):
+        '''
+            Stops recording stats; the stats recorded so far are kept.
+        '''
+        with self._lock:
+            self._instrumented = False
+            self._rebuild_plan()
+        self._rebuild_instance_plans()
+
+    def reset_stats(self):
+        '''
+            Throws away every recorded stat, including those of the
+        registries of instances.
+        '''
+        with self._lock:
+            if self._parent is None:
+                self._target_stats = CallbackStats()
+            self._stats = {}
+            self._rebuild_plan()
+        if self._callback_registries:
+            for registry in list(self._callback_registries.values()):
+                registry.reset_stats()
+
+    def _rebuild_instance_plans(self):
+        # the plans of instance-level registries depend on instrumented
+        if self._callback_registries:
+            for registry in list(self._callback_registries.values()):
+                with registry._lock:
+                    registry._rebuild_plan()
+
+    def callback_stats(self):
+        '''
+            Returns the stats recorded while instrumentation was enabled:
+            {'target': stats,
+             'callbacks': {label: stats, ...}}
+        where each stats is a dict with the keys 'calls', 'errors',
+        'total_time', 'max_time', 'mean_time' and 'histogram' (times are in
+        seconds).  Instance-level registries leave the timing of the target
+        to the class-level registry, so their 'target' is None.
+        '''
+        with self._lock:
+            callback_stats = list(self._stats.items())
+        if self._parent is None:
+            target_stats = self._target_stats.as_dict()
+        else:
+            target_stats = None
+        return {'target': target_stats,
+                'callbacks': dict((label, stats.as_dict())
+                    for label, stats in callback_stats)}
+
     @property
     def _callbacks_info(self):
+        self._purge_expired()
+        with self._lock:
+            records = self._records
+            callback_stats = dict(self._stats)
         format_string = '%38s  %9s  %6s  %10s  %11s  %14s'
+        headings = ('Label', 'priority', 'order', 'type', 'takes args',
+                'takes result')
+        if callback_stats:
+            format_string += '  %9s  %12s'
+            headings += ('calls', 'total time')
         lines = []
-        lines.append(format_string %
-                ('Label', 'priority', 'order', 'type', 'takes args', 'takes result'))
+        lines.append(format_string % headings)
+
+        orders = {}
+        for ordered in self._ordered_callbacks(records).values():
+            priority_counts = defaultdict(int)
+            for record in ordered:
+                orders[record.label] = priority_counts[record.priority]
+                priority_counts[record.priority] += 1
 
-        for label, info in sorted(self.callbacks.items()):
-            order = getattr(self, '_%s_callbacks' % info['type'])[info['priority']].index(label)
-            lines.append(format_string % (label, info['priority'], order,
-                    info['type'], info['takes_target_args'], info.get('takes_target_result', 'N/A')))
+        for label, record in sorted(records.items()):
+            order = orders[label]
+            if record.takes_target_result is None:
+                takes_target_result = 'N/A'
+            else:
+                takes_target_result = record.takes_target_result
+            columns = (label, record.priority, order, record.type,
+                    record.takes_target_args, takes_target_result)
+            if callback_stats:
+                stats = callback_stats.get(label, CallbackStats())
+                columns += (stats.calls, '%.6f' % stats.total_time)
+            lines.append(format_string % columns)
 
         return '\n'.join(lines)
 
@@ -137,7 +692,20 @@ This %s supports callbacks.
             priority=0,
             label=None,
             takes_target_args=False,
-            takes_target_result=False):
+            takes_target_result=False,
+            executor=None,
+            target_params=None,
+            when=None,
+            predicate=None,
+            takes_short_circuited=False,
+            batch_size=None,
+            batch_interval=None,
+            sample_every=None,
+            sample_rate=None,
+            max_per_second=None,
+            debounce=None,
+            group=None,
+            max_calls=None):
         '''
             Registers the callback to be called after the target is called.
         Inputs:
@@ -147,7 +715,8 @@ This %s supports callbacks.
                 ties are broken by the order in which callbacks were added.
             label: A name to call this callback, must be unique (and hashable)
                 or None, if non-unique a RuntimeError will be raised.
-                If None, a unique label will be automatically generated.
+                If None, a unique CallbackLabel will be automatically
+                generated.
                 NOTE: Callbacks can be removed using their label.
                       (see remove_callback)
             takes_target_args: If True, callback function will be passed the
@@ -156,21 +725,105 @@ This %s supports callbacks.
             takes_target_result: If True, callback will be passed, as
                 its first argument, the value returned from calling the
                 target function.
+            takes_short_circuited: If True, callback will be passed, after
+                the target's result (if it takes it), True if a pre callback
+                short-circuited the call (see add_pre_callback) and False if
+                the target was called.
+            executor: A BackgroundDispatcher or concurrent.futures.Executor.
+                If given, the callback is queued on it and the target
+                returns without waiting for the callback to run.  With a
+                ProcessDispatcher (or a ProcessPoolExecutor) the callback
+                runs in another process, and only what it is passed is
+                pickled.  If None, the post_executor of the target (if any)
+                is used.  If False, the callback is always run inline.
+            target_params: Instead of <takes_target_args>, the names of the
+                target's parameters the callback wants.  A list or tuple of
+                names passes their values positionally, in that order; a dict
+                {callback_keyword: parameter_name} passes them as keyword
+                arguments.  The names are resolved against the target's
+                signature once, when the callback is registered.
+            when: A dict {parameter_name: value} that limits the callback to
+                calls where the target's parameter has that value (or, for a
+                set, frozenset or list, one of its values).  The values must
+                be hashable; they are indexed so that calls only pay for the
+                callbacks that match.
+            predicate: A function that is passed the arguments and keyword
+                arguments of the target; the callback only runs for calls
+                where it returns True.
+            batch_size: If given, calls to the callback are buffered, and it
+                is passed a list of up to <batch_size> (args, kwargs)
+                records instead, the arguments it would have been called
+                with for each call (so only the target's result and
+                arguments if it takes them).  The batch is delivered once
+                it is full, after <batch_interval>, on flush_callbacks and
+                when the interpreter exits; with an <executor> it is
+                delivered there.  Exceptions raised by the callback are
+                logged, not raised to the caller.
+            batch_interval: Seconds after which a batch is delivered even if
+                it is not full.
+            sample_every: Only call the callback for the first of every
+                <sample_every> calls it would otherwise run for.
+            sample_rate: Only call the callback with this probability.
+            max_per_second: Call the callback at most this many times per
+                second, from a token bucket that allows bursts of that many
+                calls.
+            debounce: Seconds.  Calls to the callback are held back until
+                there have been none for this long, and then only the last
+                one is made, on a timer thread.
+            group: The name of a group to put the callback in, so that the
+                callbacks of the group can be disabled, enabled and removed
+                together (see disable_group).
+            max_calls: If given, the callback is unregistered once it has
+                been called this many times (1 for a one-shot callback).
+                Calls are counted after the predicate and sampling options
+                have let them through.
+            The sampling options can be combined; a call is skipped if any of
+        them skips it.  Their state is kept with the callback, so registering
+        other callbacks does not reset it.
         Returns:
             label
         '''
-        priority, label = self._add_callback(callback=callback,
+        buffer = None
+        if batch_size is not None:
+            if asyncio.iscoroutinefunction(callback):
+                raise TypeError('Buffered callbacks cannot be coroutine '
+                        'functions.')
+            buffer = CallBuffer(None, batch_size, batch_interval)
+        elif batch_interval is not None:
+            raise ValueError('batch_interval needs a batch_size.')
+        if executor is None:
+            executor = self.post_executor
+        elif executor is False:
+            executor = None
+        else:
+            executor = as_dispatcher(executor)
+        return self._add_callback(callback=callback,
                 priority=priority, label=label,
-                takes_target_args=takes_target_args, type='post')
-        self._post_callbacks[priority].append(label)
-        self.callbacks[label]['takes_target_result'] = takes_target_result
-        return label
+                takes_target_args=takes_target_args, type='post',
+                takes_target_result=takes_target_result, executor=executor,
+                target_params=target_params, when=when, predicate=predicate,
+                takes_short_circuited=takes_short_circuited,
+                batch_size=batch_size, buffer=buffer,
+                sample_every=sample_every, sample_rate=sample_rate,
+                max_per_second=max_per_second, debounce=debounce,
+                group=group, max_calls=max_calls)
 
     def add_exception_callback(self, callback,
             priority=0,
             label=None,
             takes_target_args=False,
-            handles_exception=False):
+            handles_exception=False,
+            target_params=None,
+            when=None,
+            predicate=None,
+            exception_types=None,
+            executor=None,
+            sample_every=None,
+            sample_rate=None,
+            max_per_second=None,
+            debounce=None,
+            group=None,
+            max_calls=None):
         '''
             Registers the callback to be called after the target raises an
         exception.  Exception callbacks are called in priority order and can
@@ -182,7 +835,8 @@ This %s supports callbacks.
                 ties are broken by the order in which callbacks were added.
             label: A name to call this callback, must be unique (and hashable)
                 or None, if non-unique a RuntimeError will be raised.
-                If None, a unique label will be automatically generated.
+                If None, a unique CallbackLabel will be automatically
+                generated.
                 NOTE: Callbacks can be removed using their label.
                       (see remove_callback)
             takes_target_args: If True, callback function will be passed the
@@ -195,22 +849,89 @@ This %s supports callbacks.
                 handling the exception or reraising it!  NOTE: If True and
                 the exception has already been handled, this callback will
                 not be called.
+            target_params: Instead of <takes_target_args>, the names of the
+                target's parameters the callback wants.  A list or tuple of
+                names passes their values positionally, in that order; a dict
+                {callback_keyword: parameter_name} passes them as keyword
+                arguments.  The names are resolved against the target's
+                signature once, when the callback is registered.
+            when: A dict {parameter_name: value} that limits the callback to
+                calls where the target's parameter has that value (or, for a
+                set, frozenset or list, one of its values).  The values must
+                be hashable; they are indexed so that calls only pay for the
+                callbacks that match.
+            predicate: A function that is passed the arguments and keyword
+                arguments of the target; the callback only runs for calls
+                where it returns True.
+            exception_types: An exception class or a tuple of them.  If given,
+                the callback is only called while the exception being
+                dispatched (the target's, or the one raised by a higher
+                priority handler) is an instance of one of them, so handlers
+                do not have to re-raise exceptions they do not care about.
+                Which callbacks apply to an exception type is cached.
+            executor: A BackgroundDispatcher or concurrent.futures.Executor
+                to queue the callback on, see add_post_callback.  Callbacks
+                that handle the exception cannot run in the background, and
+                the target's post_executor is not used for exception
+                callbacks.
+            sample_every: Only call the callback for the first of every
+                <sample_every> calls it would otherwise run for.
+            sample_rate: Only call the callback with this probability.
+            max_per_second: Call the callback at most this many times per
+                second, from a token bucket that allows bursts of that many
+                calls.
+            debounce: Seconds.  Calls to the callback are held back until
+                there have been none for this long, and then only the last
+                one is made, on a timer thread.  Handlers cannot be
+                debounced.
+            group: The name of a group to put the callback in, so that the
+                callbacks of the group can be disabled, enabled and removed
+                together (see disable_group).
+            max_calls: If given, the callback is unregistered once it has
+                been called this many times (1 for a one-shot callback).
+                Calls are counted after the predicate and sampling options
+                have let them through.
+            The sampling options can be combined; a call is skipped if any of
+        them skips it.  Their state is kept with the callback, so registering
+        other callbacks does not reset it.  A handler the sampling options
+        skip re-raises the exception.
         Returns:
             label
         '''
-        priority, label = self._add_callback(callback=callback,
+        if executor is not None:
+            if handles_exception:
+                raise ValueError('Callbacks that handle exceptions cannot '
+                        'run on an executor.')
+            executor = as_dispatcher(executor)
+        return self._add_callback(callback=callback,
                 priority=priority, label=label,
-                takes_target_args=takes_target_args, type='exception')
-        self._exception_callbacks[priority].append(label)
-        self.callbacks[label]['handles_exception'] = handles_exception
-        return label
+                takes_target_args=takes_target_args, type='exception',
+                handles_exception=handles_exception, executor=executor,
+                target_params=target_params, when=when, predicate=predicate,
+                exception_types=_exception_types(exception_types),
+                sample_every=sample_every, sample_rate=sample_rate,
+                max_per_second=max_per_second, debounce=debounce,
+                group=group, max_calls=max_calls)
 
     def add_pre_callback(self, callback,
             priority=0,
             label=None,
-            takes_target_args=False):
+            takes_target_args=False,
+            target_params=None,
+            when=None,
+            predicate=None,
+            can_short_circuit=False,
+            sample_every=None,
+            sample_rate=None,
+            max_per_second=None,
+            debounce=None,
+            group=None,
+            max_calls=None):
         '''
-        Registers the callback to be called before the target.
+        Registers the callback to be called before the target.  A pre
+        callback that raises an exception rejects the call: the exception
+        propagates to the caller and neither the target nor any other
+        callback is run.
         Inputs:
             callback: The callback function that will be called before
                 the target function is run.
@@ -218,40 +939,202 @@ This %s supports callbacks.
                 ties are broken by the order in which callbacks were added.
             label: A name to call this callback, must be unique (and hashable)
                 or None, if non-unique a RuntimeError will be raised.
-                If None, a unique label will be automatically generated.
+                If None, a unique CallbackLabel will be automatically
+                generated.
                 NOTE: Callbacks can be removed using their label.
                       (see remove_callback)
             takes_target_args: If True, callback function will be passed the
                 arguments and keyword arguments that are supplied to the
                 target function.
+            target_params: Instead of <takes_target_args>, the names of the
+                target's parameters the callback wants.  A list or tuple of
+                names passes their values positionally, in that order; a dict
+                {callback_keyword: parameter_name} passes them as keyword
+                arguments.  The names are resolved against the target's
+                signature once, when the callback is registered.
+            when: A dict {parameter_name: value} that limits the callback to
+                calls where the target's parameter has that value (or, for a
+                set, frozenset or list, one of its values).  The values must
+                be hashable; they are indexed so that calls only pay for the
+                callbacks that match.
+            predicate: A function that is passed the arguments and keyword
+                arguments of the target; the callback only runs for calls
+                where it returns True.
+            can_short_circuit: If True and the callback returns a
+                ShortCircuit(result), the remaining pre callbacks and the
+                target are skipped and the call returns <result>.  The post
+                callbacks are still run, with <result> as the target's
+                result.  Any other return value is ignored, as it is for
+                every other pre callback.
+            sample_every: Only call the callback for the first of every
+                <sample_every> calls it would otherwise run for.
+            sample_rate: Only call the callback with this probability.
+            max_per_second: Call the callback at most this many times per
+                second, from a token bucket that allows bursts of that many
+                calls.
+            debounce: Seconds.  Calls to the callback are held back until
+                there have been none for this long, and then only the last
+                one is made, on a timer thread.  Callbacks that can
+                short-circuit cannot be debounced.
+            group: The name of a group to put the callback in, so that the
+                callbacks of the group can be disabled, enabled and removed
+                together (see disable_group).
+            max_calls: If given, the callback is unregistered once it has
+                been called this many times (1 for a one-shot callback).
+                Calls are counted after the predicate and sampling options
+                have let them through.
+            The sampling options can be combined; a call is skipped if any of
+        them skips it.  Their state is kept with the callback, so registering
+        other callbacks does not reset it.
         Returns:
             label
         '''
-        priority, label = self._add_callback(callback=callback,
+        return self._add_callback(callback=callback,
                 priority=priority, label=label,
-                takes_target_args=takes_target_args, type='pre')
-        self._pre_callbacks[priority].append(label)
-        return label
+                takes_target_args=takes_target_args, type='pre',
+                can_short_circuit=can_short_circuit,
+                target_params=target_params, when=when, predicate=predicate,
+                sample_every=sample_every, sample_rate=sample_rate,
+                max_per_second=max_per_second, debounce=debounce,
+                group=group, max_calls=max_calls)
+
+    def add_cache_callback(self, callback,
+            events=CACHE_EVENTS,
+            priority=0,
+            label=None,
+            group=None,
+            max_calls=None):
+        '''
+            Registers the callback to be called on result cache events.  It is
+        passed the event ('hit', 'miss' or 'evict') and the cache key of the
+        call (see cache.CachedTarget.key); for 'evict' that is the key of the
+        result that was evicted.  Cache callbacks can only be registered on
+        a function or class-level method that was decorated with a
+        cache_size.
+        Inputs:
+            callback: The callback function.
+            events: The events the callback is called for.
+            priority: Number. Higher priority callbacks are run first,
+                ties are broken by the order in which callbacks were added.
+            label: A name to call this callback, must be unique (and hashable)
+                or None, if non-unique a RuntimeError will be raised.
+                If None, a unique CallbackLabel will be automatically
+                generated.
+            group: The name of a group to put the callback in, so that the
+                callbacks of the group can be disabled, enabled and removed
+                together (see disable_group).
+            max_calls: If given, the callback is unregistered once it has
+                been called this many times (1 for a one-shot callback).
+        Returns:
+            label
+        '''
+        if self._parent is not None:
+            raise RuntimeError('Cache callbacks are registered on the '
+                    'class-level method, not on an instance.')
+        if self._cached_target is None:
+            raise RuntimeError('Function "%s" does not cache its results, '
+                    'decorate it with a cache_size.' % self.target.__name__)
+        if isinstance(events, str):
+            events = (events,)
+        events = frozenset(events)
+        unknown = events.difference(CACHE_EVENTS)
+        if unknown:
+            raise ValueError('Unknown cache events %s, the events are %s' %
+                    (sorted(unknown), ', '.join(CACHE_EVENTS)))
+        return self._add_callback(callback=callback,
+                priority=priority, label=label,
+                takes_target_args=False, type='cache', cache_events=events,
+                group=group, max_calls=max_calls)
+
+    def cache_info(self):
+        '''
+            Returns {'hits':, 'misses':, 'evictions':, 'size':} summed over
+        the target's result caches (one per instance for the 'instance'
+        scope), along with the cache settings.  Returns None if the target
+        does not cache its results.
+        '''
+        if self._parent is not None:
+            return self._parent.cache_info()
+        if self._cached_target is None:
+            return None
+        return self._cached_target.info()
 
-    def _add_callback(self, callback, priority, label, takes_target_args, type):
+    def clear_cache(self):
+        '''
+            Throws away every cached result and resets the counts of
+        cache_info.
+        '''
+        if self._parent is not None:
+            return self._parent.clear_cache()
+        if self._cached_target is not None:
+            self._cached_target.clear()
+
+    def _add_callback(self, callback, priority, label, takes_target_args, type,
+            target_params=None, when=None, sample_every=None,
+            sample_rate=None, max_per_second=None, debounce=None,
+            max_calls=None, **settings):
         try:
             priority = float(priority)
         except:
             raise ValueError('Priority could not be cast into a float.')
 
-        if label is None:
-            label = uuid.uuid4()
+        call_counter = None
+        if max_calls is not None:
+            if max_calls < 1:
+                raise ValueError('max_calls must be at least 1.')
+            call_counter = itertools.count()
 
-        if label in list(self.callbacks.keys()):
-            raise RuntimeError('Callback with label="%s" already registered.'
-                    % label)
+        sampling = sampling_policy(sample_every, sample_rate, max_per_second)
+        debouncer = None
+        if debounce is not None:
+            if settings.get('handles_exception') or settings.get(
+                    'can_short_circuit'):
+                raise ValueError('Callbacks that handle exceptions or can '
+                        'short-circuit cannot be debounced.')
+            if asyncio.iscoroutinefunction(callback):
+                raise TypeError('Debounced callbacks cannot be coroutine '
+                        'functions.')
+            debouncer = Debouncer(debounce)
 
-        self.callbacks[label]['function'] = callback
-        self.callbacks[label]['priority'] = priority
-        self.callbacks[label]['takes_target_args'] = takes_target_args
-        self.callbacks[label]['type'] = type
+        if target_params is not None:
+            if takes_target_args:
+                raise ValueError('Use either takes_target_args or '
+                        'target_params, not both.')
+            if isinstance(target_params, dict):
+                target_params = dict(target_params)
+                names = list(target_params.values())
+            else:
+                target_params = names = tuple(target_params)
+            # only to check the names, the plan looks the values up
+            parameter_getters(self._signature, names,
+                    skip_first=self._target_is_method)
+        if when is not None:
+            when = dict((name, filter_values(value))
+                    for name, value in when.items())
+            # only to check the names, the plan looks the values up
+            parameter_getters(self._signature, list(when),
+                    skip_first=self._target_is_method)
 
-        return priority, label
+        if label is None:
+            label = CallbackLabel()
+
+        record = CallbackRecord(label=label, function=callback,
+                priority=priority, type=type,
+                takes_target_args=takes_target_args,
+                target_params=target_params, when=when, sampling=sampling,
+                debouncer=debouncer, max_calls=max_calls,
+                call_counter=call_counter, **settings)
+        self._purge_expired()
+        with self._lock:
+            if label in self._records:
+                raise RuntimeError(
+                        'Callback with label="%s" already registered.' % label)
+            records = self._records.copy()
+            records[label] = record
+            self._records = records
+            self._rebuild_plan()
+
+        return label
 
     def remove_callback(self, label):
         '''
@@ -264,18 +1147,50 @@ This %s supports callbacks.
         Returns:
             None
         '''
-        if label not in list(self.callbacks.keys()):
-            raise RuntimeError(
-                    'No callback with label "%s" attached to function "%s"' %
-                    (label, self.target.__name__))
+        self._purge_expired()
+        with self._lock:
+            if label not in self._records:
+                raise RuntimeError(
+                        'No callback with label "%s" attached to function "%s"'
+                        % (label, self.target.__name__))
+            records = self._records.copy()
+            removed = records.pop(label)
+            self._records = records
+            self._stats.pop(label, None)
+            self._rebuild_plan()
+        _flush_buffers([removed])
 
-        for index in [self._pre_callbacks, self._post_callbacks,
-                self._exception_callbacks]:
-            for priority in index.keys():
-                if label in index[priority]:
-                    index[priority].remove(label)
+    def _expire(self, record):
+        '''
+            Called, in the middle of a call, once the callback of <record>
+        has been called max_calls times.  The callback skips every later
+        call by itself, so this only queues it to be unregistered by the next
+        change to the registry, or by the next call, which rebuilds the plan
+        anyway; the call that got here does not pay for either.
+        '''
+        self._expired.append(record)
+        self._invalidate_plan()
 
-        del self.callbacks[label]
+    def _purge_expired(self):
+        '''
+            Unregisters the callbacks queued by _expire.
+        '''
+        if not self._expired:
+            return
+        removed = []
+        with self._lock:
+            records = self._records.copy()
+            while self._expired:
+                record = self._expired.pop()
+                # unless it was removed in the meantime
+                if records.get(record.label) is record:
+                    del records[record.label]
+                    self._stats.pop(record.label, None)
+                    removed.append(record)
+            if removed:
+                self._records = records
+                self._rebuild_plan()
+        _flush_buffers(removed)
 
     def remove_callbacks(self, labels=None):
         '''
@@ -286,99 +1201,1227 @@ This %s supports callbacks.
         Returns:
             None
         '''
+        self._purge_expired()
         if labels is not None:
             bad_labels = []
-            for label in labels:
-                try:
-                    self.remove_callback(label)
-                except RuntimeError:
-                    bad_labels.append(label)
-                    continue
+            removed = []
+            with self._lock:
+                records = self._records.copy()
+                for label in labels:
+                    record = records.pop(label, None)
+                    if record is None:
+                        bad_labels.append(label)
+                    else:
+                        removed.append(record)
+                    self._stats.pop(label, None)
+                self._records = records
+                self._rebuild_plan()
+            _flush_buffers(removed)
             if bad_labels:
                 raise RuntimeError(
                     'No callbacks with labels %s attached to function %s' %
                     (bad_labels, self.target.__name__))
         else:
-            self._initialize()
+            with self._lock:
+                removed = list(self._records.values())
+                self._stats = {}
+                self._initialize()
+            _flush_buffers(removed)
+
+    def disable_group(self, group):
+        '''
+            Stops calling the callbacks in <group> (see the <group> argument
+        of the add_*_callback methods) without unregistering them.  Callbacks
+        that are added to a disabled group start out disabled.  Once the
+        plan for a combination of disabled groups has been built, switching
+        back to it costs no more than a lookup, until callbacks are added or
+        removed.
+        '''
+        with self._lock:
+            self._disabled_groups = self._disabled_groups.union([group])
+            self._invalidate_plan()
+
+    def enable_group(self, group):
+        '''
+            Calls the callbacks in <group> again, see disable_group.
+        '''
+        with self._lock:
+            self._disabled_groups = self._disabled_groups.difference([group])
+            self._invalidate_plan()
+
+    @property
+    def disabled_groups(self):
+        '''
+            The frozenset of the names of the disabled groups.
+        '''
+        return self._disabled_groups
+
+    def remove_group(self, group):
+        '''
+            Unregisters every callback in <group>, enabled or not.
+        Returns:
+            The list of the labels of the callbacks that were removed.
+        '''
+        self._purge_expired()
+        with self._lock:
+            records = self._records.copy()
+            removed = [records.pop(label) for label, record
+                    in self._records.items() if record.group == group]
+            if removed:
+                for record in removed:
+                    self._stats.pop(record.label, None)
+                self._records = records
+                self._rebuild_plan()
+        _flush_buffers(removed)
+        return [record.label for record in removed]
+
+    def call_many(self, arguments, batch_callbacks=False):
+        '''
+            Calls the target once for every tuple of positional arguments in
+        <arguments> (for a method called on the class, the instance is the
+        first one).
+        Inputs:
+            arguments: An iterable of argument tuples.
+            batch_callbacks: If True, pre and post callbacks are called once
+                for the whole batch instead of once per call, as if the
+                target took the list of argument tuples and returned the
+                list of results: callbacks that take the target's arguments
+                are passed the list of argument tuples, and post callbacks
+                that take the target's result the list of results.  Exception
+                callbacks, and callbacks that look at the arguments of
+                individual calls (registered with when, predicate or
+                target_params), are still called for every call.
+        Returns:
+            The list of results.
+        '''
+        calls = [tuple(args) for args in arguments]
+        if not batch_callbacks:
+            return [self(*args) for args in calls]
+
+        if self._parent is not None:
+            registries = (self, self._parent)
+        else:
+            registries = (self,)
+        if self._target_is_method:
+            cb_calls = [args[1:] for args in calls]
+        else:
+            cb_calls = calls
+        return run_batch([registry._get_batch_plans()
+                    for registry in registries],
+                registries[-1].target, calls, cb_calls)
+
+    def map(self, *iterables, batch_callbacks=False):
+        '''
+            Like the builtin map, but returns the list of results; see
+        call_many.
+        '''
+        return self.call_many(zip(*iterables),
+                batch_callbacks=batch_callbacks)
+
+    def _get_batch_plans(self):
+        '''
+            Returns (batch plan, per-call plan) for call_many: the first
+        holds the pre and post callbacks that are called once per batch, the
+        second every other callback.  Either may be None.
+        '''
+        plans = self._batch_plans
+        if plans is None:
+            self._purge_expired()
+            with self._lock:
+                plans = self._batch_plans
+                if plans is None:
+                    ordered = self._ordered_callbacks()
+                    batched = dict((type, []) for type in ordered)
+                    per_call = dict((type, []) for type in ordered)
+                    for type, records in ordered.items():
+                        for record in records:
+                            if _batchable(record):
+                                batched[type].append(record)
+                            else:
+                                per_call[type].append(record)
+                    plans = self._batch_plans = (self._build_plan(batched),
+                            self._build_plan(per_call))
+        return plans
+
+    def flush_callbacks(self, timeout=None):
+        '''
+            Delivers the calls buffered for callbacks registered with a
+        batch_size, and waits until every callback of this function or
+        method that was queued on an executor has run.
+        Inputs:
+            timeout: Seconds to wait for each executor, or None to wait for
+                as long as it takes.
+        Returns:
+            True if everything was run, False if <timeout> expired first.
+        '''
+        self._purge_expired()
+        records = list(self._records.values())
+        _flush_buffers(records)
+        dispatchers = set(record.executor for record in records
+                if record.executor is not None)
+        flushed = True
+        for dispatcher in dispatchers:
+            flushed = dispatcher.flush(timeout) and flushed
+        return flushed
 
     def __call__(self, *args, **kwargs):
-        #print 'self', self, self.target
+        plan = self._published_plan
+        if plan is _stale:
+            plan = self._refresh_plan()
+        if self._parent is not None:
+            return self._call_instance_method(plan, args, kwargs)
+        if plan is None:
+            return self.target(*args, **kwargs)
+
         if self._target_is_method:
             cb_args = args[1:] # skip over 'self' arg
         else:
             cb_args = args
+        return plan.run(self.target, args, kwargs, cb_args)
+
+    def _call_instance_method(self, plan, args, kwargs):
+        """
+            Runs the instance-level and the class-level callbacks in a single
+        pass.  The order is the same as if the class-level registry were
+        called as the target of the instance-level one:
+
+            INSTANCE_level_PRE_callbacks
+            try:
+                CLASS_level_PRE_callbacks
+                try:
+                    original_target
+                except:
+                    CLASS_level_EXCEPTION_callbacks
+                CLASS_level_POST_callbacks
+            except:
+                INSTANCE_level_EXCEPTION_callbacks
+            INSTANCE_level_POST_callbacks
+        """
+        parent = self._parent
+        parent_plan = parent._published_plan
+        if parent_plan is _stale:
+            parent_plan = parent._refresh_plan()
+        if plan is None:
+            if parent_plan is None:
+                return parent.target(*args, **kwargs)
+            return parent_plan.run(parent.target, args, kwargs, args[1:])
+        if parent_plan is None:
+            return plan.run(parent.target, args, kwargs, args[1:])
+        return run_nested_plans((plan, parent_plan), parent.target,
+                args, kwargs, args[1:])
+
+class DispatchPlan(object):
+    '''
+        The callbacks of one registry flattened into per-phase tuples that are
+    already in the order they are run.  Plans are never modified; the
+    registry builds a new one whenever a callback is added or removed.
+        pre:       ((callback, takes_target_args, can_short_circuit), ...)
+        post:      ((callback, takes_target_args, takes_target_result), ...)
+        exception: ((callback, takes_target_args, handles_exception), ...)
+        item:      ((callback, takes_target_args, batch_size), ...)
+    '''
+    __slots__ = ('pre', 'post', 'exception', 'item', 'post_batches',
+            'wrapped_target', 'exception_index', 'short_circuited')
+
+    def __init__(self, pre=(), post=(), exception=(), item=(),
+            post_batches=None):
+        self.pre = pre
+        self.post = post
+        self.exception = exception
+        # only generator targets have item callbacks
+        self.item = item
+        # post callbacks grouped by priority, only set when they may be
+        # awaited concurrently (see AsyncSupportsCallbacks)
+        self.post_batches = post_batches
+        # the target wrapped to record its timing and/or to cache its
+        # results, only set by registries that do either
+        self.wrapped_target = None
+        # set when some exception callbacks are limited to exception types
+        self.exception_index = None
+        # the plan whose post callbacks are run after a pre callback
+        # short-circuited the call, None if that is this plan
+        self.short_circuited = None
+
+    def select(self, args, kwargs):
+        '''
+            Returns the plan to run for a call with (args, kwargs), which is
+        this plan (see FilteredDispatchPlan).
+        '''
+        return self
 
-        self._call_pre_callbacks(*cb_args, **kwargs)
+    def run(self, target, args, kwargs, cb_args):
+        short_circuit = self.call_pre(cb_args, kwargs)
+        if short_circuit is not None:
+            return self.finish_short_circuit(short_circuit, cb_args, kwargs)
         try:
-            target_result = self.target(*args, **kwargs)
+            target_result = target(*args, **kwargs)
         except Exception as e:
-            target_result = self._call_exception_callbacks(e, *cb_args, **kwargs)
-        self._call_post_callbacks(target_result, *cb_args, **kwargs)
+            target_result = self.call_exception(e, cb_args, kwargs)
+        self.call_post(target_result, cb_args, kwargs)
         return target_result
 
-    def _call_pre_callbacks(self, *args, **kwargs):
-        for priority in sorted(list(self._pre_callbacks.keys()), reverse=True):
-            for label in self._pre_callbacks[priority]:
-                callback = self.callbacks[label]['function']
-                takes_target_args = self.callbacks[label]['takes_target_args']
-                if takes_target_args:
-                    callback(*args, **kwargs)
-                else:
-                    callback()
+    def call_pre(self, args, kwargs):
+        '''
+            Returns the ShortCircuit a pre callback returned to skip the
+        target, or None.
+        '''
+        for callback, takes_target_args, can_short_circuit in self.pre:
+            if takes_target_args:
+                result = callback(*args, **kwargs)
+            else:
+                result = callback()
+            if can_short_circuit and isinstance(result, ShortCircuit):
+                return result
+        return None
+
+    def finish_short_circuit(self, short_circuit, args, kwargs):
+        '''
+            Runs the post callbacks of a call that was short-circuited.
+        '''
+        (self.short_circuited or self).call_post(short_circuit.result,
+                args, kwargs)
+        return short_circuit.result
 
-    def _call_exception_callbacks(self, exception, *args, **kwargs):
-        #import pdb; pdb.set_trace()
+    def call_exception(self, exception, args, kwargs):
+        if self.exception_index is not None:
+            return self.call_typed_exception(exception, args, kwargs)
         result = None
-        for priority in sorted(list(self._exception_callbacks.keys()), reverse=True):
-            for label in self._exception_callbacks[priority]:
-                callback = self.callbacks[label]['function']
-                takes_target_args = self.callbacks[label]['takes_target_args']
-                handles_exception = self.callbacks[label]['handles_exception']
-
-                if handles_exception and exception is None:
-                    # exception has already been handled, only call callbacks
-                    # that don't handle exceptions
+        for callback, takes_target_args, handles_exception in self.exception:
+            if handles_exception and exception is None:
+                # exception has already been handled, only call callbacks
+                # that don't handle exceptions
+                continue
+
+            if takes_target_args and handles_exception:
+                try:
+                    result = callback(exception, *args, **kwargs)
+                    exception = None
+                except Exception as e:
+                    exception = e
+                    continue
+            elif handles_exception:
+                try:
+                    result = callback(exception)
+                    exception = None
+                except Exception as e:
+                    exception = e
                     continue
+            elif takes_target_args:
+                callback(*args, **kwargs)
+            else:
+                callback()
+        if exception is not None:
+            raise exception
+        else:
+            return result
 
-                if takes_target_args and handles_exception:
-                    try:
+    def call_typed_exception(self, exception, args, kwargs):
+        '''
+            call_exception for plans with an exception_index: only the
+        callbacks that apply to the type of the exception being dispatched
+        are visited.  When a handler handles the exception or raises a
+        different one, the rest of the callbacks are looked up again.
+        '''
+        index = self.exception_index
+        result = None
+        exception_type = type(exception)
+        positions, entries = index.lookup(exception_type)
+        next_entry = 0
+        while next_entry < len(entries):
+            callback, takes_target_args, handles_exception = \
+                    entries[next_entry]
+            position = positions[next_entry]
+            next_entry += 1
+            if handles_exception:
+                if exception is None:
+                    continue
+                try:
+                    if takes_target_args:
                         result = callback(exception, *args, **kwargs)
-                        exception = None
-                    except Exception as e:
-                        exception = e
-                        continue
-                elif handles_exception:
-                    try:
+                    else:
                         result = callback(exception)
-                        exception = None
-                    except Exception as e:
-                        exception = e
-                        continue
-                elif takes_target_args:
-                    callback(*args, **kwargs)
-                else:
-                    callback()
+                    exception = None
+                except Exception as e:
+                    exception = e
+                if type(exception) is not exception_type:
+                    exception_type = type(exception)
+                    positions, entries = index.lookup(exception_type)
+                    next_entry = bisect_right(positions, position)
+            elif takes_target_args:
+                callback(*args, **kwargs)
+            else:
+                callback()
         if exception is not None:
             raise exception
         else:
             return result
 
-    def _call_post_callbacks(self, target_result, *args, **kwargs):
-        for priority in sorted(list(self._post_callbacks.keys()), reverse=True):
-            for label in self._post_callbacks[priority]:
-                callback = self.callbacks[label]['function']
-                takes_target_args = self.callbacks[label]['takes_target_args']
-                takes_target_result = self.callbacks[label]['takes_target_result']
-                if takes_target_args and takes_target_result:
-                    callback(target_result, *args, **kwargs)
-                elif takes_target_result:
-                    callback(target_result)
-                elif takes_target_args:
-                    callback(*args, **kwargs)
+    def call_post(self, target_result, args, kwargs):
+        for callback, takes_target_args, takes_target_result in self.post:
+            if takes_target_args and takes_target_result:
+                callback(target_result, *args, **kwargs)
+            elif takes_target_result:
+                callback(target_result)
+            elif takes_target_args:
+                callback(*args, **kwargs)
+            else:
+                callback()
+
+class WrappedTargetDispatchPlan(DispatchPlan):
+    '''
+        The DispatchPlan of a registry that times or caches its target, it
+    runs the wrapped target instead of the target it is given.
+    '''
+    __slots__ = ()
+
+    def run(self, target, args, kwargs, cb_args):
+        if self.wrapped_target is not None:
+            target = self.wrapped_target
+        return DispatchPlan.run(self, target, args, kwargs, cb_args)
+
+def build_dispatch_plan(plan_class, phases, wrapped_target=None,
+        batch_post=False):
+    '''
+        Returns a <plan_class> for <phases>, which is
+    {type: ((plan entry, CallbackRecord, short-circuited entry), ...)} in the
+    order the callbacks are run.  The short-circuited entries are run
+    instead of the plan entries after a pre callback short-circuited the
+    call; they only differ for callbacks that take the short-circuited flag.
+    If <batch_post> is True, post_batches groups the post callbacks by
+    priority.
+    '''
+    plan = plan_class(
+            pre=tuple(item[0] for item in phases['pre']),
+            post=tuple(item[0] for item in phases['post']),
+            exception=tuple(item[0] for item in phases['exception']),
+            item=tuple(item[0] for item in phases['item']))
+    plan.wrapped_target = wrapped_target
+    if any(item[1].exception_types is not None
+            for item in phases['exception']):
+        plan.exception_index = ExceptionIndex(plan.exception,
+                tuple(item[1].exception_types
+                    for item in phases['exception']))
+    if batch_post:
+        plan.post_batches = _batched_by_priority(phases['post'], 0)
+    if any(item[2] is not item[0] for item in phases['post']):
+        short_circuited = plan_class(
+                post=tuple(item[2] for item in phases['post']))
+        if batch_post:
+            short_circuited.post_batches = _batched_by_priority(
+                    phases['post'], 2)
+        plan.short_circuited = short_circuited
+    return plan
+
+def _batched_by_priority(items, index):
+    batches = []
+    last_priority = None
+    for item in items:
+        if batches and item[1].priority == last_priority:
+            batches[-1].append(item[index])
+        else:
+            batches.append([item[index]])
+        last_priority = item[1].priority
+    return tuple(tuple(batch) for batch in batches)
+
+def run_nested_plans(plans, target, args, kwargs, cb_args):
+    '''
+        Runs <plans> (outermost first) around <target> as if each plan's
+    registry were the target of the one before it.  An exception escaping a
+    plan's pre callbacks, target or post callbacks is passed to the exception
+    callbacks of the plans outside of it.
+    '''
+    if plans[-1].wrapped_target is not None:
+        target = plans[-1].wrapped_target
+    plans = [plan.select(cb_args, kwargs) for plan in plans]
+    error = None
+    short_circuit = None
+    entered = 0
+    for plan in plans:
+        try:
+            short_circuit = plan.call_pre(cb_args, kwargs)
+        except Exception as e:
+            error = e
+            break
+        entered += 1
+        if short_circuit is not None:
+            # the plans inside this one and the target are skipped
+            target_result = short_circuit.result
+            break
+    else:
+        try:
+            target_result = target(*args, **kwargs)
+        except Exception as e:
+            error = e
+
+    for plan in reversed(plans[:entered]):
+        if error is not None:
+            try:
+                target_result = plan.call_exception(error, cb_args, kwargs)
+                error = None
+            except Exception as e:
+                error = e
+                continue
+        if short_circuit is not None:
+            plan = plan.short_circuited or plan
+        try:
+            plan.call_post(target_result, cb_args, kwargs)
+        except Exception as e:
+            error = e
+
+    if error is not None:
+        raise error
+    return target_result
+
+def run_batch(plans, target, calls, cb_calls):
+    '''
+        Calls <target> with every tuple of arguments in <calls>, for
+    call_many.  <plans> are the (batch plan, per-call plan) pairs of the
+    registries, outermost first.  The batch plans are run once around the
+    whole batch, with the list of argument tuples the callbacks see
+    (<cb_calls>) as their only argument and the list of results as the
+    target's result; the per-call plans are run around every call.
+    '''
+    batch_plans = [batch for batch, per_call in plans if batch is not None]
+    per_call_plans = [per_call for batch, per_call in plans
+            if per_call is not None]
+    batch_args = (cb_calls,)
+
+    short_circuit = None
+    entered = 0
+    for plan in batch_plans:
+        short_circuit = plan.call_pre(batch_args, {})
+        entered += 1
+        if short_circuit is not None:
+            break
+
+    if short_circuit is not None:
+        results = list(short_circuit.result)
+    elif not per_call_plans:
+        results = [target(*args) for args in calls]
+    elif len(per_call_plans) == 1:
+        plan = per_call_plans[0]
+        results = [plan.run(target, args, {}, cb_args)
+                for args, cb_args in zip(calls, cb_calls)]
+    else:
+        results = [run_nested_plans(per_call_plans, target, args, {}, cb_args)
+                for args, cb_args in zip(calls, cb_calls)]
+
+    for plan in reversed(batch_plans[:entered]):
+        if short_circuit is not None:
+            plan = plan.short_circuited or plan
+        plan.call_post(results, batch_args, {})
+    return results
+
+async def _await_if_needed(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+async def run_plan_async(plan, target, args, kwargs, cb_args):
+    '''
+        The coroutine equivalent of DispatchPlan.run.  The target is awaited,
+    and so is whatever a callback returns if it is awaitable.
+    '''
+    if plan.wrapped_target is not None:
+        target = plan.wrapped_target
+    plan = plan.select(cb_args, kwargs)
+    short_circuit = await call_pre_async(plan, cb_args, kwargs)
+    if short_circuit is not None:
+        await call_post_async(plan.short_circuited or plan,
+                short_circuit.result, cb_args, kwargs)
+        return short_circuit.result
+    try:
+        target_result = await target(*args, **kwargs)
+    except Exception as e:
+        target_result = await call_exception_async(plan, e, cb_args, kwargs)
+    await call_post_async(plan, target_result, cb_args, kwargs)
+    return target_result
+
+async def call_pre_async(plan, args, kwargs):
+    for callback, takes_target_args, can_short_circuit in plan.pre:
+        if takes_target_args:
+            result = callback(*args, **kwargs)
+        else:
+            result = callback()
+        result = await _await_if_needed(result)
+        if can_short_circuit and isinstance(result, ShortCircuit):
+            return result
+    return None
+
+async def call_exception_async(plan, exception, args, kwargs):
+    if plan.exception_index is not None:
+        return await call_typed_exception_async(plan, exception, args, kwargs)
+    result = None
+    for callback, takes_target_args, handles_exception in plan.exception:
+        if handles_exception and exception is None:
+            continue
+
+        if handles_exception:
+            try:
+                if takes_target_args:
+                    result = callback(exception, *args, **kwargs)
+                else:
+                    result = callback(exception)
+                result = await _await_if_needed(result)
+                exception = None
+            except Exception as e:
+                exception = e
+                continue
+        elif takes_target_args:
+            await _await_if_needed(callback(*args, **kwargs))
+        else:
+            await _await_if_needed(callback())
+    if exception is not None:
+        raise exception
+    else:
+        return result
+
+async def call_typed_exception_async(plan, exception, args, kwargs):
+    '''
+        The coroutine equivalent of DispatchPlan.call_typed_exception.
+    '''
+    index = plan.exception_index
+    result = None
+    exception_type = type(exception)
+    positions, entries = index.lookup(exception_type)
+    next_entry = 0
+    while next_entry < len(entries):
+        callback, takes_target_args, handles_exception = entries[next_entry]
+        position = positions[next_entry]
+        next_entry += 1
+        if handles_exception:
+            if exception is None:
+                continue
+            try:
+                if takes_target_args:
+                    result = callback(exception, *args, **kwargs)
                 else:
-                    callback()
+                    result = callback(exception)
+                result = await _await_if_needed(result)
+                exception = None
+            except Exception as e:
+                exception = e
+            if type(exception) is not exception_type:
+                exception_type = type(exception)
+                positions, entries = index.lookup(exception_type)
+                next_entry = bisect_right(positions, position)
+        elif takes_target_args:
+            await _await_if_needed(callback(*args, **kwargs))
+        else:
+            await _await_if_needed(callback())
+    if exception is not None:
+        raise exception
+    else:
+        return result
+
+def _start_post_callback(entry, target_result, args, kwargs):
+    callback, takes_target_args, takes_target_result = entry
+    if takes_target_args and takes_target_result:
+        return callback(target_result, *args, **kwargs)
+    elif takes_target_result:
+        return callback(target_result)
+    elif takes_target_args:
+        return callback(*args, **kwargs)
+    else:
+        return callback()
+
+async def call_post_async(plan, target_result, args, kwargs):
+    if plan.post_batches is None:
+        for entry in plan.post:
+            await _await_if_needed(
+                    _start_post_callback(entry, target_result, args, kwargs))
+        return
+
+    for batch in plan.post_batches:
+        pending = []
+        for entry in batch:
+            result = _start_post_callback(entry, target_result, args, kwargs)
+            if inspect.isawaitable(result):
+                # scheduled here, in priority order; asyncio.gather would
+                # schedule coroutines in the order of a set (Python 3.6)
+                pending.append(asyncio.ensure_future(result))
+        if len(pending) == 1:
+            await pending[0]
+        elif pending:
+            await asyncio.gather(*pending)
+
+async def run_nested_plans_async(plans, target, args, kwargs, cb_args):
+    '''
+        The coroutine equivalent of run_nested_plans.
+    '''
+    if plans[-1].wrapped_target is not None:
+        target = plans[-1].wrapped_target
+    plans = [plan.select(cb_args, kwargs) for plan in plans]
+    error = None
+    short_circuit = None
+    entered = 0
+    for plan in plans:
+        try:
+            short_circuit = await call_pre_async(plan, cb_args, kwargs)
+        except Exception as e:
+            error = e
+            break
+        entered += 1
+        if short_circuit is not None:
+            target_result = short_circuit.result
+            break
+    else:
+        try:
+            target_result = await target(*args, **kwargs)
+        except Exception as e:
+            error = e
+
+    for plan in reversed(plans[:entered]):
+        if error is not None:
+            try:
+                target_result = await call_exception_async(
+                        plan, error, cb_args, kwargs)
+                error = None
+            except Exception as e:
+                error = e
+                continue
+        if short_circuit is not None:
+            plan = plan.short_circuited or plan
+        try:
+            await call_post_async(plan, target_result, cb_args, kwargs)
+        except Exception as e:
+            error = e
+
+    if error is not None:
+        raise error
+    return target_result
+
+class AsyncSupportsCallbacks(SupportsCallbacks):
+    '''
+        SupportsCallbacks for coroutine functions (async def).  Calling the
+    target returns a coroutine, and the callbacks run when it is awaited, so
+    post callbacks see the awaited result.  Callbacks may be plain functions
+    or coroutine functions; anything awaitable that a callback returns is
+    awaited before the next callback runs.
+        If <gather_post_callbacks> is True, post callbacks with the same
+    priority are started together and their awaitables are awaited
+    concurrently with asyncio.gather.
+    '''
+    # the target and the callbacks are timed until their awaitables complete
+    _timed = staticmethod(timed_async)
+
+    def __init__(self, target, target_is_method=False,
+            gather_post_callbacks=None, **options):
+        if gather_post_callbacks is None:
+            gather_post_callbacks = getattr(target, 'gather_post_callbacks',
+                    False)
+        self.gather_post_callbacks = gather_post_callbacks
+        super(AsyncSupportsCallbacks, self).__init__(target,
+                target_is_method=target_is_method, **options)
+        # calling it returns a coroutine, so tell asyncio (and, from Python
+        # 3.12 on, inspect) that it is a coroutine function
+        self._is_coroutine = _is_coroutine
+        if hasattr(inspect, 'markcoroutinefunction'):
+            inspect.markcoroutinefunction(self)
+
+    def _batches_post_callbacks(self):
+        return bool(self.gather_post_callbacks)
+
+    def call_many(self, arguments, batch_callbacks=False):
+        raise TypeError('call_many is not supported for coroutine functions.')
+
+    def _cached(self, target):
+        return self._cached_target.wrap_async(target)
+
+    def __call__(self, *args, **kwargs):
+        plan = self._published_plan
+        if plan is _stale:
+            plan = self._refresh_plan()
+        if self._parent is not None:
+            return self._call_instance_method(plan, args, kwargs)
+        if plan is None:
+            return self.target(*args, **kwargs)
+
+        if self._target_is_method:
+            cb_args = args[1:] # skip over 'self' arg
+        else:
+            cb_args = args
+        return run_plan_async(plan, self.target, args, kwargs, cb_args)
+
+    def _call_instance_method(self, plan, args, kwargs):
+        parent = self._parent
+        parent_plan = parent._published_plan
+        if parent_plan is _stale:
+            parent_plan = parent._refresh_plan()
+        if plan is None:
+            if parent_plan is None:
+                return parent.target(*args, **kwargs)
+            return run_plan_async(parent_plan, parent.target, args, kwargs,
+                    args[1:])
+        if parent_plan is None:
+            return run_plan_async(plan, parent.target, args, kwargs, args[1:])
+        return run_nested_plans_async((plan, parent_plan), parent.target,
+                args, kwargs, args[1:])
+
+class StreamItems(object):
+    '''
+        Hands the items of one stream to the item callbacks of <plans>
+    (outermost first, but the callbacks of the innermost plan see the items
+    first), collecting them into lists for callbacks with a batch_size.
+    '''
+    __slots__ = ('entries', 'args', 'kwargs', 'batches')
+
+    def __init__(self, plans, args, kwargs):
+        self.entries = tuple(entry
+                for plan in reversed(plans) for entry in plan.item)
+        self.args = args
+        self.kwargs = kwargs
+        self.batches = [[] for entry in self.entries]
+
+    def calls(self, item):
+        '''
+            Yields (callback, args, kwargs) for every callback that is due
+        now that <item> was produced.
+        '''
+        for index, (callback, takes_target_args, batch_size) in enumerate(
+                self.entries):
+            if batch_size:
+                batch = self.batches[index]
+                batch.append(item)
+                if len(batch) < batch_size:
+                    continue
+                self.batches[index] = []
+                yield self._call(callback, takes_target_args, batch)
+            else:
+                yield self._call(callback, takes_target_args, item)
+
+    def remaining_calls(self):
+        '''
+            Yields (callback, args, kwargs) for the callbacks of the batches
+        that are not full, at the end of the stream.
+        '''
+        for index, (callback, takes_target_args, batch_size) in enumerate(
+                self.entries):
+            batch = self.batches[index]
+            if batch:
+                self.batches[index] = []
+                yield self._call(callback, takes_target_args, batch)
+
+    def _call(self, callback, takes_target_args, value):
+        if takes_target_args:
+            return callback, (value,) + self.args, self.kwargs
+        return callback, (value,), {}
 
-def supports_callbacks(target=None):
+def _short_circuited_stream(iterable):
+    for item in iterable:
+        yield item
+
+def run_stream(plans, target, args, kwargs, cb_args):
+    '''
+        The generator equivalent of run_nested_plans, for a generator
+    function <target>.  The callbacks run as the stream is consumed: pre
+    callbacks when the first item is asked for, item callbacks as each item
+    is produced, and exception and post callbacks when the stream fails or
+    ends (or is closed).  Post callbacks are given the number of items as
+    the target's result.  Values sent and exceptions thrown into the stream
+    are passed on to the target's generator.
+    '''
+    plans = [plan.select(cb_args, kwargs) for plan in plans]
+    error = None
+    short_circuit = None
+    entered = 0
+    for plan in plans:
+        try:
+            short_circuit = plan.call_pre(cb_args, kwargs)
+        except Exception as e:
+            error = e
+            break
+        entered += 1
+        if short_circuit is not None:
+            break
+
+    count = 0
+    returned = None
+    items = StreamItems(plans[:entered], cb_args, kwargs)
+    generator = None
+    try:
+        if error is None:
+            if short_circuit is not None:
+                generator = _short_circuited_stream(short_circuit.result)
+            else:
+                generator = target(*args, **kwargs)
+        sent = None
+        thrown = None
+        while generator is not None:
+            try:
+                if thrown is not None:
+                    item = generator.throw(thrown)
+                else:
+                    item = generator.send(sent)
+            except StopIteration as stop:
+                returned = stop.value
+                break
+            except Exception as e:
+                error = e
+                break
+            count += 1
+            for callback, callback_args, callback_kwargs in items.calls(item):
+                callback(*callback_args, **callback_kwargs)
+            try:
+                sent = yield item
+                thrown = None
+            except GeneratorExit:
+                # the stream was closed early, it ends here
+                break
+            except BaseException as e:
+                sent = None
+                thrown = e
+    finally:
+        if generator is not None:
+            generator.close()
+
+    for callback, callback_args, callback_kwargs in items.remaining_calls():
+        callback(*callback_args, **callback_kwargs)
+    for plan in reversed(plans[:entered]):
+        if error is not None:
+            try:
+                returned = plan.call_exception(error, cb_args, kwargs)
+                error = None
+            except Exception as e:
+                error = e
+                continue
+        if short_circuit is not None:
+            plan = plan.short_circuited or plan
+        try:
+            plan.call_post(count, cb_args, kwargs)
+        except Exception as e:
+            error = e
+
+    if error is not None:
+        raise error
+    return returned
+
+async def _short_circuited_async_stream(iterable):
+    for item in iterable:
+        yield item
+
+async def run_async_stream(plans, target, args, kwargs, cb_args):
+    '''
+        The async generator equivalent of run_stream.  Async generators
+    cannot return a value, so a value returned by an exception handler is
+    dropped.
+    '''
+    plans = [plan.select(cb_args, kwargs) for plan in plans]
+    error = None
+    short_circuit = None
+    entered = 0
+    for plan in plans:
+        try:
+            short_circuit = await call_pre_async(plan, cb_args, kwargs)
+        except Exception as e:
+            error = e
+            break
+        entered += 1
+        if short_circuit is not None:
+            break
+
+    count = 0
+    items = StreamItems(plans[:entered], cb_args, kwargs)
+    generator = None
+    try:
+        if error is None:
+            if short_circuit is not None:
+                generator = _short_circuited_async_stream(
+                        short_circuit.result)
+            else:
+                generator = target(*args, **kwargs)
+        sent = None
+        thrown = None
+        while generator is not None:
+            try:
+                if thrown is not None:
+                    item = await generator.athrow(thrown)
+                else:
+                    item = await generator.asend(sent)
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                error = e
+                break
+            count += 1
+            for callback, callback_args, callback_kwargs in items.calls(item):
+                await _await_if_needed(
+                        callback(*callback_args, **callback_kwargs))
+            try:
+                sent = yield item
+                thrown = None
+            except GeneratorExit:
+                break
+            except BaseException as e:
+                sent = None
+                thrown = e
+    finally:
+        if generator is not None:
+            await generator.aclose()
+
+    for callback, callback_args, callback_kwargs in items.remaining_calls():
+        await _await_if_needed(callback(*callback_args, **callback_kwargs))
+    for plan in reversed(plans[:entered]):
+        if error is not None:
+            try:
+                await call_exception_async(plan, error, cb_args, kwargs)
+                error = None
+            except Exception as e:
+                error = e
+                continue
+        if short_circuit is not None:
+            plan = plan.short_circuited or plan
+        try:
+            await call_post_async(plan, count, cb_args, kwargs)
+        except Exception as e:
+            error = e
+
+    if error is not None:
+        raise error
+
+class GeneratorSupportsCallbacks(SupportsCallbacks):
+    '''
+        SupportsCallbacks for generator functions.  Calling the target returns
+    a generator, and the callbacks run as it is consumed, without buffering
+    the stream (see run_stream): item callbacks (see add_item_callback) are
+    called for every item, post callbacks once the stream has ended, with
+    the number of items as the target's result, and exception callbacks if
+    the stream fails part way through.  If a handler handles the exception,
+    the stream ends there.
+        The results of generator functions cannot be cached, and with
+    instrumentation only the callbacks are timed.
+    '''
+    def __init__(self, target, target_is_method=False, **options):
+        if options.get('cache_size') is not None:
+            raise ValueError('The results of generator functions cannot be '
+                    'cached.')
+        super(GeneratorSupportsCallbacks, self).__init__(target,
+                target_is_method=target_is_method, **options)
+
+    _run_stream = staticmethod(run_stream)
+
+    def call_many(self, arguments, batch_callbacks=False):
+        raise TypeError('call_many is not supported for generator functions.')
+
+    def add_item_callback(self, callback,
+            priority=0,
+            label=None,
+            takes_target_args=False,
+            batch_size=None,
+            group=None,
+            max_calls=None):
+        '''
+            Registers the callback to be called for every item the target
+        produces.
+        Inputs:
+            callback: The callback function, it is passed the item.
+            priority: Number. Higher priority callbacks are run first,
+                ties are broken by the order in which callbacks were added.
+            label: A name to call this callback, must be unique (and hashable)
+                or None, if non-unique a RuntimeError will be raised.
+                If None, a unique CallbackLabel will be automatically
+                generated.
+            takes_target_args: If True, callback function will be passed,
+                after the item, the arguments and keyword arguments that are
+                supplied to the target function.
+            batch_size: If given, the callback is passed a list of
+                <batch_size> items instead of each item; the items left over
+                at the end of the stream are passed as a shorter list.
+            group: The name of a group to put the callback in, so that the
+                callbacks of the group can be disabled, enabled and removed
+                together (see disable_group).
+            max_calls: If given, the callback is unregistered once it has
+                been called this many times (1 for a one-shot callback).
+        Returns:
+            label
+        '''
+        if batch_size is not None and batch_size < 1:
+            raise ValueError('batch_size must be at least 1.')
+        return self._add_callback(callback=callback,
+                priority=priority, label=label,
+                takes_target_args=takes_target_args, type='item',
+                batch_size=batch_size, group=group, max_calls=max_calls)
+
+    def __call__(self, *args, **kwargs):
+        plan = self._published_plan
+        if plan is _stale:
+            plan = self._refresh_plan()
+        if self._parent is not None:
+            return self._call_instance_method(plan, args, kwargs)
+        if plan is None:
+            return self.target(*args, **kwargs)
+
+        if self._target_is_method:
+            cb_args = args[1:] # skip over 'self' arg
+        else:
+            cb_args = args
+        return self._run_stream((plan,), self.target, args, kwargs, cb_args)
+
+    def _call_instance_method(self, plan, args, kwargs):
+        parent = self._parent
+        plans = tuple(plan for plan in (plan, parent._plan)
+                if plan is not None)
+        if not plans:
+            return parent.target(*args, **kwargs)
+        return self._run_stream(plans, parent.target, args, kwargs, args[1:])
+
+class AsyncGeneratorSupportsCallbacks(GeneratorSupportsCallbacks):
+    '''
+        GeneratorSupportsCallbacks for async generator functions
+    (async def ... yield), see run_async_stream.  Anything awaitable that a
+    callback returns is awaited before the next callback runs.
+    '''
+    _run_stream = staticmethod(run_async_stream)
+    _timed = staticmethod(timed_async)
+
+class _ForwardedDoc(object):
+    '''
+        The __doc__ of BoundSupportsCallbacks: the docstring of the method an
+    instance is bound to, or the class docstring for the class itself.
+    '''
+    def __init__(self, doc):
+        self.doc = doc
+
+    def __get__(self, obj, obj_type=None):
+        if obj is None:
+            return self.doc
+        return obj.__func__.__doc__
+
+class BoundSupportsCallbacks(object):
+    '''
+        What a callback-supporting method evaluates to when it is looked up on
+    an instance; it behaves like a bound method.  Any registry attribute
+    (add_callback, num_callbacks, ...) is looked up on the instance-level
+    registry, which is created on first use.
+    '''
+    __slots__ = ('__func__', '__self__')
+    __doc__ = _ForwardedDoc(__doc__)
+
+    def __init__(self, descriptor, instance):
+        self.__func__ = descriptor
+        self.__self__ = instance
+
+    @property
+    def __name__(self):
+        return self.__func__.__name__
+
+    @property
+    def __wrapped__(self):
+        return self.__func__.target
+
+    # bound coroutine functions are coroutine functions too, see
+    # AsyncSupportsCallbacks
+    @property
+    def _is_coroutine(self):
+        return getattr(self.__func__, '_is_coroutine', None)
+
+    @property
+    def _is_coroutine_marker(self):
+        return getattr(self.__func__, '_is_coroutine_marker', None)
+
+    @property
+    def __signature__(self):
+        signature = self.__func__._signature
+        # without self, like the signature of a bound method
+        return signature.replace(
+                parameters=list(signature.parameters.values())[1:])
+
+    def __call__(self, *args, **kwargs):
+        descriptor = self.__func__
+        instance = self.__self__
+        if descriptor._callback_registries:
+            callback_registry = descriptor._callback_registries.get(instance)
+            if callback_registry is not None:
+                return callback_registry(instance, *args, **kwargs)
+        return descriptor(instance, *args, **kwargs)
+
+    def __getattr__(self, name):
+        # only the registry's own attributes, so that looking anything else
+        # up (as copy, pickle and inspect do) does not create a registry
+        if not name.startswith('_'):
+            descriptor = self.__func__
+            if hasattr(type(descriptor), name) or name in vars(descriptor):
+                return getattr(descriptor._instance_registry(self.__self__),
+                        name)
+        raise AttributeError("'%s' object has no attribute '%s'" %
+                (self.__class__.__name__, name))
+
+    def call_many(self, arguments, batch_callbacks=False):
+        '''
+            Calls the method once for every tuple of arguments in <arguments>,
+        see SupportsCallbacks.call_many.
+        '''
+        descriptor = self.__func__
+        instance = self.__self__
+        calls = [(instance,) + tuple(args) for args in arguments]
+        callback_registry = descriptor._callback_registries.get(instance)
+        if callback_registry is None:
+            callback_registry = descriptor
+        return callback_registry.call_many(calls,
+                batch_callbacks=batch_callbacks)
+
+    def map(self, *iterables, batch_callbacks=False):
+        '''
+            Like the builtin map, but returns the list of results; see
+        SupportsCallbacks.call_many.
+        '''
+        return self.call_many(zip(*iterables),
+                batch_callbacks=batch_callbacks)
+
+    def __eq__(self, other):
+        if not isinstance(other, BoundSupportsCallbacks):
+            return NotImplemented
+        return (self.__func__ is other.__func__ and
+                self.__self__ is other.__self__)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash((self.__func__, id(self.__self__)))
+
+    def __repr__(self):
+        return '<bound method %s of %r>' % (self.__name__, self.__self__)
+
+def _by_priority(record):
+    return record.priority
+
+def _batchable(record):
+    '''
+        Whether call_many(batch_callbacks=True) calls <record> once per batch.
+    '''
+    return (record.type in ('pre', 'post') and record.when is None and
+            record.predicate is None and record.target_params is None and
+            record.buffer is None)
+
+def _flush_buffers(records):
+    for record in records:
+        if record.debouncer is not None:
+            record.debouncer.flush()
+        if record.buffer is not None:
+            record.buffer.flush()
+
+def _exception_types(exception_types):
+    '''
+        Returns <exception_types> (an exception class or an iterable of them)
+    as a tuple, or None.
+    '''
+    if exception_types is None:
+        return None
+    if isinstance(exception_types, type):
+        exception_types = (exception_types,)
+    exception_types = tuple(exception_types)
+    for exception_type in exception_types:
+        if not (isinstance(exception_type, type) and
+                issubclass(exception_type, BaseException)):
+            raise TypeError('exception_types must be exception classes, '
+                    'not %r' % (exception_type,))
+    return exception_types
+
+def supports_callbacks(target=None, **options):
     """
         This is a decorator.  Once a function/method is decorated, you can
     register callbacks:
@@ -395,9 +2438,26 @@ def supports_callbacks(target=None):
 
     To print a list of callbacks use:
         <target>.list_callbacks()
+
+    Options are passed on to SupportsCallbacks, e.g.
+        @supports_callbacks(post_executor=BackgroundDispatcher())
+    runs post callbacks in the background.
+
+    Coroutine functions (async def) are supported; see AsyncSupportsCallbacks
+    for the <gather_post_callbacks> option.  So are generator and async
+    generator functions; see GeneratorSupportsCallbacks.
     """
+    def decorator(target):
+        if inspect.isasyncgenfunction(target):
+            return AsyncGeneratorSupportsCallbacks(target, **options)
+        elif inspect.isgeneratorfunction(target):
+            return GeneratorSupportsCallbacks(target, **options)
+        elif asyncio.iscoroutinefunction(target):
+            return AsyncSupportsCallbacks(target, **options)
+        return SupportsCallbacks(target, **options)
+
     if callable(target):
         # this support bare @supports_callbacks syntax (no calling brackets)
-        return SupportsCallbacks(target)
+        return decorator(target)
     else:
-        return SupportsCallbacks
+        return decorator
@@ -0,0 +1,249 @@
+from __future__ import absolute_import
+
+from random import random
+from time import monotonic
+import itertools
+import threading
+
+# stands for a key argument whose value no callback has registered for
+_unmatched = object()
+
+def filter_values(value):
+    '''
+        Returns the frozenset of values a 'when' filter accepts for one
+    argument: a set, frozenset or list means any of its items, anything else
+    means just that value.
+    '''
+    if isinstance(value, (set, frozenset, list)):
+        return frozenset(value)
+    return frozenset([value])
+
+def gated(function, predicate, leading=0, takes_target_args=False,
+        handles_exception=False):
+    '''
+        Returns a function that takes the target's (*args, **kwargs), after
+    <leading> other positional arguments, and only calls <function> if
+    predicate(*args, **kwargs) is true.  <function> is given the target's
+    arguments only if <takes_target_args>.  An exception handler that is
+    skipped re-raises the exception, so it reaches the next handler.
+    '''
+    def gated_function(*args, **kwargs):
+        if predicate(*args[leading:], **kwargs):
+            if takes_target_args:
+                return function(*args, **kwargs)
+            return function(*args[:leading])
+        elif handles_exception:
+            raise args[0]
+    return gated_function
+
+def every_nth(n):
+    '''
+        Returns a function that returns True for the first of every <n>
+    calls to it.
+    '''
+    if n < 1:
+        raise ValueError('sample_every must be at least 1.')
+    counter = itertools.count()
+    def allows():
+        return next(counter) % n == 0
+    return allows
+
+def with_probability(probability):
+    '''
+        Returns a function that returns True with <probability>.
+    '''
+    if not 0 < probability <= 1:
+        raise ValueError('sample_rate must be above 0 and at most 1.')
+    def allows():
+        return random() < probability
+    return allows
+
+def token_bucket(rate, burst=None):
+    '''
+        Returns a function that returns True at most <rate> times per second
+    on average: every call takes a token from a bucket of <burst> tokens
+    (<rate>, rounded up, by default) that refills at <rate> tokens per
+    second.
+    '''
+    if rate <= 0:
+        raise ValueError('max_per_second must be positive.')
+    if burst is None:
+        burst = max(1, int(-(-rate // 1)))
+    # [tokens, when they were counted, when the next token is due]; while
+    # the bucket is empty calls are turned away without taking the lock
+    bucket = [float(burst), monotonic(), 0.0]
+    lock = threading.Lock()
+    def allows():
+        now = monotonic()
+        if now < bucket[2]:
+            return False
+        with lock:
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return True
+            bucket[0] = tokens
+            bucket[2] = now + (1 - tokens) / rate
+            return False
+    return allows
+
+def sampling_policy(sample_every=None, sample_rate=None,
+        max_per_second=None):
+    '''
+        Returns a function that tells whether a callback should run for a
+    call, allowing only the calls every given policy allows, or None if no
+    policy is given.  The policies are checked in the order of the
+    arguments, a call one of them skips is not seen by the next ones.
+    '''
+    policies = []
+    if sample_every is not None:
+        policies.append(every_nth(sample_every))
+    if sample_rate is not None:
+        policies.append(with_probability(sample_rate))
+    if max_per_second is not None:
+        policies.append(token_bucket(max_per_second))
+    if not policies:
+        return None
+    if len(policies) == 1:
+        return policies[0]
+    def allows():
+        for policy in policies:
+            if not policy():
+                return False
+        return True
+    return allows
+
+def sampled(function, allows, handles_exception=False):
+    '''
+        Returns a function that only calls <function> when allows() is true.
+    A skipped exception handler re-raises the exception, as it does in
+    gated.
+    '''
+    if handles_exception:
+        def sampled_handler(exception, *args, **kwargs):
+            if allows():
+                return function(exception, *args, **kwargs)
+            raise exception
+        return sampled_handler
+    def sampled_function(*args, **kwargs):
+        if allows():
+            return function(*args, **kwargs)
+    return sampled_function
+
+def limited(function, counter, max_calls, expire, handles_exception=False):
+    '''
+        Returns a function that calls <function> for the first <max_calls>
+    values it takes from <counter> (an itertools.count), and calls expire()
+    after the last of those calls.  Later calls are skipped, a skipped
+    exception handler re-raises the exception.
+    '''
+    def limited_function(*args, **kwargs):
+        count = next(counter)
+        if count >= max_calls:
+            if handles_exception:
+                raise args[0]
+            return None
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if count == max_calls - 1:
+                expire()
+    return limited_function
+
+class FilteredDispatchPlan(object):
+    '''
+        Stands in for a DispatchPlan when some callbacks were registered with
+    a 'when' filter.  The values of the key arguments are looked up once per
+    call and used as the key of an index of DispatchPlans that only hold the
+    unfiltered callbacks and the callbacks whose filter matches, so a call
+    runs just the callbacks it is meant to run.  Values nobody registered for
+    share a single entry, which keeps the index as small as the filters.
+        phases:  {type: ((plan entry, CallbackRecord, ...), ...)} in run
+                 order (see build_dispatch_plan).
+        keys:    ((argument name, getter(args, kwargs)), ...)
+        build:   function(phases) -> DispatchPlan
+    '''
+    __slots__ = ('phases', 'keys', 'build', 'wrapped_target', '_plans')
+
+    def __init__(self, phases, keys, build, wrapped_target=None):
+        self.phases = phases
+        values = dict((name, set()) for name, getter in keys)
+        for items in phases.values():
+            for item in items:
+                record = item[1]
+                if record.when is not None:
+                    for name, accepted in record.when.items():
+                        values[name].update(accepted)
+        self.keys = tuple((name, getter, frozenset(values[name]))
+                for name, getter in keys)
+        self.build = build
+        self.wrapped_target = wrapped_target
+        # filled in as values are seen; racing threads build equal plans
+        self._plans = {}
+
+    def select(self, args, kwargs):
+        '''
+            Returns the DispatchPlan for a call with (args, kwargs).
+        '''
+        key = []
+        for name, getter, values in self.keys:
+            try:
+                value = getter(args, kwargs)
+                if value not in values:
+                    value = _unmatched
+            except TypeError:
+                # the argument is missing or its value is unhashable
+                value = _unmatched
+            key.append(value)
+        key = tuple(key)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._plans[key] = self._build_for(key)
+        return plan
+
+    def _build_for(self, key):
+        values = dict(zip((name for name, getter, accepted in self.keys), key))
+        return self.build(dict(
+                (type, tuple(item for item in items
+                    if item[1].when is None or all(values[name] in accepted
+                        for name, accepted in item[1].when.items())))
+                for type, items in self.phases.items()))
+
+    def run(self, target, args, kwargs, cb_args):
+        return self.select(cb_args, kwargs).run(target, args, kwargs, cb_args)
+
+class ExceptionIndex(object):
+    '''
+        The exception callbacks of a DispatchPlan, indexed by the type of
+    exception they apply to.  The callbacks that apply to a type are worked
+    out (with issubclass, so over the type's MRO) the first time an
+    exception of that type is dispatched and cached from then on.
+        entries: the plan's exception entries, in the order they are run.
+        types:   for each entry a tuple of exception types, or None if it
+                 applies to any exception.
+    '''
+    __slots__ = ('entries', 'types', '_by_type')
+
+    def __init__(self, entries, types):
+        self.entries = entries
+        self.types = types
+        # racing threads build equal tuples
+        self._by_type = {}
+
+    def lookup(self, exception_type):
+        '''
+            Returns (positions, entries) for the entries that apply to
+        <exception_type>, where positions are their indices in the plan.
+        The type of None (an exception that has been handled) only gets the
+        entries without types.
+        '''
+        found = self._by_type.get(exception_type)
+        if found is None:
+            positions = tuple(position
+                    for position, types in enumerate(self.types)
+                    if types is None or issubclass(exception_type, types))
+            found = (positions,
+                    tuple(self.entries[position] for position in positions))
+            self._by_type[exception_type] = found
+        return found
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+from timeit import default_timer
+import inspect
+
+# upper bounds (in seconds) of the latency histogram buckets, the last bucket
+# holds everything slower than HISTOGRAM_BOUNDS[-1]
+HISTOGRAM_BOUNDS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+class CallbackStats(object):
+    '''
+        Call counts and wall-clock timings of a callback (or a target).
+    Updates are not locked, so with many threads calling at once the numbers
+    are approximate.
+    '''
+    __slots__ = ('calls', 'errors', 'total_time', 'max_time', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def record(self, elapsed, failed=False):
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        for index, bound in enumerate(HISTOGRAM_BOUNDS):
+            if elapsed <= bound:
+                break
+        else:
+            index = len(HISTOGRAM_BOUNDS)
+        self.histogram[index] += 1
+
+    @property
+    def mean_time(self):
+        if not self.calls:
+            return 0.0
+        return self.total_time / self.calls
+
+    def as_dict(self):
+        '''
+            Returns the stats as plain data.  'histogram' maps the upper bound
+        of each bucket (None for the last one) to the number of calls in it.
+        '''
+        bounds = HISTOGRAM_BOUNDS + (None,)
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'total_time': self.total_time,
+                'max_time': self.max_time,
+                'mean_time': self.mean_time,
+                'histogram': dict(zip(bounds, self.histogram))}
+
+def timed(function, stats):
+    '''
+        Returns a function that calls <function> and records how long it took
+    in <stats>.  What <function> returns is passed through as it is.
+    '''
+    def timed_function(*args, **kwargs):
+        start = default_timer()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            stats.record(default_timer() - start, failed=True)
+            raise
+        stats.record(default_timer() - start)
+        return result
+    return timed_function
+
+def timed_async(function, stats):
+    '''
+        Like timed, for functions whose awaitable results are awaited by the
+    caller (coroutine functions and their callbacks): if <function> returns
+    an awaitable, the time until it completes is recorded instead.
+    '''
+    def timed_function(*args, **kwargs):
+        start = default_timer()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            stats.record(default_timer() - start, failed=True)
+            raise
+        if inspect.isawaitable(result):
+            return _timed_awaitable(result, stats, start)
+        stats.record(default_timer() - start)
+        return result
+    return timed_function
+
+async def _timed_awaitable(awaitable, stats, start):
+    try:
+        result = await awaitable
+    except Exception:
+        stats.record(default_timer() - start, failed=True)
+        raise
+    stats.record(default_timer() - start)
+    return result
@@ -0,0 +1,26 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import asyncio
+
+from callbacks import supports_callbacks
+
+async def audit(result):
+    await asyncio.sleep(0.1)
+    print("audited %s" % result)
+
+def log(result):
+    print("logged %s" % result)
+
+@supports_callbacks
+async def fetch(key):
+    await asyncio.sleep(0.1)
+    return key.upper()
+
+fetch.add_post_callback(audit, takes_target_result=True)
+fetch.add_post_callback(log, takes_target_result=True)
+
+print("This should print 'audited KEY' then 'logged KEY' then 'KEY':")
+loop = asyncio.new_event_loop()
+print(loop.run_until_complete(fetch('key')))
+loop.close()
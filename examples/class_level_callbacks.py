@@ -3,9 +3,10 @@ from __future__ import print_function
 
 from callbacks import supports_callbacks
 
-#     The class-level callbacks are called as the
-# 'target' of the instance-level callbacks so the order cannot be made
-# entirely arbitrary, the order is essentially:
+#     The class-level and instance-level callbacks are run in a single pass,
+# but in the same order as if the class-level callbacks were the 'target' of
+# the instance-level callbacks, so the order cannot be made entirely
+# arbitrary, the order is essentially:
 #
 #     INSTANCE_level_PRE_callbacks
 #     try:
@@ -0,0 +1,153 @@
+from __future__ import absolute_import
+import asyncio
+import inspect
+import unittest
+
+from callbacks import supports_callbacks, BackgroundDispatcher
+
+called_order = []
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+@supports_callbacks
+async def foo(bar, baz='bone'):
+    await asyncio.sleep(0)
+    called_order.append('foo')
+    return bar, baz
+
+@supports_callbacks
+async def fails():
+    raise RuntimeError('fails')
+
+def sync_callback(*args):
+    called_order.append(('sync', args))
+
+async def async_callback(*args):
+    await asyncio.sleep(0)
+    called_order.append(('async', args))
+
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        while called_order:
+            called_order.pop()
+        foo.remove_callbacks()
+        fails.remove_callbacks()
+
+    def test_without_callbacks(self):
+        self.assertEqual(run(foo(1)), (1, 'bone'))
+        self.assertEqual(called_order, ['foo'])
+
+    def test_post_callbacks_see_awaited_result(self):
+        foo.add_pre_callback(async_callback, takes_target_args=True)
+        foo.add_post_callback(sync_callback, takes_target_result=True)
+        foo.add_post_callback(async_callback, takes_target_result=True)
+
+        coroutine = foo(1, 2)
+        self.assertEqual(called_order, [])
+
+        self.assertEqual(run(coroutine), (1, 2))
+        self.assertEqual(called_order, [('async', (1, 2)), 'foo',
+                ('sync', ((1, 2),)), ('async', ((1, 2),))])
+
+    def test_async_exception_handler(self):
+        async def handler(exception):
+            await asyncio.sleep(0)
+            return 'handled %s' % exception
+
+        fails.add_exception_callback(handler, handles_exception=True)
+        fails.add_post_callback(async_callback, takes_target_result=True)
+
+        self.assertEqual(run(fails()), 'handled fails')
+        self.assertEqual(called_order, [('async', ('handled fails',))])
+
+    def test_exception_types(self):
+        async def handler(exception):
+            return 'handled %s' % exception
+
+        fails.add_exception_callback(async_callback, priority=1,
+                handles_exception=True, exception_types=KeyError)
+        fails.add_exception_callback(handler, handles_exception=True,
+                exception_types=RuntimeError)
+
+        self.assertEqual(run(fails()), 'handled fails')
+        self.assertEqual(called_order, [])
+
+    def test_exception_propagates(self):
+        fails.add_exception_callback(async_callback)
+
+        self.assertRaises(RuntimeError, run, fails())
+        self.assertEqual(called_order, [('async', ())])
+
+    def test_gather_post_callbacks(self):
+        events = []
+        def make_callback(name):
+            async def callback():
+                events.append(('start', name))
+                await asyncio.sleep(0)
+                events.append(('end', name))
+            return callback
+
+        @supports_callbacks(gather_post_callbacks=True)
+        async def target():
+            pass
+
+        target.add_post_callback(make_callback('a'), priority=1)
+        target.add_post_callback(make_callback('b'), priority=1)
+        target.add_post_callback(make_callback('c'))
+
+        run(target())
+        self.assertEqual(events, [('start', 'a'), ('start', 'b'),
+                ('end', 'a'), ('end', 'b'), ('start', 'c'), ('end', 'c')])
+
+    def test_methods(self):
+        class ExampleClass(object):
+            @supports_callbacks(gather_post_callbacks=True)
+            async def method(self, value):
+                called_order.append('method')
+                return value
+
+        e = ExampleClass()
+        ExampleClass.method.add_post_callback(async_callback,
+                takes_target_result=True)
+        e.method.add_pre_callback(sync_callback, takes_target_args=True)
+
+        self.assertEqual(run(e.method(5)), 5)
+        self.assertEqual(called_order, [('sync', (5,)), 'method',
+                ('async', (5,))])
+        self.assertTrue(e.method.gather_post_callbacks)
+
+    def test_async_callbacks_on_an_executor(self):
+        dispatcher = BackgroundDispatcher()
+        try:
+            foo.add_post_callback(async_callback, takes_target_result=True,
+                    executor=dispatcher)
+            self.assertEqual(run(foo(1)), (1, 'bone'))
+            self.assertTrue(foo.flush_callbacks(timeout=5))
+        finally:
+            dispatcher.shutdown()
+        self.assertEqual(called_order, ['foo', ('async', ((1, 'bone'),))])
+        self.assertEqual(dispatcher.errors, 0)
+
+    def test_decorated_functions_are_coroutine_functions(self):
+        class ExampleClass(object):
+            @supports_callbacks
+            async def method(self):
+                pass
+
+        for function in (foo, ExampleClass.method, ExampleClass().method):
+            self.assertTrue(asyncio.iscoroutinefunction(function))
+            if hasattr(inspect, 'markcoroutinefunction'):
+                self.assertTrue(inspect.iscoroutinefunction(function))
+        self.assertFalse(asyncio.iscoroutinefunction(
+                supports_callbacks(lambda: None)))
+
+        # decorated coroutine functions cannot be buffered or debounced
+        self.assertRaises(TypeError, foo.add_post_callback, foo,
+                batch_size=2)
+        self.assertRaises(TypeError, foo.add_post_callback,
+                ExampleClass().method, debounce=1)
@@ -0,0 +1,177 @@
+from __future__ import absolute_import
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from callbacks import supports_callbacks, BackgroundDispatcher
+from callbacks import ProcessDispatcher
+
+called_with = []
+def callback(*args, **kwargs):
+    called_with.append((args, kwargs))
+
+@supports_callbacks
+def foo(bar, baz='bone'):
+    return bar, baz
+
+def write_pid(path, *args):
+    with open(path, 'a') as f:
+        f.write('%d %r\n' % (os.getpid(), args))
+
+def write_result_pid(result, path, value):
+    write_pid(path, result, value)
+
+@supports_callbacks
+def save(path, value):
+    if value is None:
+        raise ValueError(value)
+    return value
+
+class TestBackground(unittest.TestCase):
+    def setUp(self):
+        while called_with:
+            called_with.pop()
+        foo.remove_callbacks()
+        self.dispatcher = BackgroundDispatcher()
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+
+    def test_post_callback_runs_in_background(self):
+        threads = []
+        def record_thread(result):
+            threads.append(threading.current_thread())
+
+        foo.add_post_callback(callback, takes_target_args=True,
+                takes_target_result=True, executor=self.dispatcher)
+        foo.add_post_callback(record_thread, takes_target_result=True,
+                executor=self.dispatcher)
+
+        self.assertEqual(foo(1, baz=2), (1, 2))
+        self.assertTrue(foo.flush_callbacks(timeout=5))
+        self.assertEqual(called_with, [(((1, 2), 1), {'baz': 2})])
+        self.assertNotEqual(threads, [threading.current_thread()])
+
+    def test_target_level_executor(self):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            @supports_callbacks(post_executor=executor)
+            def target(value):
+                return value
+
+            target.add_post_callback(callback, takes_target_result=True)
+            target.add_post_callback(callback, executor=False)
+            self.assertEqual(target(3), 3)
+            self.assertTrue(target.flush_callbacks(timeout=5))
+
+        self.assertEqual(sorted(called_with), [((), {}), ((3,), {})])
+
+    def test_overflow_policies(self):
+        release = threading.Event()
+        def blocker():
+            release.wait(5)
+
+        for overflow, expected in [('drop_newest', [0]),
+                                   ('drop_oldest', [3])]:
+            seen = []
+            dispatcher = BackgroundDispatcher(max_queue=1, overflow=overflow)
+            release.clear()
+            dispatcher.submit(blocker, (), {})
+            while dispatcher.pending != 1 or dispatcher._queue:
+                pass
+            for i in range(4):
+                dispatcher.submit(seen.append, (i,), {})
+            release.set()
+            dispatcher.shutdown()
+            self.assertEqual(seen, expected)
+            self.assertEqual(dispatcher.dropped, 3)
+
+    def test_errors_are_counted(self):
+        def broken():
+            raise RuntimeError('broken')
+
+        foo.add_post_callback(broken, executor=self.dispatcher)
+        foo(1)
+        self.dispatcher.flush()
+        self.assertEqual(self.dispatcher.errors, 1)
+
+    def test_bad_overflow(self):
+        self.assertRaises(ValueError, BackgroundDispatcher, overflow='nope')
+        self.assertRaises(TypeError, foo.add_post_callback, callback,
+                executor=object())
+
+class TestProcessDispatcher(unittest.TestCase):
+    def setUp(self):
+        save.remove_callbacks()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'calls')
+        self.dispatcher = ProcessDispatcher(max_workers=2)
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+        shutil.rmtree(self.directory)
+
+    def read_calls(self):
+        with open(self.path) as f:
+            return [line.split(' ', 1) for line in f.read().splitlines()]
+
+    def test_callbacks_run_in_other_processes(self):
+        save.add_post_callback(write_result_pid, takes_target_args=True,
+                takes_target_result=True, executor=self.dispatcher)
+        save.add_exception_callback(write_pid, takes_target_args=True,
+                executor=self.dispatcher)
+
+        self.assertEqual(save(self.path, 1), 1)
+        self.assertRaises(ValueError, save, self.path, None)
+        self.assertTrue(save.flush_callbacks(timeout=30))
+
+        calls = self.read_calls()
+        self.assertEqual(sorted(args for pid, args in calls),
+                ['(1, 1)', '(None,)'])
+        self.assertFalse(str(os.getpid()) in [pid for pid, args in calls])
+
+    def test_instrumented_target(self):
+        @supports_callbacks(instrument=True)
+        def measured(path, value):
+            return value
+
+        label = measured.add_post_callback(write_result_pid,
+                takes_target_args=True, takes_target_result=True,
+                executor=self.dispatcher)
+        measured(self.path, 1)
+        self.assertTrue(measured.flush_callbacks(timeout=30))
+
+        self.assertEqual(self.dispatcher.unpicklable, 0)
+        self.assertEqual([args for pid, args in self.read_calls()],
+                ['(1, 1)'])
+        self.assertEqual(measured.callback_stats()['callbacks'][label]
+                ['calls'], 1)
+
+    def test_unpicklable_calls(self):
+        unpicklable = lambda: None
+        self.assertFalse(self.dispatcher.submit(write_pid,
+                (self.path, unpicklable), {}))
+        self.assertEqual(self.dispatcher.unpicklable, 1)
+
+        seen = []
+        for policy, expected in [('raise', Exception), ('inline', None)]:
+            dispatcher = ProcessDispatcher(unpicklable=policy)
+            if expected is None:
+                dispatcher.submit(seen.append, (unpicklable,), {})
+            else:
+                self.assertRaises(expected, dispatcher.submit, seen.append,
+                        (unpicklable,), {})
+            dispatcher.shutdown()
+        self.assertEqual(seen, [unpicklable])
+
+    def test_errors_are_counted(self):
+        self.dispatcher.submit(write_pid, (), {})
+        self.assertTrue(self.dispatcher.flush(timeout=30))
+        self.assertEqual(self.dispatcher.errors, 1)
+
+    def test_registration(self):
+        self.assertRaises(ValueError, ProcessDispatcher, unpicklable='nope')
+        self.assertRaises(ValueError, save.add_exception_callback, write_pid,
+                handles_exception=True, executor=self.dispatcher)
@@ -0,0 +1,116 @@
+from __future__ import absolute_import
+import unittest
+
+from callbacks import supports_callbacks, ShortCircuit
+
+called_with = []
+
+def recorder(name):
+    def callback(*args, **kwargs):
+        called_with.append((name,) + args)
+    return callback
+
+@supports_callbacks
+def add(a, b=0):
+    if a == 'raise':
+        raise ValueError(a)
+    return a + b
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        del called_with[:]
+        add.remove_callbacks()
+
+    def test_call_many(self):
+        add.add_post_callback(recorder('post'), takes_target_result=True)
+
+        self.assertEqual(add.call_many([(1,), (2, 3)]), [1, 5])
+        self.assertEqual(called_with, [('post', 1), ('post', 5)])
+
+    def test_map(self):
+        self.assertEqual(add.map([1, 2], [10, 20]), [11, 22])
+
+    def test_batch_callbacks(self):
+        add.add_pre_callback(recorder('pre'), takes_target_args=True)
+        add.add_pre_callback(recorder('pre no args'))
+        add.add_post_callback(recorder('post'), takes_target_args=True,
+                takes_target_result=True)
+
+        self.assertEqual(add.map([1, 2], [10, 20], batch_callbacks=True),
+                [11, 22])
+        self.assertEqual(called_with, [
+                ('pre', [(1, 10), (2, 20)]),
+                ('pre no args',),
+                ('post', [11, 22], [(1, 10), (2, 20)])])
+
+    def test_per_call_callbacks_in_batches(self):
+        add.add_pre_callback(recorder('batch'))
+        add.add_pre_callback(recorder('when'), when={'a': 2})
+        add.add_pre_callback(recorder('params'), target_params=['a'])
+        add.add_exception_callback(lambda e: None, handles_exception=True)
+
+        self.assertEqual(add.call_many([(1,), (2,), ('raise',)],
+                batch_callbacks=True), [1, 2, None])
+        self.assertEqual(called_with, [('batch',),
+                ('params', 1),
+                ('when',), ('params', 2),
+                ('params', 'raise')])
+
+    def test_unhandled_exception_stops_the_batch(self):
+        add.add_post_callback(recorder('post'))
+
+        self.assertRaises(ValueError, add.call_many,
+                [(1,), ('raise',), (2,)], batch_callbacks=True)
+        self.assertEqual(called_with, [])
+
+    def test_short_circuit(self):
+        add.add_pre_callback(lambda calls: ShortCircuit([0] * len(calls)),
+                takes_target_args=True, can_short_circuit=True)
+        add.add_post_callback(recorder('post'), takes_target_result=True,
+                takes_short_circuited=True)
+
+        self.assertEqual(add.call_many([(1,), (2,)], batch_callbacks=True),
+                [0, 0])
+        self.assertEqual(called_with, [('post', [0, 0], True)])
+
+    def test_plans_follow_registration(self):
+        add.call_many([(1,)], batch_callbacks=True)
+        add.add_post_callback(recorder('post'), takes_target_result=True)
+
+        add.call_many([(1,)], batch_callbacks=True)
+        self.assertEqual(called_with, [('post', [1])])
+
+    def test_methods(self):
+        class Example(object):
+            def __init__(self, offset):
+                self.offset = offset
+
+            @supports_callbacks
+            def shift(self, value):
+                return value + self.offset
+
+        Example.shift.add_post_callback(recorder('class'),
+                takes_target_result=True)
+        e = Example(10)
+        self.assertEqual(e.shift.map([1, 2], batch_callbacks=True), [11, 12])
+        self.assertEqual(called_with, [('class', [11, 12])])
+
+        del called_with[:]
+        e.shift.add_pre_callback(recorder('instance'), takes_target_args=True)
+        self.assertEqual(e.shift.call_many([(1,)], batch_callbacks=True),
+                [11])
+        self.assertEqual(Example.shift.call_many([(Example(0), 1)]), [1])
+        self.assertEqual(called_with, [('instance', [(1,)]),
+                ('class', [11]), ('class', 1)])
+
+    def test_coroutines_and_generators(self):
+        @supports_callbacks
+        async def coroutine():
+            pass
+
+        @supports_callbacks
+        def generator():
+            yield
+
+        self.assertRaises(TypeError, coroutine.call_many, [()])
+        self.assertRaises(TypeError, generator.call_many, [()])
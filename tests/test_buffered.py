@@ -0,0 +1,171 @@
+from __future__ import absolute_import
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import unittest
+
+from callbacks import supports_callbacks, BackgroundDispatcher
+
+batches = []
+
+@supports_callbacks
+def foo(bar, baz='bone'):
+    return bar
+
+class TestBuffered(unittest.TestCase):
+    def setUp(self):
+        del batches[:]
+        foo.remove_callbacks()
+
+    def test_delivered_when_full(self):
+        foo.add_post_callback(batches.append, batch_size=3,
+                takes_target_result=True)
+
+        for value in range(7):
+            foo(value)
+        self.assertEqual(batches, [
+                [((0,), {}), ((1,), {}), ((2,), {})],
+                [((3,), {}), ((4,), {}), ((5,), {})]])
+
+        self.assertTrue(foo.flush_callbacks())
+        self.assertEqual(batches[2:], [[((6,), {})]])
+        foo.flush_callbacks()
+        self.assertEqual(len(batches), 3)
+
+    def test_records_hold_what_the_callback_takes(self):
+        foo.add_post_callback(batches.append, batch_size=2,
+                takes_target_args=True, takes_target_result=True)
+        foo.add_post_callback(batches.append, batch_size=2,
+                target_params=['baz'])
+
+        foo(1, baz=2)
+        foo(3)
+        self.assertEqual(batches, [
+                [((1, 1), {'baz': 2}), ((3, 3), {})],
+                [((2,), {}), (('bone',), {})]])
+
+    def test_delivered_after_interval(self):
+        delivered = threading.Event()
+        def deliver(records):
+            batches.append(records)
+            delivered.set()
+        foo.add_post_callback(deliver, batch_size=100, batch_interval=0.01)
+
+        start = time.time()
+        foo(1)
+        self.assertTrue(delivered.wait(5))
+        self.assertTrue(time.time() - start >= 0.01)
+        self.assertEqual(batches, [[((), {})]])
+
+    def test_removal_delivers_pending_calls(self):
+        label = foo.add_post_callback(batches.append, batch_size=10)
+        foo(1)
+        foo.remove_callback(label)
+        self.assertEqual(batches, [[((), {})]])
+
+        foo.add_post_callback(batches.append, batch_size=10)
+        foo(1)
+        foo.remove_callbacks()
+        self.assertEqual(len(batches), 2)
+
+    def test_errors_are_not_raised_to_the_caller(self):
+        def broken(records):
+            raise RuntimeError('broken')
+        foo.add_post_callback(broken, batch_size=1)
+        foo.add_post_callback(batches.append, batch_size=1)
+
+        self.assertEqual(foo(1), 1)
+        self.assertEqual(batches, [[((), {})]])
+
+    def test_executor(self):
+        threads = []
+        def deliver(records):
+            threads.append(threading.current_thread())
+        dispatcher = BackgroundDispatcher()
+        try:
+            foo.add_post_callback(deliver, batch_size=2,
+                    executor=dispatcher)
+            foo(1)
+            foo(2)
+            self.assertTrue(foo.flush_callbacks(timeout=5))
+        finally:
+            dispatcher.shutdown()
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.current_thread())
+
+    def test_bad_arguments(self):
+        async def coroutine(records):
+            pass
+
+        self.assertRaises(ValueError, foo.add_post_callback, batches.append,
+                batch_size=0)
+        self.assertRaises(ValueError, foo.add_post_callback, batches.append,
+                batch_interval=1)
+        self.assertRaises(ValueError, foo.add_post_callback, batches.append,
+                batch_size=2, batch_interval=0)
+        self.assertRaises(TypeError, foo.add_post_callback, coroutine,
+                batch_size=2)
+
+    def test_appends_from_many_threads(self):
+        foo.add_post_callback(batches.append, batch_size=8,
+                takes_target_result=True)
+        start = threading.Barrier(8)
+        errors = []
+        def call(offset):
+            start.wait()
+            try:
+                for value in range(offset, offset + 2000):
+                    foo(value)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call, args=(offset * 2000,))
+                for offset in range(8)]
+        # switch threads often, so that appends land while a batch is taken
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        foo.flush_callbacks()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(all(len(batch) <= 8 for batch in batches))
+        self.assertEqual(sorted(args[0] for batch in batches
+                    for args, kwargs in batch), list(range(16000)))
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), 'needs os.fork')
+    def test_forked_child_delivers_its_calls_on_exit(self):
+        script = textwrap.dedent('''
+            import os
+            from callbacks import supports_callbacks
+
+            @supports_callbacks
+            def foo(bar):
+                return bar
+
+            def sink(records):
+                print('%s %d' % (tag, len(records)))
+
+            foo.add_post_callback(sink, batch_size=100)
+            tag = 'parent'
+            foo(1)
+            pid = os.fork()
+            if pid:
+                os.waitpid(pid, 0)
+            else:
+                tag = 'child'
+                for value in range(5):
+                    foo(value)
+            ''')
+        output = subprocess.check_output([sys.executable, '-c', script],
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(
+                    __file__))), timeout=60)
+        self.assertEqual(output.decode().split('\n'),
+                ['child 5', 'parent 1', ''])
@@ -0,0 +1,187 @@
+from __future__ import absolute_import
+import asyncio
+import gc
+import time
+import unittest
+
+from callbacks import supports_callbacks
+
+calls = []
+events = []
+
+def record_event(event, key):
+    events.append((event, key))
+
+@supports_callbacks(cache_size=2)
+def lookup(a, b=2, **options):
+    calls.append((a, b))
+    return a + b
+
+class Example(object):
+    def __init__(self, offset):
+        self.offset = offset
+
+    @supports_callbacks(cache_size=10)
+    def per_instance(self, value):
+        calls.append(value)
+        return value + self.offset
+
+    @supports_callbacks(cache_size=10, cache_scope='class')
+    def shared(self, value):
+        calls.append(value)
+        return value + self.offset
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        del calls[:]
+        del events[:]
+        lookup.remove_callbacks()
+        lookup.clear_cache()
+
+    def test_arguments_are_normalized(self):
+        self.assertEqual(lookup(1), 3)
+        self.assertEqual(lookup(a=1), 3)
+        self.assertEqual(lookup(1, 2), 3)
+        self.assertEqual(lookup(1, b=2, c=3), 3)
+        self.assertEqual(lookup(1, c=3), 3)
+        self.assertEqual(calls, [(1, 2), (1, 2)])
+
+    def test_lru_and_events(self):
+        lookup.add_cache_callback(record_event)
+
+        lookup(1)
+        lookup(2)
+        lookup(1)
+        lookup(3)
+        key = lambda a: (('a', a), ('b', 2), ('options', ()))
+        self.assertEqual(events, [('miss', key(1)), ('miss', key(2)),
+                ('hit', key(1)), ('miss', key(3)), ('evict', key(2))])
+        self.assertEqual(calls, [(1, 2), (2, 2), (3, 2)])
+
+        info = lookup.cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['evictions'],
+                info['size']), (1, 3, 1, 2))
+
+    def test_event_filter(self):
+        lookup.add_cache_callback(record_event, events='hit')
+
+        lookup(1)
+        lookup(1)
+        self.assertEqual([event for event, key in events], ['hit'])
+
+    def test_callbacks_run_on_hits(self):
+        lookup.add_post_callback(events.append, takes_target_result=True)
+
+        lookup(1)
+        lookup(1)
+        self.assertEqual(events, [3, 3])
+        self.assertEqual(len(calls), 1)
+
+    def test_unhashable_arguments_are_not_cached(self):
+        @supports_callbacks(cache_size=2)
+        def first(items):
+            calls.append(items)
+            return items[0]
+
+        first([1])
+        first([1])
+        self.assertEqual(len(calls), 2)
+
+    def test_exceptions_are_not_cached(self):
+        self.assertRaises(TypeError, lookup, 'a')
+        self.assertRaises(TypeError, lookup, 'a')
+        self.assertEqual(len(calls), 2)
+
+    def test_ttl(self):
+        @supports_callbacks(cache_size=2, cache_ttl=0.01)
+        def clock(a):
+            calls.append(a)
+            return a
+        clock.add_cache_callback(record_event)
+
+        clock(1)
+        clock(1)
+        time.sleep(0.02)
+        clock(1)
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual([event for event, key in events],
+                ['miss', 'hit', 'evict', 'miss'])
+
+    def test_instance_scope(self):
+        one, two = Example(1), Example(2)
+        self.assertEqual(one.per_instance(1), 2)
+        self.assertEqual(two.per_instance(1), 3)
+        self.assertEqual(one.per_instance(1), 2)
+        self.assertEqual(calls, [1, 1])
+
+        one.per_instance.add_callback(events.append, takes_target_args=True)
+        self.assertEqual(one.per_instance(1), 2)
+        self.assertEqual(events, [1])
+        self.assertEqual(calls, [1, 1])
+
+    def test_equal_instances_have_caches_of_their_own(self):
+        class Value(Example):
+            # every Value is equal to every other
+            def __eq__(self, other):
+                return isinstance(other, Value)
+
+            def __hash__(self):
+                return 0
+
+        one = Value(1)
+        self.assertEqual(one.per_instance(5), 6)
+        other = Value(10)
+        self.assertEqual(other.per_instance(5), 15)
+        self.assertEqual(calls, [5, 5])
+
+        cached_target = Example.__dict__['per_instance']._cached_target
+        self.assertEqual(len(cached_target._instance_caches), 2)
+        del one, other
+        gc.collect()
+        self.assertEqual(len(cached_target._instance_caches), 0)
+
+    def test_class_scope(self):
+        one, two = Example(1), Example(2)
+        self.assertEqual(one.shared(1), 2)
+        self.assertEqual(two.shared(1), 2)
+        self.assertEqual(calls, [1])
+
+    def test_registration_errors(self):
+        @supports_callbacks
+        def plain():
+            pass
+
+        self.assertRaises(RuntimeError, plain.add_cache_callback,
+                record_event)
+        self.assertRaises(RuntimeError,
+                Example(1).per_instance.add_cache_callback, record_event)
+        self.assertRaises(ValueError, lookup.add_cache_callback,
+                record_event, events=['expired'])
+        self.assertRaises(ValueError, supports_callbacks(cache_size=0),
+                lambda: None)
+        self.assertRaises(ValueError, supports_callbacks(cache_ttl=1),
+                lambda: None)
+        self.assertEqual(plain.cache_info(), None)
+
+    def test_instrumented_target_counts_misses(self):
+        @supports_callbacks(cache_size=2, instrument=True)
+        def double(a):
+            return a * 2
+
+        double(1)
+        double(1)
+        self.assertEqual(double.callback_stats()['target']['calls'], 1)
+
+    def test_coroutines(self):
+        @supports_callbacks(cache_size=2)
+        async def fetch(a):
+            calls.append(a)
+            return a
+
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(fetch(1)), 1)
+            self.assertEqual(loop.run_until_complete(fetch(1)), 1)
+        finally:
+            loop.close()
+        self.assertEqual(calls, [1])
@@ -1,10 +1,12 @@
 from __future__ import absolute_import
 import unittest
-import uuid
 
 import typing
+from mock import patch
 
-from callbacks import supports_callbacks
+from callbacks.callbacks import DispatchPlan
+
+from callbacks import supports_callbacks, CallbackRecord, CallbackLabel
 
 called_with = []
 def callback(*args, **kwargs):
@@ -50,6 +52,19 @@ class TestCallbackDecorator(unittest.TestCase):
         self.assertEqual(len(called_with), 2)
         self.assertEqual(called_with[1], (tuple(), {}))
 
+    def test_passthrough_without_callbacks(self):
+        with patch.object(DispatchPlan, 'call_post') as call_post:
+            self.assertEqual(foo(10, 20), (10, 20))
+            self.assertFalse(call_post.called)
+
+            label = foo.add_callback(callback)
+            self.assertEqual(foo(10, 20), (10, 20))
+            self.assertEqual(call_post.call_count, 1)
+
+            foo.remove_callback(label)
+            self.assertEqual(foo(10, 20), (10, 20))
+            self.assertEqual(call_post.call_count, 1)
+
     def test_raises(self):
         self.assertRaises(ValueError, foo.add_callback, callback, priority='boo')
 
@@ -65,6 +80,34 @@ class TestCallbackDecorator(unittest.TestCase):
         self.assertRaises(RuntimeError, foo.remove_callbacks, ['bad_label', 'good_label'])
         self.assertEqual(len(foo.callbacks), 1)
 
+    def test_callback_records(self):
+        foo.add_post_callback(callback, label='a', priority=2,
+                takes_target_result=True)
+        foo.add_exception_callback(callback, label='b', handles_exception=True)
+
+        record = foo.callbacks['a']
+        self.assertTrue(isinstance(record, CallbackRecord))
+        self.assertEqual(record.function, callback)
+        self.assertEqual(record.priority, 2.0)
+        self.assertEqual(record.type, 'post')
+        self.assertFalse(record.takes_target_args)
+        self.assertTrue(record.takes_target_result)
+        self.assertEqual(record.handles_exception, None)
+        self.assertTrue(foo.callbacks['b'].handles_exception)
+        self.assertFalse(hasattr(record, '__dict__'))
+        # options that were not given take no room
+        self.assertEqual(record.options, None)
+        self.assertEqual(record.group, None)
+
+        foo.add_post_callback(callback, label='c', group='tracing')
+        self.assertEqual(foo.callbacks['c'].options, {'group': 'tracing'})
+        self.assertEqual(foo.callbacks['c'].group, 'tracing')
+        self.assertRaises(TypeError, CallbackRecord, 'd', callback, 0, 'post',
+                False, colour='red')
+
+        with self.assertRaises(TypeError):
+            foo.callbacks['c'] = record
+
     def test_callbacks_info(self):
         foo.add_pre_callback(callback, label='a')
         foo.add_pre_callback(callback, label='b', takes_target_args=True)
@@ -261,6 +304,23 @@ class TestCallbackDecorator(unittest.TestCase):
         self.assertEqual(result, (10, 20))
         self.assertEqual(called_order, ['cb1','cb2','cb3', 'cb3'])
 
+    def test_remove_callbacks_keeps_order(self):
+        labels = [foo.add_pre_callback(cb1, priority=1),
+                  foo.add_pre_callback(cb2),
+                  foo.add_callback(cb3, priority=1),
+                  foo.add_callback(cb1),
+                  foo.add_callback(cb2, priority=1)]
+
+        foo(10, 20)
+        self.assertEqual(called_order, ['cb1', 'cb2', 'cb3', 'cb2', 'cb1'])
+
+        foo.remove_callbacks([labels[0], labels[2]])
+        foo.remove_callback(labels[3])
+        self.assertEqual(len(foo.callbacks), 2)
+
+        foo(10, 20)
+        self.assertEqual(called_order[5:], ['cb2', 'cb2'])
+
     def test_labels(self):
         result = foo(10, 20)
         self.assertEqual(result, (10, 20))
@@ -272,5 +332,29 @@ class TestCallbackDecorator(unittest.TestCase):
 
         self.assertEqual(l1, 1)
         self.assertEqual(l2, 2)
-        self.assertEqual(type(l3), type(uuid.uuid4()))
+        self.assertTrue(isinstance(l3, CallbackLabel))
 
+    def test_generated_labels_are_unique(self):
+        l1 = foo.add_callback(cb1)
+        l2 = foo.add_callback(cb2)
+        self.assertNotEqual(l1, l2)
+        self.assertTrue(l1 < l2)
+        self.assertEqual(len(foo.callbacks), 2)
+
+        foo.remove_callback(l1)
+        self.assertEqual(list(foo.callbacks), [l2])
+
+
+    def test_changes_are_rebuilt_once(self):
+        with patch.object(foo, '_publish_plan',
+                wraps=foo._publish_plan) as publish_plan:
+            labels = [foo.add_callback(cb1) for _ in range(10)]
+            foo.remove_callbacks(labels[:5])
+            for label in labels[5:]:
+                foo.remove_callback(label)
+            foo.add_pre_callback(cb2)
+            self.assertEqual(publish_plan.call_count, 0)
+
+            foo(1, 2)
+            foo(1, 2)
+            self.assertEqual(publish_plan.call_count, 1)
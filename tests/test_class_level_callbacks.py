@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+import gc
+import inspect
 import unittest
 
 from callbacks import supports_callbacks
@@ -68,3 +70,114 @@ class TestClassLevel(unittest.TestCase):
 
         b.method(4321)
         self.assertEqual(called_with, [1234])
+
+    def test_instance_registry_is_created_lazily(self):
+        called_with = []
+        def callback(value):
+            called_with.append(value)
+
+        class ExampleClass(object):
+            @supports_callbacks
+            def method(self, value):
+                return value * 2
+
+        descriptor = ExampleClass.__dict__['method']
+        e = ExampleClass()
+        bound = e.method
+        self.assertEqual(bound(2), 4)
+        self.assertEqual(len(descriptor._callback_registries), 0)
+
+        e.method.add_callback(callback, takes_target_args=True)
+        self.assertEqual(len(descriptor._callback_registries), 1)
+        # which shares what it can with the class-level registry
+        registry = descriptor._callback_registries[e]
+        self.assertTrue(registry.__doc__ is descriptor.__doc__)
+        self.assertEqual(registry._callback_registries, None)
+        self.assertEqual(registry._target_stats, None)
+        del registry
+
+        # bound methods fetched earlier see the new instance-level registry
+        self.assertEqual(bound(3), 6)
+        self.assertEqual(called_with, [3])
+        self.assertEqual(bound, e.method)
+
+        del e, bound
+        gc.collect()
+        self.assertEqual(len(descriptor._callback_registries), 0)
+
+    def test_bound_method_attributes(self):
+        class ExampleClass(object):
+            @supports_callbacks
+            def method(self, value, scale=2):
+                '''Scales value.'''
+                return value * scale
+
+        descriptor = ExampleClass.__dict__['method']
+        e = ExampleClass()
+        self.assertEqual(e.method.__doc__, ExampleClass.method.__doc__)
+        self.assertTrue('Scales value.' in e.method.__doc__)
+        self.assertTrue(e.method.__wrapped__ is descriptor.target)
+        self.assertEqual(str(inspect.signature(e.method)), '(value, scale=2)')
+
+        # only the registry API creates the instance-level registry
+        self.assertFalse(hasattr(e.method, '_plan'))
+        self.assertFalse(hasattr(e.method, 'no_such_attribute'))
+        self.assertEqual(len(descriptor._callback_registries), 0)
+        self.assertEqual(e.method.num_callbacks, (0, 0))
+        self.assertEqual(len(descriptor._callback_registries), 1)
+
+    def test_class_and_instance_callback_order(self):
+        called_order = []
+        def recorder(name):
+            def callback(*args):
+                called_order.append(name)
+            return callback
+
+        class ExampleClass(object):
+            @supports_callbacks
+            def method(self):
+                called_order.append('target')
+                return 'result'
+
+        e = ExampleClass()
+        e.method.add_pre_callback(recorder('instance_pre'))
+        e.method.add_post_callback(recorder('instance_post'))
+        e.method.add_exception_callback(recorder('instance_exception'))
+        ExampleClass.method.add_pre_callback(recorder('class_pre'))
+        ExampleClass.method.add_post_callback(recorder('class_post'))
+        ExampleClass.method.add_exception_callback(recorder('class_exception'))
+
+        self.assertEqual(e.method(), 'result')
+        self.assertEqual(called_order, ['instance_pre', 'class_pre', 'target',
+                'class_post', 'instance_post'])
+
+    def test_class_level_errors_reach_instance_exception_callbacks(self):
+        handled = []
+        def handler(exception):
+            handled.append(exception)
+            return 'handled'
+        def broken_post():
+            raise ValueError('class post')
+
+        class ExampleClass(object):
+            @supports_callbacks
+            def method(self):
+                raise RuntimeError('target')
+
+        e = ExampleClass()
+        e.method.add_exception_callback(handler, handles_exception=True)
+        class_labels = [
+            ExampleClass.method.add_exception_callback(lambda exception: None,
+                handles_exception=True),
+            ExampleClass.method.add_post_callback(broken_post)]
+
+        # the class-level handler swallows the target's exception but the
+        # class-level post callback raises
+        self.assertEqual(e.method(), 'handled')
+        self.assertEqual([str(exception) for exception in handled],
+                ['class post'])
+
+        ExampleClass.method.remove_callbacks(class_labels)
+        self.assertEqual(e.method(), 'handled')
+        self.assertEqual([str(exception) for exception in handled],
+                ['class post', 'target'])
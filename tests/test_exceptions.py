@@ -171,3 +171,56 @@ class TestExceptions(unittest.TestCase):
         self.assertEqual(expected_called_with, called_with)
 
 
+
+    def test_exception_types(self):
+        foo.add_exception_callback(c5, priority=1, handles_exception=True,
+                exception_types=KeyError)
+        foo.add_exception_callback(c4, handles_exception=True,
+                exception_types=(KeyError, RuntimeError))
+
+        result = foo(1, baz=2)
+
+        self.assertEqual('c4 returned this', result)
+        self.assertEqual(['c4'], called_order)
+
+    def test_exception_types_follow_raised_exception(self):
+        # c5 turns the foo_error into a c5_error (a ValueError)
+        foo.add_exception_callback(c5, priority=3, handles_exception=True,
+                exception_types=foo_error)
+        foo.add_exception_callback(c2, priority=2, handles_exception=True,
+                exception_types=foo_error)
+        foo.add_exception_callback(c4, priority=1, handles_exception=True,
+                exception_types=ValueError)
+        foo.add_exception_callback(c1, exception_types=ValueError)
+        foo.add_exception_callback(c3)
+
+        result = foo(1, baz=2)
+
+        self.assertEqual('c4 returned this', result)
+        # c1 is skipped as the exception was handled by then
+        self.assertEqual(['c5', 'c4', 'c3'], called_order)
+
+    def test_exception_types_unhandled(self):
+        foo.add_exception_callback(c4, handles_exception=True,
+                exception_types=ValueError)
+
+        self.assertRaises(foo_error, foo, 1, baz=2)
+        self.assertEqual([], called_order)
+
+    def test_exception_types_cached(self):
+        foo.add_exception_callback(c1, exception_types=RuntimeError)
+        foo.add_exception_callback(c3, exception_types=ValueError)
+
+        self.assertRaises(foo_error, foo, 1)
+        self.assertRaises(foo_error, foo, 1)
+
+        self.assertEqual(['c1', 'c1'], called_order)
+        index = foo._plan.exception_index
+        self.assertEqual(list(index._by_type), [foo_error])
+
+    def test_exception_types_must_be_exceptions(self):
+        self.assertRaises(TypeError, foo.add_exception_callback, c1,
+                exception_types=int)
+        self.assertRaises(TypeError, foo.add_exception_callback, c1,
+                exception_types=[ValueError, 'KeyError'])
+        self.assertEqual(foo.num_callbacks, 0)
@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+import asyncio
+import unittest
+
+from callbacks import supports_callbacks
+from callbacks.filters import FilteredDispatchPlan
+
+called_with = []
+def recorder(name):
+    def callback(*args, **kwargs):
+        called_with.append((name, args, kwargs))
+    return callback
+
+@supports_callbacks
+def dispatch(event_type, payload=None, source='user'):
+    if payload == 'raise':
+        raise RuntimeError(event_type)
+    return payload
+
+class TestFilters(unittest.TestCase):
+    def setUp(self):
+        while called_with:
+            called_with.pop()
+        dispatch.remove_callbacks()
+
+    def test_when_value(self):
+        dispatch.add_post_callback(recorder('click'),
+                when={'event_type': 'click'})
+        dispatch.add_post_callback(recorder('key'), when={'event_type': 'key'})
+        dispatch.add_post_callback(recorder('all'))
+
+        dispatch('click')
+        dispatch(event_type='key')
+        dispatch('scroll')
+        self.assertEqual([name for name, args, kwargs in called_with],
+                ['click', 'all', 'key', 'all', 'all'])
+
+    def test_when_any_of_and_several_arguments(self):
+        dispatch.add_pre_callback(recorder('pointer'),
+                when={'event_type': {'click', 'move'}})
+        dispatch.add_pre_callback(recorder('system click'),
+                when={'event_type': 'click', 'source': 'system'})
+
+        dispatch('move')
+        dispatch('click')
+        dispatch('click', source='system')
+        self.assertEqual([name for name, args, kwargs in called_with],
+                ['pointer', 'pointer', 'pointer', 'system click'])
+
+    def test_order_is_kept(self):
+        dispatch.add_post_callback(recorder('low'), priority=-1,
+                when={'event_type': 'click'})
+        dispatch.add_post_callback(recorder('middle'))
+        dispatch.add_post_callback(recorder('high'), priority=1,
+                when={'event_type': 'click'})
+
+        dispatch('click')
+        self.assertEqual([name for name, args, kwargs in called_with],
+                ['high', 'middle', 'low'])
+
+    def test_flags_are_kept(self):
+        dispatch.add_post_callback(recorder('post'), takes_target_args=True,
+                takes_target_result=True, when={'event_type': 'click'})
+
+        self.assertEqual(dispatch('click', payload=1), 1)
+        self.assertEqual(called_with,
+                [('post', (1, 'click'), {'payload': 1})])
+
+    def test_unhashable_and_missing_values_match_nothing(self):
+        dispatch.add_pre_callback(recorder('click'),
+                when={'event_type': 'click'})
+
+        dispatch(['click'])
+        self.assertRaises(TypeError, dispatch)
+        self.assertEqual(called_with, [])
+
+    def test_index_only_holds_registered_values(self):
+        dispatch.add_pre_callback(recorder('click'),
+                when={'event_type': 'click'})
+        for value in range(100):
+            dispatch(value)
+        dispatch('click')
+
+        plan = dispatch._plan
+        self.assertTrue(isinstance(plan, FilteredDispatchPlan))
+        self.assertEqual(len(plan._plans), 2)
+
+    def test_unknown_parameter(self):
+        self.assertRaises(ValueError, dispatch.add_pre_callback,
+                recorder('x'), when={'kind': 'click'})
+        self.assertEqual(dispatch.num_callbacks, 0)
+
+    def test_predicate(self):
+        def is_big(event_type, payload=None, **kwargs):
+            return payload is not None and payload > 10
+        dispatch.add_post_callback(recorder('big'), takes_target_result=True,
+                predicate=is_big)
+
+        dispatch('x', payload=5)
+        dispatch('x', payload=50)
+        self.assertEqual(called_with, [('big', (50,), {})])
+
+    def test_predicate_skipped_handler_reraises(self):
+        dispatch.add_exception_callback(recorder('handler'),
+                handles_exception=True,
+                predicate=lambda event_type, **kwargs: event_type == 'ok')
+        dispatch.add_exception_callback(lambda e: 'handled', priority=-1,
+                handles_exception=True)
+
+        self.assertEqual(dispatch('other', payload='raise'), 'handled')
+        self.assertEqual(called_with, [])
+        self.assertEqual(dispatch('ok', payload='raise'), None)
+        self.assertEqual(len(called_with), 1)
+
+    def test_removal_rebuilds_plan(self):
+        label = dispatch.add_pre_callback(recorder('click'),
+                when={'event_type': 'click'})
+        dispatch.remove_callback(label)
+
+        self.assertEqual(dispatch._plan, None)
+        dispatch('click')
+        self.assertEqual(called_with, [])
+
+    def test_methods(self):
+        class Widget(object):
+            @supports_callbacks
+            def handle(self, event_type):
+                return event_type
+
+        Widget.handle.add_pre_callback(recorder('class'),
+                takes_target_args=True, when={'event_type': 'click'})
+        w = Widget()
+        w.handle.add_pre_callback(recorder('instance'),
+                when={'event_type': 'key'})
+
+        w.handle('click')
+        w.handle('key')
+        Widget().handle('key')
+        self.assertEqual(called_with,
+                [('class', ('click',), {}), ('instance', (), {})])
+
+    def test_coroutines(self):
+        @supports_callbacks(gather_post_callbacks=True)
+        async def handle(event_type):
+            return event_type
+
+        handle.add_post_callback(recorder('click'),
+                when={'event_type': 'click'})
+        handle.add_post_callback(recorder('key'), when={'event_type': 'key'})
+
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(handle('key')), 'key')
+        finally:
+            loop.close()
+        self.assertEqual(called_with, [('key', (), {})])
@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+import unittest
+
+from callbacks import supports_callbacks
+
+called_with = []
+
+def recorder(name):
+    def callback(*args, **kwargs):
+        called_with.append(name)
+    return callback
+
+@supports_callbacks
+def foo(bar):
+    return bar
+
+class TestGroups(unittest.TestCase):
+    def setUp(self):
+        del called_with[:]
+        foo.remove_callbacks()
+        for group in foo.disabled_groups:
+            foo.enable_group(group)
+
+    def test_disable_and_enable(self):
+        foo.add_pre_callback(recorder('pre'), group='tracing')
+        foo.add_post_callback(recorder('low'), priority=-1)
+        foo.add_post_callback(recorder('high'), priority=1, group='tracing')
+
+        foo.disable_group('tracing')
+        foo(1)
+        self.assertEqual(called_with, ['low'])
+        self.assertEqual(foo.disabled_groups, frozenset(['tracing']))
+        self.assertEqual(foo.num_callbacks, 3)
+
+        del called_with[:]
+        foo.enable_group('tracing')
+        foo(1)
+        self.assertEqual(called_with, ['pre', 'high', 'low'])
+
+    def test_toggling_reuses_plans(self):
+        foo.add_post_callback(recorder('post'), group='tracing')
+        enabled_plan = foo._plan
+        foo.disable_group('tracing')
+        disabled_plan = foo._plan
+        self.assertEqual(disabled_plan, None)
+
+        foo.enable_group('tracing')
+        self.assertTrue(foo._plan is enabled_plan)
+
+        foo.add_post_callback(recorder('other'))
+        self.assertFalse(foo._plan is enabled_plan)
+
+    def test_added_to_a_disabled_group(self):
+        foo.disable_group('tracing')
+        foo.add_post_callback(recorder('post'), group='tracing')
+        foo(1)
+        self.assertEqual(called_with, [])
+
+        foo.enable_group('tracing')
+        foo(1)
+        self.assertEqual(called_with, ['post'])
+
+    def test_remove_group(self):
+        first = foo.add_post_callback(recorder('first'), group='tracing')
+        second = foo.add_exception_callback(recorder('second'),
+                group='tracing')
+        foo.add_post_callback(recorder('other'), group='audit')
+        foo.disable_group('tracing')
+
+        self.assertEqual(sorted(foo.remove_group('tracing'), key=id),
+                sorted([first, second], key=id))
+        self.assertEqual(foo.remove_group('tracing'), [])
+        foo.enable_group('tracing')
+        foo(1)
+        self.assertEqual(called_with, ['other'])
+
+    def test_instance_groups(self):
+        class Example(object):
+            @supports_callbacks
+            def method(self):
+                pass
+
+        Example.method.add_post_callback(recorder('class'), group='tracing')
+        e = Example()
+        e.method.add_post_callback(recorder('instance'), group='tracing')
+
+        e.method.disable_group('tracing')
+        e.method()
+        self.assertEqual(called_with, ['class'])
+
+        del called_with[:]
+        Example.method.disable_group('tracing')
+        e.method()
+        Example().method()
+        self.assertEqual(called_with, [])
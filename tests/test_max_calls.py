@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+import threading
+import unittest
+
+from mock import patch
+
+from callbacks import supports_callbacks
+
+called_with = []
+
+def recorder(name):
+    def callback(*args, **kwargs):
+        called_with.append((name,) + args)
+    return callback
+
+@supports_callbacks
+def foo(bar):
+    if bar is None:
+        raise ValueError(bar)
+    return bar
+
+class TestMaxCalls(unittest.TestCase):
+    def setUp(self):
+        del called_with[:]
+        foo.remove_callbacks()
+
+    def test_one_shot(self):
+        foo.add_pre_callback(recorder('once'), max_calls=1)
+        foo.add_post_callback(recorder('post'))
+
+        foo(1)
+        foo(2)
+        self.assertEqual(called_with, [('once',), ('post',), ('post',)])
+        self.assertEqual(foo.num_callbacks, 1)
+
+    def test_n_shot(self):
+        foo.add_post_callback(recorder('post'), takes_target_result=True,
+                max_calls=2)
+
+        for value in range(4):
+            foo(value)
+        self.assertEqual(called_with, [('post', 0), ('post', 1)])
+        self.assertEqual(foo.num_callbacks, 0)
+
+    def test_removing_during_dispatch(self):
+        # every callback of the plan being run is still called
+        for name in 'abc':
+            foo.add_post_callback(recorder(name), max_calls=1)
+
+        foo(1)
+        foo(1)
+        self.assertEqual(called_with, [('a',), ('b',), ('c',)])
+
+    def test_unregistered_after_the_call(self):
+        foo.add_post_callback(recorder('once'), max_calls=1)
+        foo._plan
+        with patch.object(foo, '_rebuild_plan',
+                wraps=foo._rebuild_plan) as rebuild_plan:
+            foo(1)
+            self.assertEqual(rebuild_plan.call_count, 0)
+            foo(1)
+            self.assertEqual(rebuild_plan.call_count, 1)
+        self.assertEqual(foo.num_callbacks, 0)
+        self.assertEqual(called_with, [('once',)])
+
+    def test_only_calls_that_pass_the_predicate_count(self):
+        foo.add_post_callback(recorder('odd'), takes_target_args=True,
+                predicate=lambda bar: bar % 2 == 1, max_calls=1)
+
+        foo(0)
+        foo(1)
+        foo(3)
+        self.assertEqual(called_with, [('odd', 1)])
+
+    def test_exception_handler(self):
+        foo.add_exception_callback(lambda exception: 'handled',
+                handles_exception=True, max_calls=1)
+
+        self.assertEqual(foo(None), 'handled')
+        self.assertRaises(ValueError, foo, None)
+
+    def test_concurrent_calls(self):
+        foo.add_post_callback(recorder('once'), max_calls=1)
+        start = threading.Barrier(8)
+        def call():
+            start.wait()
+            for _ in range(100):
+                foo(1)
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(called_with, [('once',)])
+
+    def test_relabel_after_expiry(self):
+        foo.add_post_callback(recorder('first'), label='warmup', max_calls=1)
+        foo(1)
+        foo.add_post_callback(recorder('second'), label='warmup',
+                max_calls=1)
+        foo(1)
+        foo(1)
+        self.assertEqual(called_with, [('first',), ('second',)])
+
+    def test_bad_max_calls(self):
+        self.assertRaises(ValueError, foo.add_post_callback, recorder('x'),
+                max_calls=0)
@@ -0,0 +1,112 @@
+from __future__ import absolute_import
+import random
+import threading
+import time
+import unittest
+
+from callbacks import supports_callbacks
+
+called_with = []
+
+def callback(*args, **kwargs):
+    called_with.append(args)
+
+@supports_callbacks
+def foo(bar):
+    if bar is None:
+        raise ValueError(bar)
+    return bar
+
+class TestSampling(unittest.TestCase):
+    def setUp(self):
+        del called_with[:]
+        foo.remove_callbacks()
+
+    def test_sample_every(self):
+        foo.add_post_callback(callback, takes_target_result=True,
+                sample_every=3)
+
+        for value in range(7):
+            foo(value)
+        self.assertEqual(called_with, [(0,), (3,), (6,)])
+
+    def test_state_survives_registration(self):
+        foo.add_pre_callback(callback, takes_target_args=True,
+                sample_every=2)
+        foo(0)
+        foo.add_post_callback(lambda: None)
+        foo(1)
+        foo(2)
+        self.assertEqual(called_with, [(0,), (2,)])
+
+    def test_sample_every_counts_matching_calls(self):
+        foo.add_post_callback(callback, takes_target_args=True,
+                predicate=lambda bar: bar % 2 == 1, sample_every=2)
+
+        for value in range(8):
+            foo(value)
+        self.assertEqual(called_with, [(1,), (5,)])
+
+    def test_sample_rate(self):
+        foo.add_post_callback(callback, sample_rate=0.25)
+
+        random.seed(0)
+        for value in range(2000):
+            foo(value)
+        self.assertTrue(400 < len(called_with) < 600, len(called_with))
+
+    def test_max_per_second(self):
+        foo.add_post_callback(callback, max_per_second=5)
+
+        for value in range(100):
+            foo(value)
+        self.assertEqual(len(called_with), 5)
+        time.sleep(0.25)
+        foo(0)
+        self.assertEqual(len(called_with), 6)
+
+    def test_skipped_handler_reraises(self):
+        def handler(exception):
+            return 'handled'
+        foo.add_exception_callback(handler, handles_exception=True,
+                sample_every=2)
+
+        self.assertEqual(foo(None), 'handled')
+        self.assertRaises(ValueError, foo, None)
+        self.assertEqual(foo(None), 'handled')
+
+    def test_debounce(self):
+        done = threading.Event()
+        def last(bar):
+            called_with.append((bar, threading.current_thread()))
+            done.set()
+        foo.add_post_callback(last, takes_target_args=True, debounce=0.05)
+
+        for value in range(10):
+            foo(value)
+        self.assertEqual(called_with, [])
+        self.assertTrue(done.wait(5))
+        self.assertEqual(called_with[0][0], 9)
+        self.assertNotEqual(called_with[0][1], threading.current_thread())
+
+    def test_flush_makes_the_debounced_call(self):
+        foo.add_post_callback(callback, takes_target_args=True, debounce=60)
+
+        foo(1)
+        foo(2)
+        foo.flush_callbacks()
+        self.assertEqual(called_with, [(2,)])
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, foo.add_post_callback, callback,
+                sample_every=0)
+        self.assertRaises(ValueError, foo.add_post_callback, callback,
+                sample_rate=1.5)
+        self.assertRaises(ValueError, foo.add_post_callback, callback,
+                max_per_second=0)
+        self.assertRaises(ValueError, foo.add_post_callback, callback,
+                debounce=0)
+        self.assertRaises(ValueError, foo.add_exception_callback, callback,
+                handles_exception=True, debounce=1)
+        self.assertRaises(ValueError, foo.add_pre_callback, callback,
+                can_short_circuit=True, debounce=1)
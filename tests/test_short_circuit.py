@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+import asyncio
+import unittest
+
+from callbacks import supports_callbacks, ShortCircuit
+
+called_order = []
+
+@supports_callbacks
+def foo(bar):
+    called_order.append('foo')
+    return bar
+
+def cached(bar):
+    called_order.append('cached')
+    if bar == 'hit':
+        return ShortCircuit('from cache')
+
+def post(result, short_circuited):
+    called_order.append(('post', result, short_circuited))
+
+class Rejected(Exception):
+    pass
+
+class TestShortCircuit(unittest.TestCase):
+    def setUp(self):
+        while called_order:
+            called_order.pop()
+        foo.remove_callbacks()
+
+    def test_short_circuit(self):
+        foo.add_pre_callback(cached, priority=1, takes_target_args=True,
+                can_short_circuit=True)
+        foo.add_pre_callback(lambda: called_order.append('later'))
+        foo.add_post_callback(post, takes_target_result=True,
+                takes_short_circuited=True)
+
+        self.assertEqual(foo('hit'), 'from cache')
+        self.assertEqual(called_order,
+                ['cached', ('post', 'from cache', True)])
+
+        del called_order[:]
+        self.assertEqual(foo('miss'), 'miss')
+        self.assertEqual(called_order,
+                ['cached', 'later', 'foo', ('post', 'miss', False)])
+
+    def test_flag_with_target_args(self):
+        def post_with_args(short_circuited, bar):
+            called_order.append((short_circuited, bar))
+        foo.add_pre_callback(lambda: ShortCircuit(), can_short_circuit=True)
+        foo.add_post_callback(post_with_args, takes_target_args=True,
+                takes_short_circuited=True)
+
+        self.assertEqual(foo(1), None)
+        self.assertEqual(called_order, [(True, 1)])
+
+    def test_only_registered_callbacks_short_circuit(self):
+        foo.add_pre_callback(cached, takes_target_args=True)
+
+        self.assertEqual(foo('hit'), 'hit')
+        self.assertEqual(called_order, ['cached', 'foo'])
+
+    def test_raising_rejects_the_call(self):
+        def reject():
+            raise Rejected()
+        foo.add_pre_callback(reject)
+        foo.add_post_callback(post, takes_target_result=True,
+                takes_short_circuited=True)
+
+        self.assertRaises(Rejected, foo, 1)
+        self.assertEqual(called_order, [])
+
+    def test_methods(self):
+        class Example(object):
+            @supports_callbacks
+            def method(self, bar):
+                called_order.append('method')
+                return bar
+
+        Example.method.add_pre_callback(cached, takes_target_args=True,
+                can_short_circuit=True)
+        Example.method.add_post_callback(post, takes_target_result=True,
+                takes_short_circuited=True)
+        e = Example()
+        e.method.add_post_callback(post, takes_target_result=True,
+                takes_short_circuited=True)
+
+        self.assertEqual(e.method('hit'), 'from cache')
+        self.assertEqual(called_order, ['cached',
+                ('post', 'from cache', True), ('post', 'from cache', True)])
+
+        # an instance-level short circuit skips the class-level callbacks
+        del called_order[:]
+        e.method.add_pre_callback(lambda: ShortCircuit('instance'),
+                can_short_circuit=True)
+        self.assertEqual(e.method('miss'), 'instance')
+        self.assertEqual(called_order, [('post', 'instance', True)])
+
+    def test_coroutines(self):
+        @supports_callbacks(gather_post_callbacks=True)
+        async def target(bar):
+            called_order.append('target')
+            return bar
+
+        async def async_cached(bar):
+            return ShortCircuit('from cache')
+
+        target.add_pre_callback(async_cached, takes_target_args=True,
+                can_short_circuit=True)
+        target.add_post_callback(post, takes_target_result=True,
+                takes_short_circuited=True)
+
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(target(1)),
+                    'from cache')
+        finally:
+            loop.close()
+        self.assertEqual(called_order, [('post', 'from cache', True)])
@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+import asyncio
+import unittest
+
+from callbacks import supports_callbacks
+from callbacks.callbacks import DispatchPlan
+
+def callback():
+    pass
+
+def broken():
+    raise RuntimeError('broken')
+
+@supports_callbacks
+def foo(bar):
+    return bar
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        foo.remove_callbacks()
+        foo.disable_instrumentation()
+        foo.reset_stats()
+
+    def test_disabled_by_default(self):
+        foo.add_callback(callback, label='a')
+        foo(1)
+
+        stats = foo.callback_stats()
+        self.assertEqual(stats['target']['calls'], 0)
+        self.assertEqual(stats['callbacks'], {})
+        self.assertEqual(type(foo._plan), DispatchPlan)
+        self.assertTrue(foo._plan.post[0][0] is callback)
+
+    def test_counts_and_times(self):
+        foo.enable_instrumentation()
+        foo.add_pre_callback(callback, label='a')
+        foo.add_exception_callback(callback, label='b')
+        foo(1)
+        foo(2)
+
+        stats = foo.callback_stats()
+        self.assertEqual(stats['target']['calls'], 2)
+        self.assertEqual(stats['callbacks']['a']['calls'], 2)
+        self.assertEqual(stats['callbacks']['a']['errors'], 0)
+        self.assertEqual(sum(stats['callbacks']['a']['histogram'].values()), 2)
+        self.assertTrue(stats['callbacks']['a']['max_time'] <=
+                stats['callbacks']['a']['total_time'])
+        self.assertEqual(stats['callbacks']['b']['calls'], 0)
+        self.assertTrue('calls' in foo._callbacks_info)
+
+    def test_errors(self):
+        foo.enable_instrumentation()
+        foo.add_callback(broken, label='a')
+        self.assertRaises(RuntimeError, foo, 1)
+
+        stats = foo.callback_stats()
+        self.assertEqual(stats['callbacks']['a']['calls'], 1)
+        self.assertEqual(stats['callbacks']['a']['errors'], 1)
+
+    def test_target_timed_without_callbacks(self):
+        foo.enable_instrumentation()
+        self.assertEqual(foo(3), 3)
+        self.assertEqual(foo.callback_stats()['target']['calls'], 1)
+
+        foo.disable_instrumentation()
+        foo(3)
+        self.assertEqual(foo.callback_stats()['target']['calls'], 1)
+        self.assertTrue(foo._plan is None)
+
+    def test_methods(self):
+        class ExampleClass(object):
+            @supports_callbacks(instrument=True)
+            def method(self):
+                return 'result'
+
+        e = ExampleClass()
+        e.method.add_callback(callback, label='a')
+        ExampleClass.method.add_callback(callback, label='b')
+        self.assertEqual(e.method(), 'result')
+
+        self.assertEqual(e.method.callback_stats()['target'], None)
+        self.assertEqual(e.method.callback_stats()['callbacks']['a']['calls'], 1)
+        class_stats = ExampleClass.method.callback_stats()
+        self.assertEqual(class_stats['target']['calls'], 1)
+        self.assertEqual(class_stats['callbacks']['b']['calls'], 1)
+
+    def test_instance_registries_follow_the_class(self):
+        class ExampleClass(object):
+            @supports_callbacks
+            def method(self):
+                pass
+
+        before, after = ExampleClass(), ExampleClass()
+        before.method.add_callback(callback, label='a')
+        ExampleClass.method.enable_instrumentation()
+        after.method.add_callback(callback, label='a')
+        before.method()
+        after.method()
+        for e in (before, after):
+            self.assertTrue(e.method.instrumented)
+            self.assertEqual(
+                    e.method.callback_stats()['callbacks']['a']['calls'], 1)
+
+        ExampleClass.method.reset_stats()
+        self.assertEqual(before.method.callback_stats()['callbacks'], {})
+        ExampleClass.method.disable_instrumentation()
+        before.method()
+        self.assertFalse(before.method.instrumented)
+        self.assertEqual(before.method.callback_stats()['callbacks'], {})
+
+    def test_awaitable_results_are_passed_through(self):
+        loop = asyncio.new_event_loop()
+        results = []
+        @supports_callbacks(instrument=True)
+        def future():
+            return loop.create_future()
+
+        @supports_callbacks(instrument=True)
+        async def coroutine():
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        try:
+            future.add_post_callback(results.append,
+                    takes_target_result=True)
+            self.assertTrue(isinstance(future(), asyncio.Future))
+            self.assertTrue(isinstance(results[0], asyncio.Future))
+
+            self.assertEqual(loop.run_until_complete(coroutine()), 'result')
+        finally:
+            loop.close()
+        # coroutine functions are timed until they complete
+        self.assertTrue(coroutine.callback_stats()['target']['total_time']
+                >= 0.01)
@@ -0,0 +1,168 @@
+from __future__ import absolute_import
+import asyncio
+import unittest
+
+from callbacks import supports_callbacks, ShortCircuit
+
+called_order = []
+
+def recorder(name):
+    def callback(*args, **kwargs):
+        called_order.append((name,) + args)
+    return callback
+
+@supports_callbacks
+def rows(count, fail_at=None):
+    for row in range(count):
+        if row == fail_at:
+            raise ValueError(row)
+        called_order.append(('produce', row))
+        yield row
+    return 'done'
+
+@supports_callbacks
+async def async_rows(count, fail_at=None):
+    for row in range(count):
+        if row == fail_at:
+            raise ValueError(row)
+        await asyncio.sleep(0)
+        yield row
+
+def collect(async_generator):
+    async def consume():
+        return [item async for item in async_generator]
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(consume())
+    finally:
+        loop.close()
+
+class TestStreams(unittest.TestCase):
+    def setUp(self):
+        del called_order[:]
+        rows.remove_callbacks()
+        async_rows.remove_callbacks()
+
+    def test_callbacks_follow_the_stream(self):
+        rows.add_pre_callback(recorder('pre'))
+        rows.add_item_callback(recorder('item'))
+        rows.add_post_callback(recorder('post'), takes_target_result=True)
+
+        stream = rows(2)
+        self.assertEqual(called_order, [])
+        self.assertEqual(list(stream), [0, 1])
+        self.assertEqual(called_order, [('pre',),
+                ('produce', 0), ('item', 0),
+                ('produce', 1), ('item', 1),
+                ('post', 2)])
+
+    def test_batches(self):
+        rows.add_item_callback(recorder('batch'), batch_size=2,
+                takes_target_args=True)
+
+        list(rows(5))
+        self.assertEqual([call for call in called_order
+                if call[0] == 'batch'],
+                [('batch', [0, 1], 5), ('batch', [2, 3], 5),
+                 ('batch', [4], 5)])
+
+    def test_return_value_is_kept(self):
+        rows.add_post_callback(recorder('post'))
+        stream = rows(0)
+        try:
+            next(stream)
+        except StopIteration as stop:
+            self.assertEqual(stop.value, 'done')
+        else:
+            self.fail('the stream should be empty')
+
+    def test_mid_stream_failure(self):
+        rows.add_exception_callback(recorder('exception'))
+        rows.add_item_callback(recorder('batch'), batch_size=10)
+        rows.add_post_callback(recorder('post'))
+
+        stream = rows(5, fail_at=2)
+        self.assertEqual(next(stream), 0)
+        self.assertEqual(next(stream), 1)
+        self.assertRaises(ValueError, next, stream)
+        self.assertEqual(called_order[-2:],
+                [('batch', [0, 1]), ('exception',)])
+
+    def test_handled_failure_ends_the_stream(self):
+        rows.add_exception_callback(recorder('handler'),
+                handles_exception=True)
+        rows.add_post_callback(recorder('post'), takes_target_result=True)
+
+        self.assertEqual(list(rows(5, fail_at=1)), [0])
+        self.assertTrue(isinstance(called_order[1][1], ValueError))
+        self.assertEqual(called_order[2], ('post', 1))
+
+    def test_closed_early(self):
+        rows.add_post_callback(recorder('post'), takes_target_result=True)
+
+        stream = rows(1000)
+        next(stream)
+        stream.close()
+        self.assertEqual(called_order, [('produce', 0), ('post', 1)])
+
+    def test_send_is_forwarded(self):
+        @supports_callbacks
+        def echo():
+            received = None
+            while True:
+                received = yield received
+
+        echo.add_item_callback(recorder('item'))
+        stream = echo()
+        self.assertEqual(next(stream), None)
+        self.assertEqual(stream.send('a'), 'a')
+        self.assertEqual(called_order, [('item', None), ('item', 'a')])
+
+    def test_short_circuit(self):
+        rows.add_pre_callback(lambda: ShortCircuit(['cached']),
+                can_short_circuit=True)
+        rows.add_item_callback(recorder('item'))
+
+        self.assertEqual(list(rows(3)), ['cached'])
+        self.assertEqual(called_order, [('item', 'cached')])
+
+    def test_methods(self):
+        class Table(object):
+            @supports_callbacks
+            def scan(self, count):
+                for row in range(count):
+                    yield row
+
+        Table.scan.add_item_callback(recorder('class'))
+        t = Table()
+        t.scan.add_item_callback(recorder('instance'))
+        t.scan.add_post_callback(recorder('post'), takes_target_result=True)
+
+        self.assertEqual(list(t.scan(1)), [0])
+        self.assertEqual(called_order,
+                [('class', 0), ('instance', 0), ('post', 1)])
+
+    def test_cannot_cache(self):
+        def stream():
+            yield 1
+        self.assertRaises(ValueError, supports_callbacks(cache_size=2),
+                stream)
+
+    def test_async_generators(self):
+        async def async_item(item):
+            await asyncio.sleep(0)
+            called_order.append(('item', item))
+        async_rows.add_item_callback(async_item)
+        async_rows.add_post_callback(recorder('post'),
+                takes_target_result=True)
+
+        self.assertEqual(collect(async_rows(3)), [0, 1, 2])
+        self.assertEqual(called_order,
+                [('item', 0), ('item', 1), ('item', 2), ('post', 3)])
+
+    def test_async_generator_failure(self):
+        async_rows.add_exception_callback(recorder('handler'),
+                handles_exception=True)
+
+        self.assertEqual(collect(async_rows(3, fail_at=2)), [0, 1])
+        self.assertTrue(isinstance(called_order[0][1], ValueError))
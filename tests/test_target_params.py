@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+import unittest
+
+from callbacks import supports_callbacks
+
+called_with = []
+def callback(*args, **kwargs):
+    called_with.append((args, kwargs))
+
+@supports_callbacks
+def foo(bar, baz='bone', *extra, qux=None, **options):
+    if bar == 'raise':
+        raise RuntimeError(bar)
+    return bar
+
+class TestTargetParams(unittest.TestCase):
+    def setUp(self):
+        while called_with:
+            called_with.pop()
+        foo.remove_callbacks()
+
+    def test_positional(self):
+        foo.add_pre_callback(callback, target_params=['baz', 'bar'])
+
+        foo(1)
+        foo(1, 2)
+        foo(bar=3, baz=4)
+        self.assertEqual(called_with, [((('bone', 1)), {}),
+                ((2, 1), {}), ((4, 3), {})])
+
+    def test_keywords(self):
+        foo.add_pre_callback(callback,
+                target_params={'first': 'bar', 'q': 'qux'})
+
+        foo(1, qux=2)
+        self.assertEqual(called_with, [((), {'first': 1, 'q': 2})])
+
+    def test_var_args(self):
+        foo.add_pre_callback(callback, target_params=['extra', 'options'])
+
+        foo(1, 2, 3, 4, qux=5, other=6)
+        self.assertEqual(called_with, [(((3, 4), {'other': 6}), {})])
+
+    def test_with_result_and_exception(self):
+        foo.add_post_callback(callback, takes_target_result=True,
+                target_params=['bar'])
+        foo.add_exception_callback(callback, handles_exception=True,
+                target_params={'value': 'bar'})
+
+        foo(1)
+        self.assertEqual(called_with, [((1, 1), {})])
+
+        # the exception callback handles the exception and returns None
+        self.assertEqual(foo('raise'), None)
+        (exception,), kwargs = called_with[1]
+        self.assertTrue(isinstance(exception, RuntimeError))
+        self.assertEqual(kwargs, {'value': 'raise'})
+        self.assertEqual(called_with[2], ((None, 'raise'), {}))
+
+    def test_methods_skip_self(self):
+        class ExampleClass(object):
+            @supports_callbacks
+            def method(self, value):
+                return value
+
+        ExampleClass.method.add_pre_callback(callback, target_params=['value'])
+        e = ExampleClass()
+        e.method.add_post_callback(callback, target_params=['value'])
+        e.method(5)
+        self.assertEqual(called_with, [((5,), {}), ((5,), {})])
+
+    def test_registered_in_the_class_body(self):
+        class ExampleClass(object):
+            @supports_callbacks
+            def method(self, value, kind):
+                return value
+
+            method.add_post_callback(callback, target_params=['kind'])
+
+        ExampleClass().method(5, 'kind')
+        self.assertEqual(called_with, [(('kind',), {})])
+
+    def test_bad_params(self):
+        self.assertRaises(ValueError, foo.add_pre_callback, callback,
+                target_params=['nope'])
+        self.assertRaises(ValueError, foo.add_pre_callback, callback,
+                target_params=['bar'], takes_target_args=True)
+        self.assertEqual(foo.num_callbacks, 0)
@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+import threading
+import unittest
+
+from callbacks import supports_callbacks
+
+def callback(*args, **kwargs):
+    pass
+
+@supports_callbacks
+def foo(bar):
+    return bar
+
+def run_threads(function, count=8):
+    errors = []
+    def run():
+        try:
+            function()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+class TestThreading(unittest.TestCase):
+    def setUp(self):
+        foo.remove_callbacks()
+
+    def test_concurrent_adds_are_not_lost(self):
+        def add():
+            for _ in range(200):
+                foo.add_callback(callback)
+
+        self.assertEqual(run_threads(add), [])
+        self.assertEqual(foo.num_callbacks, 8 * 200)
+        self.assertEqual(len(foo._plan.post), 8 * 200)
+
+    def test_calls_during_registration(self):
+        stop = threading.Event()
+        call_errors = []
+        def call():
+            try:
+                while not stop.is_set():
+                    foo(1)
+                    foo._callbacks_info
+            except Exception as e:
+                call_errors.append(e)
+
+        def churn():
+            for _ in range(200):
+                labels = [foo.add_callback(callback),
+                          foo.add_pre_callback(callback),
+                          foo.add_exception_callback(callback)]
+                foo.remove_callback(labels[0])
+                foo.remove_callbacks(labels[1:])
+
+        callers = [threading.Thread(target=call) for _ in range(4)]
+        for thread in callers:
+            thread.start()
+        try:
+            errors = run_threads(churn, count=4)
+        finally:
+            stop.set()
+            for thread in callers:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(call_errors, [])
+        self.assertEqual(foo.num_callbacks, 0)
+
+    def test_plan_in_progress_is_not_modified(self):
+        called = []
+        def second():
+            called.append('second')
+        def first():
+            called.append('first')
+            foo.remove_callbacks()
+
+        foo.add_callback(first)
+        foo.add_callback(second)
+        foo(1)
+        self.assertEqual(called, ['first', 'second'])
+        foo(1)
+        self.assertEqual(called, ['first', 'second'])